@@ -0,0 +1,81 @@
+# Micro-benchmark: compiled KeywordMatcher vs the legacy substring scan
+"""
+Compare detect_category_keywords implementations on synthetic prompts.
+
+Usage (from service/):
+    python bench/bench_keywords.py [--keywords 300] [--sizes 1000,10000,50000]
+"""
+import os
+import sys
+import time
+import random
+import string
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import KeywordMatcher  # noqa: E402
+
+def legacy_detect(categories, message: str) -> str:
+    """The pre-compiled implementation: one substring scan per keyword"""
+    message_lower = message.lower()
+    for category, keywords in categories:
+        for keyword in keywords:
+            if keyword.lower() in message_lower:
+                return category
+    return "conversation"
+
+def make_categories(n_keywords: int, rng: random.Random):
+    words_per_cat = 10
+    categories = []
+    for i in range(max(1, n_keywords // words_per_cat)):
+        keywords = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(5, 10))) for _ in range(words_per_cat)]
+        categories.append((f"cat{i}", keywords))
+    categories.append(("conversation", ["thank you", "hello", "def "]))
+    return categories
+
+def make_message(size: int, vocab, rng: random.Random) -> str:
+    weights = [1 / (i + 1) for i in range(len(vocab))]
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choices(vocab, weights=weights)[0]
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+def timeit(fn, *args, repeat: int = 20) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(*args)
+    return (time.perf_counter() - start) / repeat * 1000
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keywords", type=int, default=300)
+    parser.add_argument("--sizes", default="1000,10000,50000")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    
+    rng = random.Random(args.seed)
+    categories = make_categories(args.keywords, rng)
+    vocab = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for _ in range(3000)]
+    
+    start = time.perf_counter()
+    matcher = KeywordMatcher(categories)
+    build_ms = (time.perf_counter() - start) * 1000
+    print(f"keywords={sum(len(k) for _, k in categories)} build={build_ms:.1f}ms")
+    print(f"{'size':>8} {'legacy_ms':>10} {'compiled_ms':>12} {'speedup':>8}")
+    
+    for size in [int(s) for s in args.sizes.split(",")]:
+        message = make_message(size, vocab, rng)
+        # Plant a keyword from the last category so neither side can exit early
+        message += " " + categories[-2][1][0]
+        expected = legacy_detect(categories, message)
+        assert (matcher.match(message) or "conversation") == expected
+        legacy_ms = timeit(legacy_detect, categories, message)
+        compiled_ms = timeit(matcher.match, message)
+        print(f"{size:>8} {legacy_ms:>10.3f} {compiled_ms:>12.3f} {legacy_ms / compiled_ms:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
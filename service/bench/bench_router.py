@@ -0,0 +1,292 @@
+# Load benchmark: the FastAPI app against a local mock provider
+"""
+Drive /v1/chat/completions in-process (direct ASGI calls) at fixed concurrency
+levels, with every provider pointed at bench/mock_provider.py in a child process.
+
+Reports per scenario and concurrency: throughput, p50/p95/p99 latency, router
+overhead (request latency minus time spent in call_model / open_model_stream, so
+it includes classification), router CPU time per request and, with --memory,
+memory per in-flight request.
+
+Scenarios:
+    keywords  keyword routing, single model
+    api       classification by the router API model
+    hybrid    Ollama and API classifiers raced
+    semantic  embedding classifier (SEMANTIC_EMBEDDER, default built-in hash)
+    fallback  first model of the chain answers 500
+    spill     first model answers 429, chain spills over
+    stream    keyword routing, SSE streaming (latency = time to first byte)
+
+Usage (from service/):
+    python bench/bench_router.py [--scenarios keywords,api,stream] [--concurrency 1,10,50]
+        [--requests 300] [--prompt-kb 64] [--memory] [--json results.json] [mock provider options]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import contextvars
+import tracemalloc
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_provider import add_arguments  # noqa: E402
+
+SCENARIOS = ["keywords", "api", "hybrid", "semantic", "fallback", "spill", "stream"]
+BENCH_MODEL = "openai/gpt-4o-mini"
+
+# Upstream time spent by the current request, summed over call_model / open_model_stream
+upstream_ms: contextvars.ContextVar = contextvars.ContextVar("upstream_ms")
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_mock(args, mock_dests: List[str]) -> Tuple[subprocess.Popen, int]:
+    """Run the mock in its own process so it does not compete with the router for the GIL"""
+    port = free_port()
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_provider.py"),
+               "--port", str(port)]
+    for dest in mock_dests:
+        command += [f"--{dest.replace('_', '-')}", str(getattr(args, dest))]
+    process = subprocess.Popen(command)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process, port
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise SystemExit("Mock provider did not start")
+
+def import_router(mock_port: int, workdir: str):
+    """Import main with every provider on the mock and state files in a temp dir"""
+    base = f"http://127.0.0.1:{mock_port}"
+    for name in ("OPENROUTER", "OPENAI"):
+        os.environ[f"{name}_BASE_URL"] = base + "/v1"
+        os.environ[f"{name}_API_KEY"] = "bench"
+    os.environ["OLLAMA_BASE_URL"] = base
+    os.environ["ROUTER_CONFIG_FILE"] = os.path.join(workdir, "router_config.json")
+    os.environ["EVENT_STORE_DB"] = os.path.join(workdir, "request_events.db")
+    os.environ.setdefault("ACCESS_LOG_FILE", os.devnull)  # Still formatted and written, off the table
+    import main
+
+    main.circuit_breaker.persister.path = os.path.join(workdir, "circuit_breaker_state.json")
+    main.print = lambda *a, **k: None  # Per-request logging would dominate the profile
+
+    def timed(fn):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                spent = upstream_ms.get(None)
+                if spent is not None:
+                    spent.append((time.perf_counter() - start) * 1000)
+        return wrapper
+
+    main.call_model = timed(main.call_model)
+    main.open_model_stream = timed(main.open_model_stream)
+    return main
+
+def configure(main, scenario: str):
+    main.routing_cache.clear()
+    main.circuit_breaker.reset_all()
+    main.rate_limiter.blocked_until.clear()
+    main.session_affinity.sessions.clear()
+    main.ROUTING_MODE = {"api": "api", "hybrid": "hybrid", "semantic": "semantic"}.get(scenario, "keywords")
+    chain = [BENCH_MODEL]
+    # Requests share their opening turns: keep them from being pinned to one session
+    config = {"session_affinity": {"enabled": False}}
+    if scenario == "fallback":
+        chain = ["openai/fail-model", BENCH_MODEL]
+        # Keep the failing model in the chain: measure fallback, not the open circuit
+        config["circuit_breaker"] = {"failure_threshold": 10 ** 9}
+    elif scenario == "spill":
+        chain = ["openai/ratelimit-model", BENCH_MODEL]
+    config["model_mappings"] = {category: list(chain) for category in main.model_mappings}
+    main.config_store.apply(config)
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+async def asgi_post(app, body: Dict) -> Tuple[int, float, float]:
+    """POST straight to the ASGI app. Returns (status, ms to first body byte, ms to end).
+    
+    Bypassing an HTTP client keeps its cost out of the numbers and, unlike the
+    httpx ASGI transport, sees streamed chunks as the app sends them.
+    """
+    payload = json.dumps(body).encode()
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/v1/chat/completions", "raw_path": b"/v1/chat/completions",
+        "root_path": "", "query_string": b"", "server": ("router", 80), "client": ("127.0.0.1", 50000),
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())],
+    }
+    done = asyncio.Event()
+    sent = False
+    status = 0
+    first_byte = None
+    start = time.perf_counter()
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": payload, "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status, first_byte
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            if first_byte is None and message.get("body"):
+                first_byte = time.perf_counter()
+            if not message.get("more_body"):
+                done.set()
+
+    try:
+        await app(scope, receive, send)
+    finally:
+        done.set()
+    end = time.perf_counter()
+    return status, ((first_byte or end) - start) * 1000, (end - start) * 1000
+
+def filler_messages(prompt_kb: int) -> List[Dict]:
+    """Earlier conversation turns adding about prompt_kb KB to the request"""
+    turn = "Here is the file you asked about, with the traceback and the config it loads. " * 12
+    messages = []
+    while sum(len(m["content"]) for m in messages) < prompt_kb * 1024:
+        messages.append({"role": "user" if len(messages) % 2 == 0 else "assistant", "content": turn})
+    return messages
+
+async def one_request(app, scenario: str, i: int, latencies: List[float], overheads: List[float], errors: List[int],
+                      history: List[Dict] = ()):
+    # Unique prompts: every request misses the routing cache
+    prompt = f"please explain this python function and its bug, variant {i} {time.perf_counter_ns()}"
+    body = {"model": "auto", "messages": [*history, {"role": "user", "content": prompt}], "stream": scenario == "stream"}
+    spent: List[float] = []
+    upstream_ms.set(spent)
+    try:
+        status, first_byte_ms, total_ms = await asgi_post(app, body)
+    except Exception:
+        errors[0] += 1
+        return
+    if status != 200:
+        errors[0] += 1
+        return
+    # Streams: time to first byte, against open_model_stream (which returns on the first chunk)
+    elapsed = first_byte_ms if scenario == "stream" else total_ms
+    latencies.append(elapsed)
+    overheads.append(elapsed - sum(spent))
+
+async def run_level(main, scenario: str, concurrency: int, n_requests: int, memory: bool, prompt_kb: int) -> Dict:
+    latencies: List[float] = []
+    overheads: List[float] = []
+    errors = [0]
+    history = filler_messages(prompt_kb)
+    for i in range(min(concurrency, 20)):  # Warm up pools and code paths
+        await one_request(main.app, scenario, -i, [], [], [0], history)
+
+    queue = iter(range(n_requests))
+
+    async def worker():
+        for i in queue:
+            await one_request(main.app, scenario, i, latencies, overheads, errors, history)
+
+    if memory:
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    cpu = time.process_time() - cpu_start
+    duration = time.perf_counter() - start
+    result = {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": n_requests,
+        "errors": errors[0],
+        "throughput_rps": round(len(latencies) / duration, 1),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "overhead_p50_ms": round(percentile(overheads, 50), 3),
+        "overhead_p95_ms": round(percentile(overheads, 95), 3),
+        # The mock runs in another process: this is router CPU only
+        "cpu_ms_per_request": round(cpu * 1000 / n_requests, 3),
+    }
+    if memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["inflight_kb_per_request"] = round((peak - baseline) / concurrency / 1024, 1)
+        result["retained_bytes_per_request"] = round((current - baseline) / n_requests)
+    return result
+
+def print_table(results: List[Dict]):
+    columns = ["scenario", "concurrency", "throughput_rps", "p50_ms", "p95_ms", "p99_ms",
+               "overhead_p50_ms", "overhead_p95_ms", "cpu_ms_per_request", "errors"]
+    if results and "inflight_kb_per_request" in results[0]:
+        columns += ["inflight_kb_per_request", "retained_bytes_per_request"]
+    widths = [max(len(c), *(len(str(r[c])) for r in results)) for c in columns]
+    print("  ".join(c.rjust(w) for c, w in zip(columns, widths)))
+    for r in results:
+        print("  ".join(str(r[c]).rjust(w) for c, w in zip(columns, widths)))
+
+async def run(args, main) -> List[Dict]:
+    results = []
+    for scenario in args.scenarios.split(","):
+        if scenario not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario: {scenario} (choose from {', '.join(SCENARIOS)})")
+        configure(main, scenario)
+        for concurrency in [int(c) for c in args.concurrency.split(",")]:
+            results.append(await run_level(main, scenario, concurrency, args.requests, args.memory, args.prompt_kb))
+            print(f"  {scenario} x{concurrency}: {results[-1]['throughput_rps']} req/s", file=sys.stderr)
+    await main.provider_pools.close()
+    return results
+
+def main_cli():
+    mock_parser = argparse.ArgumentParser(add_help=False)
+    add_arguments(mock_parser)
+    mock_dests = [action.dest for action in mock_parser._actions]
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     parents=[mock_parser])
+    parser.add_argument("--scenarios", default="keywords,api,hybrid,semantic,fallback,spill,stream")
+    parser.add_argument("--concurrency", default="1,10,50")
+    parser.add_argument("--requests", type=int, default=300, help="Requests per scenario and level")
+    parser.add_argument("--prompt-kb", type=int, default=0, help="Add earlier turns of about this size to every request")
+    parser.add_argument("--memory", action="store_true", help="Trace allocations (slower, separate from timing runs)")
+    parser.add_argument("--json", help="Also write results to this file")
+    args = parser.parse_args()
+
+    process, port = start_mock(args, mock_dests)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            router = import_router(port, workdir)
+            results = asyncio.run(run(args, router))
+            router.circuit_breaker.persister.stop()
+    finally:
+        process.terminate()
+
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main_cli()
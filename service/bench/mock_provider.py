@@ -0,0 +1,211 @@
+# Local mock of the OpenAI-compatible and Ollama APIs, for offline benchmarks
+"""
+Answers /v1/chat/completions (JSON or SSE) and Ollama /api/chat (JSON or NDJSON)
+and /api/generate with synthetic completions after a sampled latency, and
+/v1/embeddings and /api/embed with bag-of-words vectors.
+
+Router classifier models (--router-models) answer with a category name. Other
+behaviour is driven by the model name, so fallback scenarios need no extra setup:
+    *fail*       always 500
+    *ratelimit*  always 429 with Retry-After
+    *slow*       latency x10
+
+Usage (from service/):
+    python bench/mock_provider.py [--port 9100] [--latency-ms 50 --latency-dist lognormal]
+        [--error-rate 0.01] [--rate-limit-rate 0.01] [--stream-chunks 20]
+    OPENAI_BASE_URL=http://127.0.0.1:9100/v1 OLLAMA_BASE_URL=http://127.0.0.1:9100 ...
+"""
+import json
+import time
+import zlib
+import random
+import asyncio
+import argparse
+from dataclasses import dataclass, field
+from typing import List
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+CATEGORIES = ["code", "reasoning", "conversation"]
+WORDS = "the router picks a model for each request based on its category and fallback chain".split()
+
+@dataclass
+class MockConfig:
+    latency_ms: float = 50.0
+    latency_dist: str = "lognormal"  # fixed | uniform | exponential | lognormal
+    latency_sigma: float = 0.3       # lognormal shape; uniform spreads +/- this share
+    router_latency_ms: float = 20.0
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    retry_after_sec: float = 1.0
+    completion_tokens: int = 40
+    stream_chunks: int = 20
+    chunk_delay_ms: float = 2.0
+    embedding_dim: int = 256
+    router_models: List[str] = field(default_factory=lambda: ["qwen2.5:0.5b", "qwen/qwen3-1.7b", "qwen3-1.7b"])
+    seed: int = 0
+
+def sample_latency(cfg: MockConfig, mean_ms: float, rng: random.Random) -> float:
+    if cfg.latency_dist == "fixed":
+        return mean_ms
+    if cfg.latency_dist == "uniform":
+        return rng.uniform(mean_ms * (1 - cfg.latency_sigma), mean_ms * (1 + cfg.latency_sigma))
+    if cfg.latency_dist == "exponential":
+        return rng.expovariate(1 / mean_ms) if mean_ms > 0 else 0.0
+    # lognormal with median mean_ms: a realistic long tail
+    return mean_ms * rng.lognormvariate(0, cfg.latency_sigma)
+
+def create_app(cfg: MockConfig) -> FastAPI:
+    app = FastAPI(title="Mock LLM provider")
+    rng = random.Random(cfg.seed)
+    app.state.requests = 0
+
+    def completion_text(n_tokens: int) -> List[str]:
+        return [rng.choice(WORDS) + " " for _ in range(n_tokens)]
+
+    async def misbehave(model: str):
+        """Sleep the sampled latency; return an error response, or None to answer"""
+        app.state.requests += 1
+        is_router = model in cfg.router_models
+        mean = cfg.router_latency_ms if is_router else cfg.latency_ms
+        if "slow" in model:
+            mean *= 10
+        await asyncio.sleep(sample_latency(cfg, mean, rng) / 1000)
+        if "ratelimit" in model or (not is_router and rng.random() < cfg.rate_limit_rate):
+            return JSONResponse({"error": {"message": "Rate limit exceeded"}}, status_code=429,
+                                headers={"Retry-After": str(cfg.retry_after_sec)})
+        if "fail" in model or (not is_router and rng.random() < cfg.error_rate):
+            return JSONResponse({"error": {"message": "Upstream error"}}, status_code=500)
+        return None
+
+    def reply_for(model: str) -> List[str]:
+        if model in cfg.router_models:
+            return [rng.choice(CATEGORIES)]
+        return completion_text(cfg.completion_tokens)
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get("model", "")
+        error = await misbehave(model)
+        if error is not None:
+            return error
+        tokens = reply_for(model)
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in body.get("messages", [])) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                 "total_tokens": prompt_tokens + len(tokens)}
+        created = int(time.time())
+        if not body.get("stream"):
+            return {
+                "id": f"chatcmpl-mock-{app.state.requests}", "object": "chat.completion", "created": created,
+                "model": model, "usage": usage,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                             "finish_reason": "stop"}]
+            }
+
+        async def events():
+            per_chunk = max(1, len(tokens) // max(cfg.stream_chunks, 1))
+            for i in range(0, len(tokens), per_chunk):
+                chunk = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": created, "model": model,
+                         "choices": [{"index": 0, "delta": {"content": "".join(tokens[i:i + per_chunk])},
+                                      "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(cfg.chunk_delay_ms / 1000)
+            final = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+            yield f"data: {json.dumps(final)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    def embedding(text: str) -> List[float]:
+        """Deterministic bag-of-words vector, so equal words give close embeddings"""
+        vector = [0.0] * cfg.embedding_dim
+        for word in text.lower().split():
+            vector[zlib.crc32(word.encode()) % cfg.embedding_dim] += 1.0
+        return vector
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        await asyncio.sleep(sample_latency(cfg, cfg.router_latency_ms / 4, rng) / 1000)
+        return {"object": "list", "model": body.get("model"),
+                "data": [{"object": "embedding", "index": i, "embedding": embedding(t)} for i, t in enumerate(texts)]}
+
+    @app.post("/api/embed")
+    async def ollama_embed(request: Request):
+        body = await request.json()
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        await asyncio.sleep(sample_latency(cfg, cfg.router_latency_ms / 4, rng) / 1000)
+        return {"model": body.get("model"), "embeddings": [embedding(t) for t in texts]}
+
+    @app.post("/api/generate")
+    async def ollama_generate(request: Request):
+        body = await request.json()
+        model = body.get("model", "")
+        error = await misbehave(model)
+        if error is not None:
+            return error
+        return {"model": model, "response": "".join(reply_for(model)), "done": True}
+
+    @app.post("/api/chat")
+    async def ollama_chat(request: Request):
+        body = await request.json()
+        model = body.get("model", "")
+        error = await misbehave(model)
+        if error is not None:
+            return error
+        tokens = reply_for(model)
+        if not body.get("stream"):
+            return {"model": model, "message": {"role": "assistant", "content": "".join(tokens)}, "done": True,
+                    "prompt_eval_count": 10, "eval_count": len(tokens)}
+
+        async def lines():
+            per_chunk = max(1, len(tokens) // max(cfg.stream_chunks, 1))
+            for i in range(0, len(tokens), per_chunk):
+                yield json.dumps({"model": model, "message": {"role": "assistant",
+                                                               "content": "".join(tokens[i:i + per_chunk])},
+                                  "done": False}) + "\n"
+                await asyncio.sleep(cfg.chunk_delay_ms / 1000)
+            yield json.dumps({"model": model, "message": {"role": "assistant", "content": ""}, "done": True,
+                              "prompt_eval_count": 10, "eval_count": len(tokens)}) + "\n"
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    return app
+
+def add_arguments(parser: argparse.ArgumentParser):
+    defaults = MockConfig()
+    parser.add_argument("--latency-ms", type=float, default=defaults.latency_ms, help="Median completion latency")
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "exponential", "lognormal"],
+                        default=defaults.latency_dist)
+    parser.add_argument("--latency-sigma", type=float, default=defaults.latency_sigma)
+    parser.add_argument("--router-latency-ms", type=float, default=defaults.router_latency_ms,
+                        help="Median latency of classifier models")
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="Share of 500 answers")
+    parser.add_argument("--rate-limit-rate", type=float, default=defaults.rate_limit_rate, help="Share of 429 answers")
+    parser.add_argument("--retry-after-sec", type=float, default=defaults.retry_after_sec)
+    parser.add_argument("--completion-tokens", type=int, default=defaults.completion_tokens)
+    parser.add_argument("--stream-chunks", type=int, default=defaults.stream_chunks)
+    parser.add_argument("--chunk-delay-ms", type=float, default=defaults.chunk_delay_ms)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+def config_from_args(args: argparse.Namespace) -> MockConfig:
+    return MockConfig(
+        latency_ms=args.latency_ms, latency_dist=args.latency_dist, latency_sigma=args.latency_sigma,
+        router_latency_ms=args.router_latency_ms, error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+        retry_after_sec=args.retry_after_sec, completion_tokens=args.completion_tokens,
+        stream_chunks=args.stream_chunks, chunk_delay_ms=args.chunk_delay_ms, seed=args.seed,
+    )
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,96 @@
+# Local stand-in for Redis: the handful of RESP2 commands the shared-state backend uses
+"""
+Single-process, in-memory server speaking enough RESP2 for SHARED_STATE_BACKEND=redis,
+so multi-worker shared state can be tried without a Redis install.
+
+Usage (from service/):
+    python bench/mock_redis.py [--port 6379]
+    SHARED_STATE_BACKEND=redis SHARED_STATE_URL=redis://localhost:6379/0 uvicorn main:app --workers 4
+"""
+import asyncio
+import argparse
+
+store = {}
+
+def encode(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, bool):
+        return b"+OK\r\n"
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(encode(v) for v in value)
+    data = str(value).encode("utf-8")
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+def execute(command):
+    name, args = command[0].upper(), command[1:]
+    if name in ("PING",):
+        return "PONG"
+    if name in ("AUTH", "SELECT"):
+        return True
+    if name == "DEL":
+        return sum(1 for key in args if store.pop(key, None) is not None)
+    if name == "HINCRBYFLOAT":
+        key, field, delta = args
+        table = store.setdefault(key, {})
+        table[field] = repr(float(table.get(field, 0)) + float(delta))
+        return table[field]
+    if name == "HINCRBY":
+        key, field, delta = args
+        table = store.setdefault(key, {})
+        table[field] = str(int(table.get(field, 0)) + int(delta))
+        return int(table[field])
+    if name == "HSET":
+        key, field, value = args
+        table = store.setdefault(key, {})
+        added = field not in table
+        table[field] = value
+        return int(added)
+    if name == "HGETALL":
+        table = store.get(args[0], {})
+        return [item for pair in table.items() for item in pair]
+    raise ValueError(f"unknown command '{name}'")
+
+async def read_command(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    count = int(line[1:-2])
+    command = []
+    for _ in range(count):
+        length = int((await reader.readline())[1:-2])
+        command.append((await reader.readexactly(length + 2))[:-2].decode("utf-8"))
+    return command
+
+async def handle(reader, writer):
+    try:
+        while True:
+            command = await read_command(reader)
+            if command is None:
+                break
+            try:
+                writer.write(encode(execute(command)))
+            except Exception as e:
+                writer.write(f"-ERR {e}\r\n".encode())
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def main(port: int):
+    server = await asyncio.start_server(handle, "127.0.0.1", port)
+    print(f"mock redis listening on 127.0.0.1:{port}")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args.port))
+    except KeyboardInterrupt:
+        pass
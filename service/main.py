@@ -2,25 +2,51 @@
 """
 Routing intelligent avec:
 - Multi-provider: OpenRouter, OpenAI, Anthropic, Google, Ollama
-- Modes: ollama | api | hybrid | keywords
+- Modes: ollama | api | hybrid | keywords | semantic
 - Circuit breaker persistant
 - Métriques de coût estimé
 - Configuration utilisateur des modèles et catégories
 """
 import os
+import sys
 import re
 import time
 import json
+import hashlib
+import mimetypes
+import zlib
+import math
+import random
+import sqlite3
+import bisect
+import mmap
+import socket
+import struct
+import email.utils
+import urllib.parse
+import asyncio
+import contextvars
+import logging
+import logging.handlers
+import queue
 from datetime import datetime
-from typing import Optional, List, Dict, Any, Tuple, Literal
+from typing import Optional, List, Dict, Any, Tuple, Literal, Callable, Mapping
+from types import MappingProxyType
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from fastapi.exceptions import RequestValidationError
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 import httpx
+import anyio
 from dotenv import load_dotenv
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
 import threading
+import atexit
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 load_dotenv()
 
@@ -30,15 +56,137 @@ app = FastAPI(title="LLM Router", version="0.5.0")
 # MIDDLEWARE
 # =============================================================================
 
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    if request.url.path in ["/chat/completions", "/v1/chat/completions"]:
+ACCESS_LOG = os.getenv("ACCESS_LOG", "true").lower() == "true"
+ACCESS_LOG_FORMAT = os.getenv("ACCESS_LOG_FORMAT", "json")  # json | text
+ACCESS_LOG_FILE = os.getenv("ACCESS_LOG_FILE", "")  # Empty: stdout
+ACCESS_LOG_SAMPLE_RATE = float(os.getenv("ACCESS_LOG_SAMPLE_RATE", "1.0"))  # Errors are always logged
+
+# Routing details of the request being served, filled in by the endpoints
+access_log_fields: contextvars.ContextVar = contextvars.ContextVar("access_log_fields", default=None)
+
+def annotate_access_log(**fields):
+    """Attach routing details (category, model, attempts...) to the current access-log line"""
+    current = access_log_fields.get()
+    if current is not None:
+        current.update(fields)
+
+class AccessLogFormatter(logging.Formatter):
+    """Renders the record dict on the listener thread, not on the event loop"""
+    
+    def __init__(self, fmt: str):
+        super().__init__()
+        self.fmt = fmt
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z"}
+        entry.update((k, v) for k, v in record.msg.items() if v is not None)
+        if self.fmt == "text":
+            return " ".join(f"{k}={v}" for k, v in entry.items())
+        return json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record  # Formatting happens on the listener thread
+
+class AccessLog:
+    """One structured line per request, written by a background thread.
+    
+    The event loop only builds a dict and puts it on a queue; a QueueListener
+    formats it (JSON or key=value) and does the blocking write.
+    """
+    
+    def __init__(self, fmt: str = ACCESS_LOG_FORMAT, path: str = ACCESS_LOG_FILE,
+                 sample_rate: float = ACCESS_LOG_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.logger = logging.getLogger("llm_router.access")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        handler = logging.FileHandler(path, encoding="utf-8") if path else logging.StreamHandler(sys.stdout)
+        handler.setFormatter(AccessLogFormatter(fmt))
+        log_queue = queue.SimpleQueue()
+        self.logger.handlers = [RecordQueueHandler(log_queue)]
+        self.listener = logging.handlers.QueueListener(log_queue, handler)
+        self.listener.start()
+        self.stopped = False
+        self.stats = {"logged": 0, "sampled_out": 0}
+    
+    def should_log(self, status: int) -> bool:
+        if status >= 400 or self.sample_rate >= 1 or random.random() < self.sample_rate:
+            return True
+        self.stats["sampled_out"] += 1
+        return False
+    
+    def emit(self, entry: Dict):
+        self.stats["logged"] += 1
+        self.logger.info(entry)
+    
+    def stop(self):
+        """Flush pending lines; safe to call twice (shutdown event and atexit)"""
+        if not self.stopped:
+            self.stopped = True
+            self.listener.stop()
+
+class AccessLogMiddleware:
+    """Pure ASGI middleware: never reads the body, so streaming and parsing are untouched.
+    
+    Request size comes from Content-Length, or from counting the received chunks
+    when the header is missing; response size and status from the sent messages.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        fields: Dict[str, Any] = {}
+        token = access_log_fields.set(fields)
+        sizes = {"request": None, "response": 0}
+        status = 500
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                try:
+                    sizes["request"] = int(value)
+                except ValueError:
+                    pass  # Malformed: count the received chunks instead
+                break
+        
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                sizes["request"] = (sizes["request"] or 0) + len(message.get("body", b""))
+            return message
+        
+        async def counting_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sizes["response"] += len(message.get("body", b""))
+            await send(message)
+        
         try:
-            body = await request.body()
-            print(f"[REQUEST] {request.url.path} ({len(body)} bytes)")
-        except:
-            pass
-    return await call_next(request)
+            await self.app(scope, receive if sizes["request"] is not None else counting_receive, counting_send)
+        finally:
+            access_log_fields.reset(token)
+            if access_log.should_log(status):
+                access_log.emit({
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status,
+                    "latency_ms": round((time.perf_counter() - start) * 1000, 2),
+                    "request_bytes": sizes["request"] or 0,
+                    "response_bytes": sizes["response"],
+                    **fields
+                })
+
+access_log: Optional[AccessLog] = None
+if ACCESS_LOG:
+    access_log = AccessLog()
+    atexit.register(access_log.stop)
+    app.add_middleware(AccessLogMiddleware)
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
@@ -63,6 +211,10 @@ PROVIDERS = {
         "auth_header": "Authorization",
         "auth_prefix": "Bearer ",
         "models_prefix": "",  # Models are referenced as-is
+        "api": "openai",  # Wire format, see PROVIDER ADAPTERS
+        "health_path": "/auth/key",  # Cheap authenticated call, see HEALTH CHECKS
+        "timeout": float(os.getenv("OPENROUTER_TIMEOUT", "60")),
+        "http2": True,
     },
     "openai": {
         "base_url": os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1"),
@@ -70,6 +222,10 @@ PROVIDERS = {
         "auth_header": "Authorization",
         "auth_prefix": "Bearer ",
         "models_prefix": "",
+        "api": "openai",
+        "health_path": "/models",
+        "timeout": float(os.getenv("OPENAI_TIMEOUT", "60")),
+        "http2": True,
     },
     "anthropic": {
         "base_url": os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com/v1"),
@@ -77,7 +233,10 @@ PROVIDERS = {
         "auth_header": "x-api-key",
         "auth_prefix": "",
         "models_prefix": "",
-        "requires_version": True,
+        "api": "anthropic",  # Messages API, with anthropic-version header
+        "health_path": "/models?limit=1",
+        "timeout": float(os.getenv("ANTHROPIC_TIMEOUT", "60")),
+        "http2": True,
     },
     "google": {
         "base_url": os.getenv("GOOGLE_BASE_URL", "https://generativelanguage.googleapis.com/v1beta"),
@@ -85,6 +244,10 @@ PROVIDERS = {
         "auth_header": "x-goog-api-key",
         "auth_prefix": "",
         "models_prefix": "models/",
+        "api": "google",  # generateContent
+        "health_path": "/models?pageSize=1",
+        "timeout": float(os.getenv("GOOGLE_TIMEOUT", "60")),
+        "http2": True,
     },
     "ollama": {
         "base_url": os.getenv("OLLAMA_BASE_URL", "http://localhost:11434"),
@@ -92,7 +255,10 @@ PROVIDERS = {
         "auth_header": None,
         "auth_prefix": "",
         "models_prefix": "",
-        "use_generate_api": True,  # Ollama uses /api/generate
+        "api": "ollama",  # /api/chat
+        "health_path": "/api/version",
+        "timeout": float(os.getenv("OLLAMA_TIMEOUT", "60")),
+        "http2": False,  # Local plain HTTP, no h2c
     },
 }
 
@@ -101,6 +267,89 @@ OLLAMA_ROUTER_MODEL = os.getenv("OLLAMA_ROUTER_MODEL", "qwen2.5:0.5b")
 ROUTER_API_MODEL = os.getenv("ROUTER_API_MODEL", "qwen/qwen3-1.7b")
 DEFAULT_PROVIDER = os.getenv("DEFAULT_PROVIDER", "openrouter")
 DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "z-ai/glm-5")
+ROUTER_NAME = os.getenv("ROUTER_NAME", "LLM Router")
+ROUTER_URL = os.getenv("ROUTER_URL", "https://llm-router.akashabot.com")
+
+# =============================================================================
+# CONNECTION POOLS
+# =============================================================================
+
+try:
+    import h2  # noqa: F401 - enables HTTP/2 support in httpx
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+POOL_MAX_CONNECTIONS = int(os.getenv("POOL_MAX_CONNECTIONS", "100"))
+POOL_MAX_KEEPALIVE = int(os.getenv("POOL_MAX_KEEPALIVE", "20"))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("POOL_KEEPALIVE_EXPIRY", "30"))
+POOL_CONNECT_TIMEOUT = float(os.getenv("POOL_CONNECT_TIMEOUT", "10"))
+
+class ProviderPools:
+    """One long-lived httpx.AsyncClient per provider, opened at startup and closed at shutdown."""
+
+    def __init__(self):
+        self.clients: Dict[str, httpx.AsyncClient] = {}
+
+    def _create_client(self, provider: str) -> httpx.AsyncClient:
+        prov_config = PROVIDERS[provider]
+        limits = httpx.Limits(
+            max_connections=POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=POOL_MAX_KEEPALIVE,
+            keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+        )
+        timeout = httpx.Timeout(prov_config.get("timeout", 60.0), connect=POOL_CONNECT_TIMEOUT)
+        return httpx.AsyncClient(
+            limits=limits,
+            timeout=timeout,
+            http2=HTTP2_AVAILABLE and prov_config.get("http2", False),
+        )
+
+    async def start(self):
+        for provider in PROVIDERS:
+            if provider not in self.clients:
+                self.clients[provider] = self._create_client(provider)
+
+    async def close(self):
+        clients, self.clients = self.clients, {}
+        for client in clients.values():
+            try:
+                await client.aclose()
+            except Exception as e:
+                print(f"Error closing client: {e}")
+
+    def get(self, provider: str) -> httpx.AsyncClient:
+        """Return the pooled client, creating it lazily if startup has not run."""
+        client = self.clients.get(provider)
+        if client is None or client.is_closed:
+            client = self._create_client(provider)
+            self.clients[provider] = client
+        return client
+
+    def get_stats(self) -> Dict:
+        stats = {}
+        for provider, client in self.clients.items():
+            # httpx does not expose pool stats publicly, read them from httpcore
+            pool = getattr(getattr(client, "_transport", None), "_pool", None)
+            connections = list(getattr(pool, "connections", []) or [])
+            requests = list(getattr(pool, "_requests", []) or [])
+            idle = sum(1 for c in connections if c.is_idle())
+            stats[provider] = {
+                "in_use": len(connections) - idle,
+                "idle": idle,
+                "waiting": sum(1 for r in requests if getattr(r, "connection", None) is None),
+                "http2": HTTP2_AVAILABLE and PROVIDERS[provider].get("http2", False),
+            }
+        return {
+            "providers": stats,
+            "config": {
+                "max_connections": POOL_MAX_CONNECTIONS,
+                "max_keepalive": POOL_MAX_KEEPALIVE,
+                "keepalive_expiry_sec": POOL_KEEPALIVE_EXPIRY,
+            }
+        }
+
+provider_pools = ProviderPools()
 
 # =============================================================================
 # COST ESTIMATES (USD per 1M tokens)
@@ -128,11 +377,152 @@ MODEL_COSTS = {
     "ollama/qwen2.5": {"input": 0, "output": 0},
 }
 
+# =============================================================================
+# MODEL METADATA (context window, max output tokens, output tokens/s)
+# =============================================================================
+
+MODEL_METADATA = {
+    # OpenRouter models
+    "openrouter/moonshotai/kimi-k2.5": {"context_window": 262144, "max_output": 32768, "tokens_per_sec": 40},
+    "openrouter/z-ai/glm-5": {"context_window": 200000, "max_output": 32768, "tokens_per_sec": 50},
+    "openrouter/qwen/qwen3-1.7b": {"context_window": 32768, "max_output": 8192, "tokens_per_sec": 150},
+    "openrouter/qwen/qwen3-1.7b:free": {"context_window": 32768, "max_output": 8192, "tokens_per_sec": 100},
+    # OpenAI models
+    "openai/gpt-4o": {"context_window": 128000, "max_output": 16384, "tokens_per_sec": 80},
+    "openai/gpt-4o-mini": {"context_window": 128000, "max_output": 16384, "tokens_per_sec": 100},
+    "openai/gpt-4-turbo": {"context_window": 128000, "max_output": 4096, "tokens_per_sec": 30},
+    # Anthropic models
+    "anthropic/claude-3-opus": {"context_window": 200000, "max_output": 4096, "tokens_per_sec": 25},
+    "anthropic/claude-3-sonnet": {"context_window": 200000, "max_output": 4096, "tokens_per_sec": 60},
+    "anthropic/claude-3-haiku": {"context_window": 200000, "max_output": 4096, "tokens_per_sec": 120},
+    # Google models
+    "google/gemini-1.5-pro": {"context_window": 2097152, "max_output": 8192, "tokens_per_sec": 60},
+    "google/gemini-1.5-flash": {"context_window": 1048576, "max_output": 8192, "tokens_per_sec": 150},
+    # Ollama: the server's default num_ctx, not the model's maximum
+    "ollama/llama3.1": {"context_window": 4096, "max_output": 4096, "tokens_per_sec": 30},
+    "ollama/qwen2.5": {"context_window": 4096, "max_output": 4096, "tokens_per_sec": 30},
+}
+
+# =============================================================================
+# KEYWORD MATCHING
+# =============================================================================
+
+WORD_TOKEN_RE = re.compile(r"\w+")
+
+def build_trie_pattern(words: List[str]) -> str:
+    """Regex alternation factored into a trie, so shared prefixes are tested once"""
+    trie: Dict[str, Dict] = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+    
+    def build(node: Dict) -> str:
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            pattern = "(?:" + pattern + ")?"
+        return pattern
+    
+    return build(trie)
+
+class KeywordMatcher:
+    """Keyword classifier compiled once per config.
+    
+    Categories are given in priority order (custom categories first, then
+    declaration order). Keywords made of word characters only are matched against
+    the set of distinct tokens of the message with a single trie regex (or a set
+    lookup with word boundaries), so cost no longer grows with keywords x message
+    length. Phrase keywords ("def ", "thank you") are checked against the full text.
+    
+    scoring="priority" keeps the historical semantics: the first category in
+    priority order with any matching keyword wins. scoring="weighted" sums the
+    weights of distinct matched keywords per category, ties broken by priority.
+    """
+    
+    def __init__(self, categories: List[Tuple[str, List[str]]], word_boundaries: bool = False,
+                 scoring: str = "priority", weights: Optional[Dict[str, float]] = None):
+        self.word_boundaries = word_boundaries
+        self.scoring = scoring
+        self.weights = {k.lower(): float(v) for k, v in (weights or {}).items()}
+        self.category_names: List[str] = []
+        # keyword -> list of category ranks it belongs to
+        self.keyword_ranks: Dict[str, List[int]] = {}
+        rank_of: Dict[str, int] = {}
+        for name, keywords in categories:
+            if name not in rank_of:
+                rank_of[name] = len(self.category_names)
+                self.category_names.append(name)
+            for keyword in keywords:
+                keyword = keyword.lower()
+                if word_boundaries:
+                    keyword = keyword.strip()
+                if not keyword:
+                    continue
+                ranks = self.keyword_ranks.setdefault(keyword, [])
+                if rank_of[name] not in ranks:
+                    ranks.append(rank_of[name])
+        
+        self.best_rank = {k: min(ranks) for k, ranks in self.keyword_ranks.items()}
+        word_keywords = [k for k in self.keyword_ranks if WORD_TOKEN_RE.fullmatch(k)]
+        self.word_keywords = set(word_keywords)
+        # Phrases sorted by rank so the priority scan can stop at the first hit
+        self.phrases = sorted((k for k in self.keyword_ranks if k not in self.word_keywords),
+                              key=lambda k: self.best_rank[k])
+        self.phrase_patterns = {k: re.compile(r"(?<!\w)" + re.escape(k) + r"(?!\w)") for k in self.phrases} if word_boundaries else {}
+        self.word_pattern = re.compile("(?=(" + build_trie_pattern(word_keywords) + "))") if word_keywords and not word_boundaries else None
+        # The trie regex reports the longest keyword at each position: expand it to
+        # the keywords that are prefixes of it, which start at the same position
+        self.prefixes: Dict[str, List[str]] = {
+            k: [k[:i] for i in range(1, len(k) + 1) if k[:i] in self.word_keywords] for k in word_keywords
+        }
+    
+    def _word_matches(self, message_lower: str) -> set:
+        tokens = set(WORD_TOKEN_RE.findall(message_lower))
+        if self.word_boundaries:
+            return tokens & self.word_keywords
+        if self.word_pattern is None:
+            return set()
+        return {k for m in self.word_pattern.finditer(" ".join(tokens)) for k in self.prefixes[m.group(1)]}
+    
+    def _phrase_found(self, phrase: str, message_lower: str) -> bool:
+        if self.word_boundaries:
+            return self.phrase_patterns[phrase].search(message_lower) is not None
+        return phrase in message_lower
+    
+    def match(self, message: str) -> Optional[str]:
+        """Return the matching category name, or None"""
+        message_lower = message.lower()
+        matched = self._word_matches(message_lower)
+        
+        if self.scoring == "weighted":
+            matched |= {p for p in self.phrases if self._phrase_found(p, message_lower)}
+            scores: Dict[int, float] = defaultdict(float)
+            for keyword in matched:
+                for rank in self.keyword_ranks[keyword]:
+                    scores[rank] += self.weights.get(keyword, 1.0)
+            if not scores:
+                return None
+            return self.category_names[min(scores, key=lambda r: (-scores[r], r))]
+        
+        best_rank = min((self.best_rank[k] for k in matched), default=None)
+        for phrase in self.phrases:
+            if best_rank is not None and self.best_rank[phrase] >= best_rank:
+                break
+            if self._phrase_found(phrase, message_lower):
+                best_rank = self.best_rank[phrase]
+                break
+        return self.category_names[best_rank] if best_rank is not None else None
+
 # =============================================================================
 # USER CONFIG
 # =============================================================================
 
 CONFIG_FILE = os.getenv("ROUTER_CONFIG_FILE", "router_config.json")
+CONFIG_WATCH_SEC = float(os.getenv("CONFIG_WATCH_SEC", "2"))  # Config file poll interval (0 = no watcher)
 
 DEFAULT_MODEL_MAPPINGS = {
     "tools": [
@@ -163,40 +553,336 @@ DEFAULT_KEYWORDS = {
     "conversation": ["hello", "hi", "hey", "thanks", "thank you", "please", "sorry", "yes", "no", "ok", "okay", "sure"]
 }
 
-model_mappings: Dict[str, List[str]] = {}
-category_keywords: Dict[str, List[str]] = {}
-custom_categories: Dict[str, Dict] = {}
+# Config file sections read by the subsystems as plain dicts: {**DEFAULTS, **section}
+hedging_config: Dict[str, Dict] = {}
+adaptive_config: Dict[str, Any] = {}
+circuit_breaker_config: Dict[str, Any] = {}
+rate_limit_config: Dict[str, Any] = {}
+token_routing_config: Dict[str, Any] = {}
+semantic_config: Dict[str, Any] = {}
+batch_config: Dict[str, Any] = {}
+prompt_cache_config: Dict[str, Any] = {}
+session_affinity_config: Dict[str, Any] = {}
+health_check_config: Dict[str, Any] = {}
+
+def freeze(value: Any) -> Any:
+    """Read-only copy of a JSON value: dicts become mapping proxies, lists tuples"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+def thaw(value: Any) -> Any:
+    """Plain JSON copy of a frozen value, for output or editing"""
+    if isinstance(value, Mapping):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+def config_hash(value: Any) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()[:16]
+
+class RoutingSnapshot:
+    """Compiled, read-only routing table: chains, keyword matcher, costs and metadata.
+    
+    Built off the event loop from a config dict and swapped in whole by ConfigStore.
+    A request takes the current snapshot once, so it reads one consistent table
+    even if the config changes while it runs, and nothing needs a lock.
+    """
+    
+    def __init__(self, config: Dict, version: int, source: Optional[Tuple[int, int]] = None):
+        self.version = version
+        self.source = source  # (mtime_ns, size) of the file it was read from or written to
+        self.built_at = time.time()
+        self.config = freeze(config)
+        mappings = {**DEFAULT_MODEL_MAPPINGS, **config.get("model_mappings", {})}
+        self.model_mappings = freeze(mappings)
+        self.category_keywords = freeze({**DEFAULT_KEYWORDS, **config.get("keywords", {})})
+        self.custom_categories = freeze(config.get("custom_categories", {}))
+        matching = config.get("keyword_matching", {})
+        categories = [(name, cfg.get("keywords", [])) for name, cfg in self.custom_categories.items()]
+        self.keyword_matcher = KeywordMatcher(
+            categories + list(self.category_keywords.items()),
+            word_boundaries=matching.get("word_boundaries", False),
+            scoring=matching.get("scoring", "priority"),
+            weights=matching.get("weights"),
+        )
+        self.fingerprint = config_hash(mappings)
+        self.semantic_fingerprint = config_hash([sorted(mappings), config.get("semantic", {}).get("utterances", {})])
+        self.model_costs = freeze({**MODEL_COSTS, **config.get("model_costs", {})})
+        overrides = config.get("token_routing", {}).get("models", {})
+        self.model_metadata = freeze({m: {**MODEL_METADATA.get(m, {}), **overrides.get(m, {})}
+                                      for m in MODEL_METADATA.keys() | overrides.keys()})
+    
+    def chain(self, category: str) -> List[str]:
+        """Fallback chain of a category (a fresh list the caller may reorder)"""
+        return list(self.model_mappings.get(category, self.model_mappings.get(
+            "conversation", (f"{DEFAULT_PROVIDER}/{DEFAULT_MODEL}",))))
+
+# Current snapshot and the names the routing code reads, all rebound together by ConfigStore.install
+routing_table: RoutingSnapshot = None
+model_mappings: Mapping[str, Tuple[str, ...]] = MappingProxyType({})
+category_keywords: Mapping[str, Tuple[str, ...]] = MappingProxyType({})
+custom_categories: Mapping[str, Mapping] = MappingProxyType({})
+keyword_matcher: KeywordMatcher = KeywordMatcher([])
+routing_config_fingerprint = ""
+semantic_fingerprint = ""
+
+def read_config_file() -> Tuple[Dict, Optional[Tuple[int, int]]]:
+    """(config, (mtime_ns, size)) of CONFIG_FILE; empty config if there is none. Raises if invalid"""
+    try:
+        stat = os.stat(CONFIG_FILE)
+    except FileNotFoundError:
+        return {}, None
+    with open(CONFIG_FILE, "r") as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError("top level must be a JSON object")
+    return config, (stat.st_mtime_ns, stat.st_size)
+
+def write_config_file(config: Dict) -> Tuple[int, int]:
+    """Write through a temp file and a rename, so readers never see half a file"""
+    data = json.dumps(config, indent=2)
+    tmp_path = f"{CONFIG_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, CONFIG_FILE)
+    except OSError:
+        # A bind-mounted single file cannot be replaced: write it in place
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        with open(CONFIG_FILE, "w") as f:
+            f.write(data)
+    stat = os.stat(CONFIG_FILE)
+    return stat.st_mtime_ns, stat.st_size
 
-def load_config():
-    global model_mappings, category_keywords, custom_categories
-    model_mappings = DEFAULT_MODEL_MAPPINGS.copy()
-    category_keywords = DEFAULT_KEYWORDS.copy()
-    custom_categories = {}
+class ConfigStore:
+    """Owns the routing snapshot: loads, edits, persists and watches router_config.json.
     
-    if os.path.exists(CONFIG_FILE):
+    Parsing, compiling and writing run in a thread; install() then rebinds the
+    globals with plain assignments, so coroutines on the loop see the old table or
+    the new one, never a mix. Edits are serialized and start from the current
+    snapshot's config. An invalid file keeps the current table.
+    """
+    
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.failed_source: Optional[Tuple[int, int]] = None
+        self.stats = {"installs": 0, "reloads": 0, "updates": 0, "errors": 0, "last_error": None}
+    
+    def install(self, snapshot: RoutingSnapshot) -> RoutingSnapshot:
+        global routing_table, model_mappings, category_keywords, custom_categories, keyword_matcher
+        global routing_config_fingerprint, semantic_fingerprint
+        global hedging_config, adaptive_config, circuit_breaker_config, rate_limit_config, token_routing_config
+        global semantic_config, batch_config, prompt_cache_config, session_affinity_config, health_check_config
+        sections = thaw(snapshot.config)
+        hedging_config = sections.get("hedging", {})
+        adaptive_config = sections.get("adaptive", {})
+        circuit_breaker_config = sections.get("circuit_breaker", {})
+        rate_limit_config = sections.get("rate_limits", {})
+        token_routing_config = sections.get("token_routing", {})
+        semantic_config = sections.get("semantic", {})
+        batch_config = sections.get("batch", {})
+        prompt_cache_config = sections.get("prompt_cache", {})
+        session_affinity_config = sections.get("session_affinity", {})
+        health_check_config = sections.get("health_checks", {})
+        model_mappings = snapshot.model_mappings
+        category_keywords = snapshot.category_keywords
+        custom_categories = snapshot.custom_categories
+        keyword_matcher = snapshot.keyword_matcher
+        routing_config_fingerprint = snapshot.fingerprint
+        semantic_fingerprint = snapshot.semantic_fingerprint
+        routing_table = snapshot
+        self.stats["installs"] += 1
+        return snapshot
+    
+    def next_version(self) -> int:
+        return routing_table.version + 1 if routing_table else 1
+    
+    def apply(self, config: Dict) -> RoutingSnapshot:
+        """Compile and install a config without persisting it (startup, benchmarks)"""
+        return self.install(RoutingSnapshot(config, self.next_version()))
+    
+    def load(self) -> RoutingSnapshot:
+        """Startup load: an unreadable file falls back to the defaults"""
         try:
-            with open(CONFIG_FILE, "r") as f:
-                config = json.load(f)
-                if "model_mappings" in config:
-                    model_mappings.update(config["model_mappings"])
-                if "keywords" in config:
-                    category_keywords.update(config["keywords"])
-                if "custom_categories" in config:
-                    custom_categories = config["custom_categories"]
-            print(f"Config loaded from {CONFIG_FILE}")
+            config, source = read_config_file()
+            if source:
+                print(f"Config loaded from {CONFIG_FILE}")
         except Exception as e:
             print(f"Error loading config: {e}")
+            config, source = {}, None
+        return self.install(RoutingSnapshot(config, self.next_version(), source))
+    
+    async def reload(self) -> RoutingSnapshot:
+        """Re-read the file; raises (keeping the current table) if it is invalid"""
+        async with self.lock:
+            config, source = await asyncio.to_thread(read_config_file)
+            snapshot = await asyncio.to_thread(RoutingSnapshot, config, self.next_version(), source)
+            self.stats["reloads"] += 1
+            return self.install(snapshot)
+    
+    async def update(self, edit: Callable[[Dict], None]) -> RoutingSnapshot:
+        """Apply edit() to a copy of the current config, then compile, persist and install it"""
+        async with self.lock:
+            config = thaw(routing_table.config)
+            edit(config)
+            snapshot = await asyncio.to_thread(self.compile_and_save, config)
+            self.stats["updates"] += 1
+            return self.install(snapshot)
+    
+    def compile_and_save(self, config: Dict) -> RoutingSnapshot:
+        snapshot = RoutingSnapshot(config, self.next_version())
+        snapshot.source = write_config_file(config)
+        return snapshot
+    
+    async def watch(self):
+        """Reload when router_config.json changes on disk (edits, deploys, other workers)"""
+        while True:
+            await asyncio.sleep(CONFIG_WATCH_SEC)
+            try:
+                stat = await asyncio.to_thread(os.stat, CONFIG_FILE)
+            except FileNotFoundError:
+                continue
+            source = (stat.st_mtime_ns, stat.st_size)
+            if source == routing_table.source or source == self.failed_source:
+                continue
+            try:
+                snapshot = await self.reload()
+                print(f"Config file changed: routing table v{snapshot.version} installed")
+            except Exception as e:
+                # Often a file caught mid-write: retried when it changes again
+                self.failed_source = source
+                self.stats["errors"] += 1
+                self.stats["last_error"] = str(e)[:200]
+                print(f"Config file changed but could not be loaded, keeping v{routing_table.version}: {e}")
+    
+    def get_stats(self) -> Dict:
+        return {
+            "version": routing_table.version,
+            "built_at": datetime.fromtimestamp(routing_table.built_at).isoformat(),
+            "fingerprint": routing_table.fingerprint,
+            "watch_sec": CONFIG_WATCH_SEC,
+            **self.stats
+        }
 
-def save_config():
-    config = {
-        "model_mappings": model_mappings,
-        "keywords": category_keywords,
-        "custom_categories": custom_categories
-    }
-    with open(CONFIG_FILE, "w") as f:
-        json.dump(config, f, indent=2)
+config_store = ConfigStore()
+config_store.load()
 
-load_config()
+# =============================================================================
+# BACKGROUND PERSISTENCE
+# =============================================================================
+
+STATE_FLUSH_DELAY_SEC = float(os.getenv("STATE_FLUSH_DELAY_SEC", "1.0"))
+STATE_FLUSH_MAX_DELAY_SEC = float(os.getenv("STATE_FLUSH_MAX_DELAY_SEC", "5.0"))
+
+def atomic_write_json(path: str, data: Any, indent: Optional[int] = 2):
+    """Write JSON to a temp file in the same directory, fsync, then rename over the target"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def load_json_file(path: str) -> Optional[Any]:
+    """Load a JSON state file, ignoring leftovers from an interrupted write"""
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error loading {path}: {e}")
+        return None
+
+class StatePersister:
+    """Debounced background writer.
+    
+    Callers mark the state dirty; a daemon thread waits until changes settle
+    (bounded by max_delay_sec), takes a snapshot and writes it atomically.
+    Nothing is written when the snapshot is identical to the last one on disk.
+    """
+    
+    def __init__(self, path: str, snapshot: Callable[[], Dict],
+                 delay_sec: float = STATE_FLUSH_DELAY_SEC, max_delay_sec: float = STATE_FLUSH_MAX_DELAY_SEC):
+        self.path = path
+        self.snapshot = snapshot
+        self.delay_sec = delay_sec
+        self.max_delay_sec = max_delay_sec
+        self.flushes = 0
+        self._last_written: Optional[str] = None
+        self._dirty = threading.Event()
+        self._stop = threading.Event()
+        self._write_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+    
+    def mark_dirty(self):
+        self._dirty.set()
+        if self._thread is None or not self._thread.is_alive():
+            self._start()
+    
+    def _start(self):
+        with self._write_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=f"persist-{os.path.basename(self.path)}", daemon=True)
+            self._thread.start()
+    
+    def _run(self):
+        while not self._stop.is_set():
+            self._dirty.wait()
+            if self._stop.is_set():
+                break
+            first_change = time.monotonic()
+            while True:
+                self._dirty.clear()
+                if self._stop.wait(self.delay_sec):
+                    break
+                if not self._dirty.is_set() or time.monotonic() - first_change >= self.max_delay_sec:
+                    break
+            self.flush()
+    
+    def flush(self) -> bool:
+        """Write the current snapshot if it changed. Returns True if a write happened."""
+        with self._write_lock:
+            try:
+                state = self.snapshot()
+                serialized = json.dumps(state, sort_keys=True)
+                if serialized == self._last_written:
+                    return False
+                atomic_write_json(self.path, dict(state, updated_at=datetime.utcnow().isoformat()))
+                self._last_written = serialized
+                self.flushes += 1
+                return True
+            except Exception as e:
+                print(f"Error saving {self.path}: {e}")
+                return False
+    
+    def mark_clean(self, state: Dict):
+        """Record a state just loaded from disk so it is not rewritten unchanged"""
+        self._last_written = json.dumps(state, sort_keys=True)
+    
+    def stop(self):
+        """Stop the writer thread and flush any pending change synchronously"""
+        self._stop.set()
+        self._dirty.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=5.0)
+        self._thread = None
+        self._dirty.clear()
+        self.flush()
 
 # =============================================================================
 # CIRCUIT BREAKER WITH PERSISTENCE
@@ -204,83 +890,615 @@ load_config()
 
 CIRCUIT_BREAKER_FILE = os.path.join(os.path.dirname(__file__), "circuit_breaker_state.json")
 
+CIRCUIT_BREAKER_DEFAULTS = {
+    "failure_threshold": 3,            # Consecutive failures that open the circuit
+    "recovery_timeout_sec": 300,       # Open period after the first trip
+    "backoff_multiplier": 2.0,         # Open period growth on each consecutive trip
+    "max_recovery_timeout_sec": 3600,
+    "half_open_max_calls": 1,          # Trial calls allowed at once while half-open
+    "half_open_successes": 1,          # Successful trials needed to close the circuit
+    "probe_timeout_sec": 60,           # A trial with no outcome after this frees its slot
+    "window_sec": 60,                  # Sliding window for rate-based trips
+    "min_calls": 20,                   # Calls in the window before rates are evaluated
+    "error_rate_threshold": 0.0,       # Trip when the failure share reaches this (0 = off)
+    "slow_call_ms": 0,                 # Calls slower than this count as slow (0 = off)
+    "slow_call_rate_threshold": 0.5,   # Trip when the slow share reaches this
+}
+
+def new_breaker_op() -> Dict:
+    return {"reset": False, "failures": 0, "last_failure": 0.0, "state": None, "state_at": 0.0, "trips": 0}
+
+def merge_breaker_op(previous: Dict, op: Dict):
+    """Fold a newer queued change into an older one, in place"""
+    if op["reset"]:
+        previous["reset"] = True
+        previous["failures"] = op["failures"]
+    else:
+        previous["failures"] += op["failures"]
+    previous["last_failure"] = max(previous["last_failure"], op["last_failure"])
+    if op["state"] and op["state_at"] >= previous["state_at"]:
+        previous["state"] = op["state"]
+        previous["state_at"] = op["state_at"]
+        previous["trips"] = op["trips"]
+
 class CircuitBreaker:
-    def __init__(self, failure_threshold: int = 3, recovery_timeout_sec: int = 300):
-        self.failure_threshold = failure_threshold
-        self.recovery_timeout = recovery_timeout_sec
+    """Per-model closed / open / half-open state machine.
+    
+    closed: calls flow; consecutive failures, or the error or slow-call share over
+    the sliding window, trip the circuit. open: calls are refused for the recovery
+    timeout, multiplied by backoff_multiplier on every consecutive trip. half-open:
+    at most half_open_max_calls trial calls at once; enough successes close the
+    circuit, a failure opens it again for longer.
+    """
+    
+    def __init__(self):
         self.failures: Dict[str, int] = defaultdict(int)
         self.last_failure: Dict[str, float] = {}
-        self.open_circuits: Dict[str, bool] = {}
+        self.states: Dict[str, str] = {}          # "open" | "half_open"; missing = closed
+        self.opened_at: Dict[str, float] = {}
+        self.trips: Dict[str, int] = {}           # Consecutive trips, drives the backoff
+        self.transition_at: Dict[str, float] = {}
+        self.probes: Dict[str, Dict] = {}         # model -> {"inflight", "successes", "started"}
+        self.windows: Dict[str, Dict] = {}        # model -> {"calls": deque, "errors", "slow"}
+        self.trip_reasons: Dict[str, int] = defaultdict(int)
+        self.rejected = 0
+        self.probed: frozenset = frozenset()     # Models whose trials are left to the health checks
         self.lock = threading.Lock()
+        self.persister = StatePersister(CIRCUIT_BREAKER_FILE, self._snapshot)
+        # With a shared-state backend, changes are queued here instead of written to file
+        self.shared = False
+        self.pending: Dict[str, Dict] = {}
         self._load_state()
     
+    def config(self) -> Dict:
+        return {**CIRCUIT_BREAKER_DEFAULTS, **circuit_breaker_config}
+    
     def _load_state(self):
-        if os.path.exists(CIRCUIT_BREAKER_FILE):
+        state = load_json_file(CIRCUIT_BREAKER_FILE)
+        if state is not None:
             try:
-                with open(CIRCUIT_BREAKER_FILE, "r") as f:
-                    state = json.load(f)
                 self.failures = defaultdict(int, state.get("failures", {}))
                 self.last_failure = {k: float(v) for k, v in state.get("last_failure", {}).items()}
-                self.open_circuits = state.get("open_circuits", {})
+                self.states = dict(state.get("states", {}))
+                self.opened_at = {k: float(v) for k, v in state.get("opened_at", {}).items()}
+                self.trips = dict(state.get("trips", {}))
+                # Files written before the half-open state only had open flags
+                for model, is_open in state.get("open_circuits", {}).items():
+                    if is_open and model not in self.states:
+                        self.states[model] = "open"
+                        self.opened_at[model] = self.last_failure.get(model, time.time())
+                        self.trips[model] = 1
                 print(f"Circuit breaker state loaded")
             except Exception as e:
                 print(f"Error loading circuit breaker: {e}")
+        self.persister.mark_clean(self._snapshot())
     
-    def _save_state(self):
-        try:
-            state = {
-                "failures": dict(self.failures),
-                "last_failure": self.last_failure,
-                "open_circuits": self.open_circuits,
-                "updated_at": datetime.utcnow().isoformat()
+    def _snapshot(self) -> Dict:
+        with self.lock:
+            return {
+                "failures": {k: v for k, v in self.failures.items() if v},
+                "last_failure": dict(self.last_failure),
+                "states": dict(self.states),
+                "opened_at": dict(self.opened_at),
+                "trips": dict(self.trips),
             }
-            with open(CIRCUIT_BREAKER_FILE, "w") as f:
-                json.dump(state, f, indent=2)
-        except Exception as e:
-            print(f"Error saving circuit breaker: {e}")
+    
+    def _changed(self):
+        if not self.shared:
+            self.persister.mark_dirty()
+    
+    def _queue(self, model: str) -> Dict:
+        return self.pending.setdefault(model, new_breaker_op())
+    
+    def open_timeout(self, model: str, cfg: Dict) -> float:
+        trips = max(self.trips.get(model, 1), 1)
+        timeout = cfg["recovery_timeout_sec"] * cfg["backoff_multiplier"] ** (trips - 1)
+        return min(timeout, cfg["max_recovery_timeout_sec"])
+    
+    def _trip(self, model: str, now: float, reason: str):
+        self.states[model] = "open"
+        self.opened_at[model] = now
+        self.trips[model] = self.trips.get(model, 0) + 1
+        self.transition_at[model] = now
+        self.probes.pop(model, None)
+        self.windows.pop(model, None)
+        self.trip_reasons[reason] += 1
+        print(f"Circuit OPEN for {model} ({reason}, trip {self.trips[model]})")
+        if self.shared:
+            op = self._queue(model)
+            op.update(state="open", state_at=now, trips=self.trips[model])
+    
+    def _close(self, model: str, now: float):
+        self.states.pop(model, None)
+        self.opened_at.pop(model, None)
+        self.trips.pop(model, None)
+        self.probes.pop(model, None)
+        self.failures[model] = 0
+        self.transition_at[model] = now
+        if self.shared:
+            op = self._queue(model)
+            op.update(reset=True, failures=0, state="closed", state_at=now, trips=0)
+    
+    def _watch(self, model: str, now: float, success: bool, latency_ms: Optional[float], cfg: Dict) -> Optional[str]:
+        """Add a call to the sliding window; returns a trip reason when a rate is exceeded"""
+        if not cfg["error_rate_threshold"] and not cfg["slow_call_ms"]:
+            return None
+        window = self.windows.setdefault(model, {"calls": deque(), "errors": 0, "slow": 0})
+        slow = bool(cfg["slow_call_ms"]) and latency_ms is not None and latency_ms >= cfg["slow_call_ms"]
+        calls = window["calls"]
+        calls.append((now, success, slow))
+        window["errors"] += not success
+        window["slow"] += slow
+        while calls and calls[0][0] < now - cfg["window_sec"]:
+            _, old_success, old_slow = calls.popleft()
+            window["errors"] -= not old_success
+            window["slow"] -= old_slow
+        if len(calls) < cfg["min_calls"]:
+            return None
+        if cfg["error_rate_threshold"] and window["errors"] / len(calls) >= cfg["error_rate_threshold"]:
+            return "error_rate"
+        if cfg["slow_call_ms"] and window["slow"] / len(calls) >= cfg["slow_call_rate_threshold"]:
+            return "slow_calls"
+        return None
     
     def record_failure(self, model: str):
         with self.lock:
+            now = time.time()
+            cfg = self.config()
             self.failures[model] += 1
-            self.last_failure[model] = time.time()
-            if self.failures[model] >= self.failure_threshold:
-                self.open_circuits[model] = True
-                print(f"Circuit OPEN for {model}")
-            self._save_state()
+            self.last_failure[model] = now
+            if self.shared:
+                op = self._queue(model)
+                op["failures"] += 1
+                op["last_failure"] = now
+            state = self.states.get(model)
+            if state == "half_open":
+                self._trip(model, now, "probe_failed")
+            elif state is None:
+                if self.failures[model] >= cfg["failure_threshold"]:
+                    self._trip(model, now, "consecutive_failures")
+                else:
+                    reason = self._watch(model, now, False, None, cfg)
+                    if reason:
+                        self._trip(model, now, reason)
+        self._changed()
     
-    def record_success(self, model: str):
+    def record_success(self, model: str, latency_ms: Optional[float] = None):
         with self.lock:
-            self.failures[model] = 0
-            self.open_circuits[model] = False
-            self._save_state()
+            now = time.time()
+            cfg = self.config()
+            state = self.states.get(model)
+            if state == "open":
+                return  # Late answer to a call started before the trip
+            if state == "half_open":
+                probe = self.probes.setdefault(model, {"inflight": 0, "successes": 0, "started": 0.0})
+                probe["inflight"] = max(0, probe["inflight"] - 1)
+                probe["successes"] += 1
+                if probe["successes"] < cfg["half_open_successes"]:
+                    return
+                self._close(model, now)
+                print(f"Circuit CLOSED for {model}")
+            else:
+                reason = self._watch(model, now, True, latency_ms, cfg)
+                if reason:
+                    self._trip(model, now, reason)
+                elif not self.failures.get(model):
+                    return
+                else:
+                    self.failures[model] = 0
+                    if self.shared:
+                        op = self._queue(model)
+                        op["reset"] = True
+                        op["failures"] = 0
+        self._changed()
     
-    def is_available(self, model: str) -> bool:
+    def is_available(self, model: str, probe: bool = False) -> bool:
+        """True if a call may go to the model now. In half-open, this takes a trial slot.
+        
+        Trials of models in self.probed are only given to health probes (probe=True),
+        so no user request is spent finding out whether the model is back.
+        """
         with self.lock:
-            if model not in self.open_circuits or not self.open_circuits[model]:
+            state = self.states.get(model)
+            if state is None:
                 return True
-            if model in self.last_failure:
-                elapsed = time.time() - self.last_failure[model]
-                if elapsed > self.recovery_timeout:
-                    return True
-            return False
+            if model in self.probed and not probe:
+                self.rejected += 1
+                return False
+            now = time.time()
+            cfg = self.config()
+            if state == "open":
+                if now - self.opened_at.get(model, 0.0) < self.open_timeout(model, cfg):
+                    self.rejected += 1
+                    return False
+                self.states[model] = "half_open"
+                self.probes[model] = {"inflight": 0, "successes": 0, "started": 0.0}
+            trial = self.probes.setdefault(model, {"inflight": 0, "successes": 0, "started": 0.0})
+            if trial["inflight"] >= cfg["half_open_max_calls"]:
+                if now - trial["started"] < cfg["probe_timeout_sec"]:
+                    self.rejected += 1
+                    return False
+                trial["inflight"] = 0  # Trials that never reported back
+            trial["inflight"] += 1
+            trial["started"] = now
+            return True
+    
+    def release(self, model: str):
+        """Give back a half-open trial slot whose call was cancelled"""
+        with self.lock:
+            probe = self.probes.get(model)
+            if probe and self.states.get(model) == "half_open":
+                probe["inflight"] = max(0, probe["inflight"] - 1)
+    
+    def state(self, model: str) -> str:
+        return self.states.get(model, "closed")
     
     def get_status(self) -> Dict:
         with self.lock:
+            cfg = self.config()
+            now = time.time()
             return {
                 "failures": dict(self.failures),
-                "open_circuits": {k: v for k, v in self.open_circuits.items() if v},
+                "open_circuits": {k: True for k, v in self.states.items() if v == "open"},
+                "half_open": {k: self.probes.get(k, {}).get("inflight", 0) for k, v in self.states.items() if v == "half_open"},
+                "retry_in_sec": {
+                    k: round(max(0.0, self.opened_at.get(k, 0.0) + self.open_timeout(k, cfg) - now), 1)
+                    for k, v in self.states.items() if v == "open"
+                },
+                "trips": dict(self.trips),
+                "trip_reasons": dict(self.trip_reasons),
+                "rejected": self.rejected,
                 "last_failure": {k: datetime.fromtimestamp(v).isoformat() for k, v in self.last_failure.items()},
-                "config": {"failure_threshold": self.failure_threshold, "recovery_timeout_sec": self.recovery_timeout}
+                "config": cfg,
+                "persistence": {"flushes": self.persister.flushes, "flush_delay_sec": self.persister.delay_sec}
             }
     
+    def reset(self, model: str):
+        with self.lock:
+            self._close(model, time.time())
+        self._changed()
+    
     def reset_all(self):
         with self.lock:
+            now = time.time()
             self.failures.clear()
             self.last_failure.clear()
-            self.open_circuits.clear()
-            self._save_state()
+            self.states.clear()
+            self.opened_at.clear()
+            self.trips.clear()
+            self.probes.clear()
+            self.windows.clear()
+            for model in self.transition_at:
+                self.transition_at[model] = now
+            if self.shared:
+                op = new_breaker_op()
+                op.update(reset=True, state="closed", state_at=now)
+                self.pending = {"*": op}
+        self._changed()
+    
+    def take_pending(self) -> Dict[str, Dict]:
+        """Hand the queued changes to the shared-state sync"""
+        with self.lock:
+            ops, self.pending = self.pending, {}
+            return ops
+    
+    def restore_pending(self, ops: Dict[str, Dict]):
+        """Put back changes whose sync failed, under any newer ones"""
+        with self.lock:
+            newer, self.pending = self.pending, dict(ops)
+            if "*" in newer:
+                self.pending = {}
+            for model, op in newer.items():
+                if model in self.pending:
+                    merge_breaker_op(self.pending[model], op)
+                else:
+                    self.pending[model] = op
+    
+    def apply_shared(self, breakers: Dict[str, Dict]):
+        """Adopt the shared breaker table, replaying changes not pushed yet.
+        
+        Failure counts come from the table; a state change made by another worker
+        (trip, close, reset) is adopted when it is newer than the last local one.
+        The sliding windows and half-open trials stay per worker.
+        """
+        with self.lock:
+            reset = breakers.pop("*", None)
+            for model in list(self.failures) + list(self.states):
+                if model not in breakers:
+                    breakers[model] = dict(new_breaker_op(), **({"state": "closed", "state_at": reset["state_at"]} if reset else {}))
+            for model, record in breakers.items():
+                record = dict(new_breaker_op(), **{k: v for k, v in record.items() if v is not None})
+                op = self.pending.get(model)
+                if op:
+                    merged = new_breaker_op()
+                    merged.update(failures=record["failures"], last_failure=record["last_failure"],
+                                  state=record["state"], state_at=record["state_at"], trips=record["trips"])
+                    merge_breaker_op(merged, op)
+                    record = merged
+                self.failures[model] = int(record["failures"])
+                if record["last_failure"]:
+                    self.last_failure[model] = float(record["last_failure"])
+                state_at = float(record["state_at"] or 0.0)
+                if record["state"] and state_at > self.transition_at.get(model, 0.0):
+                    self.transition_at[model] = state_at
+                    if record["state"] == "open":
+                        if self.states.get(model) != "open":
+                            self.states[model] = "open"
+                            self.probes.pop(model, None)
+                        self.opened_at[model] = state_at
+                        self.trips[model] = int(record["trips"] or 1)
+                    else:
+                        self.states.pop(model, None)
+                        self.opened_at.pop(model, None)
+                        self.trips.pop(model, None)
+                        self.probes.pop(model, None)
 
 circuit_breaker = CircuitBreaker()
+atexit.register(circuit_breaker.persister.stop)
+
+# =============================================================================
+# REQUEST EVENT STORE
+# =============================================================================
+
+EVENT_STORE_DB = os.getenv("EVENT_STORE_DB", "request_events.db")  # Empty: in-memory SQLite
+EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", "10000"))   # Events waiting for the writer
+EVENT_FLUSH_SEC = float(os.getenv("EVENT_FLUSH_SEC", "2"))
+EVENT_RETENTION_DAYS = float(os.getenv("EVENT_RETENTION_DAYS", "30"))
+EVENT_ROLLUP_RETENTION_DAYS = float(os.getenv("EVENT_ROLLUP_RETENTION_DAYS", "400"))
+
+EVENT_FIELDS = ("ts", "category", "model", "provider", "user", "routing_mode", "latency_ms", "cost_usd",
+                "success", "cached", "attempts", "error")
+EVENT_GROUPS = ("category", "model", "provider", "user", "routing_mode")
+LATENCY_BUCKET_BASE = math.log(1.25)  # Rollup latency buckets: +25% per bucket from 1 ms
+
+def latency_bucket(latency_ms: float) -> int:
+    return int(math.log(max(latency_ms, 1.0)) / LATENCY_BUCKET_BASE)
+
+def parse_time(value: Optional[str], now: float) -> Optional[float]:
+    """Epoch seconds from an epoch number, an ISO 8601 date or a duration ago ("15m", "2h", "7d")"""
+    if not value:
+        return None
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if value[-1] in units and value[:-1].replace(".", "", 1).isdigit():
+        return now - float(value[:-1]) * units[value[-1]]
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        return (parsed - datetime(1970, 1, 1)).total_seconds()
+    return parsed.timestamp()
+
+class RequestEventStore:
+    """Append-only log of served requests.
+
+    track_request appends a tuple to a bounded in-memory ring (O(1), no lock); a
+    daemon thread drains it every EVENT_FLUSH_SEC into SQLite (WAL), both as raw
+    events and as per-minute rollups keyed by category, model, provider, user,
+    routing mode and latency bucket. Aggregate queries read rollups only, so their
+    cost grows with the window and the number of groups, not with traffic.
+    Several workers can share the database: rollups are upserted additively.
+    """
+
+    def __init__(self, path: str = EVENT_STORE_DB, buffer_size: int = EVENT_BUFFER_SIZE):
+        self.path = path or ":memory:"
+        self.pending: deque = deque(maxlen=buffer_size)
+        self.recent: deque = deque(maxlen=100)
+        self.stats = {"recorded": 0, "dropped": 0, "flushed": 0, "flushes": 0, "errors": 0}
+        self.lock = threading.Lock()
+        self.db: Optional[sqlite3.Connection] = None
+        self.last_prune = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _open(self) -> sqlite3.Connection:
+        if self.db is None:
+            db = sqlite3.connect(self.path, timeout=10.0, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS events (ts REAL NOT NULL, category TEXT, model TEXT, provider TEXT, "
+                "user TEXT, routing_mode TEXT, latency_ms REAL, cost_usd REAL, success INTEGER, cached INTEGER, "
+                "attempts INTEGER, error TEXT)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS events_ts ON events(ts)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS rollups (minute INTEGER NOT NULL, category TEXT NOT NULL, "
+                "model TEXT NOT NULL, provider TEXT NOT NULL, user TEXT NOT NULL, routing_mode TEXT NOT NULL, "
+                "bucket INTEGER NOT NULL, requests INTEGER NOT NULL, failures INTEGER NOT NULL, "
+                "cached INTEGER NOT NULL, fallbacks INTEGER NOT NULL, latency_ms REAL NOT NULL, cost_usd REAL NOT NULL, "
+                "PRIMARY KEY (minute, category, model, provider, user, routing_mode, bucket)) WITHOUT ROWID"
+            )
+            self.db = db
+        return self.db
+
+    def record(self, category: str, model: str, provider: Optional[str], user: Optional[str], routing_mode: str,
+               latency_ms: float, cost_usd: float, success: bool, cached: bool, attempts: Optional[int],
+               error: Optional[str]):
+        event = (time.time(), category, model, provider, user, routing_mode, round(latency_ms, 2),
+                 round(cost_usd, 8), int(success), int(cached), attempts, error[:200] if error else None)
+        if len(self.pending) == self.pending.maxlen:
+            self.stats["dropped"] += 1
+        self.pending.append(event)
+        self.recent.append(event)
+        self.stats["recorded"] += 1
+        if self._thread is None:
+            self._start()
+
+    def _start(self):
+        with self.lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="request-events", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(EVENT_FLUSH_SEC):
+            self.flush()
+
+    def flush(self) -> int:
+        """Write pending events and their rollups. Returns the number of events written."""
+        events = []
+        while True:
+            try:
+                events.append(self.pending.popleft())
+            except IndexError:
+                break
+        with self.lock:
+            try:
+                db = self._open()
+                now = time.time()
+                if events:
+                    rollups: Dict[Tuple, List[float]] = {}
+                    for e in events:
+                        ts, category, model, provider, user, routing_mode, latency_ms, cost_usd, success, cached, attempts, _ = e
+                        # Cache hits get their own bucket: they would hide upstream latency
+                        key = (int(ts // 60), category or "", model or "", provider or "", user or "",
+                               routing_mode or "", -1 if cached else latency_bucket(latency_ms))
+                        row = rollups.get(key)
+                        if row is None:
+                            row = rollups[key] = [0, 0, 0, 0, 0.0, 0.0]
+                        row[0] += 1
+                        row[1] += 1 - success
+                        row[2] += cached
+                        row[3] += 1 if (attempts or 1) > 1 else 0
+                        row[4] += latency_ms
+                        row[5] += cost_usd
+                    db.execute("BEGIN IMMEDIATE")
+                    try:
+                        db.executemany(f"INSERT INTO events ({', '.join(EVENT_FIELDS)}) VALUES "
+                                       f"({', '.join('?' * len(EVENT_FIELDS))})", events)
+                        db.executemany(
+                            "INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                            "ON CONFLICT DO UPDATE SET requests = requests + excluded.requests, "
+                            "failures = failures + excluded.failures, cached = cached + excluded.cached, "
+                            "fallbacks = fallbacks + excluded.fallbacks, latency_ms = latency_ms + excluded.latency_ms, "
+                            "cost_usd = cost_usd + excluded.cost_usd",
+                            [(*key, *row) for key, row in rollups.items()]
+                        )
+                        db.execute("COMMIT")
+                    except Exception:
+                        db.execute("ROLLBACK")
+                        raise
+                    self.stats["flushed"] += len(events)
+                    self.stats["flushes"] += 1
+                if now - self.last_prune > 3600:
+                    self.last_prune = now
+                    db.execute("DELETE FROM events WHERE ts < ?", (now - EVENT_RETENTION_DAYS * 86400,))
+                    db.execute("DELETE FROM rollups WHERE minute < ?", (int((now - EVENT_ROLLUP_RETENTION_DAYS * 86400) // 60),))
+                return len(events)
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Error writing request events: {e}")
+                return 0
+
+    def recent_requests(self, n: int) -> List[Dict]:
+        """Last n events in the /metrics "recent_requests" format"""
+        entries = []
+        for ts, category, model, provider, _, routing_mode, latency_ms, cost_usd, success, cached, _, error in list(self.recent)[-n:]:
+            entry = {
+                "timestamp": datetime.utcfromtimestamp(ts).isoformat() + "Z",
+                "category": category, "model": model, "provider": provider,
+                "latency_ms": latency_ms, "success": bool(success),
+                "routing_mode": routing_mode, "cost_usd": round(cost_usd, 6)
+            }
+            if error:
+                entry["error"] = error
+            if cached:
+                entry["cached"] = True
+            entries.append(entry)
+        return entries
+
+    @staticmethod
+    def _filters(since: float, until: float, filters: Dict[str, str], time_column: str,
+                 scale: float) -> Tuple[str, List]:
+        clauses, params = [f"{time_column} >= ?", f"{time_column} < ?"], [since / scale, until / scale]
+        for name, value in filters.items():
+            clauses.append(f"{name} = ?")
+            params.append(value)
+        return " AND ".join(clauses), params
+
+    def aggregate(self, since: float, until: float, group_by: List[str], filters: Dict[str, str]) -> List[Dict]:
+        """Totals, rates, cost and latency percentiles per group over [since, until), at minute resolution"""
+        self.flush()
+        where, params = self._filters(math.floor(since / 60) * 60, math.ceil(until / 60) * 60, filters, "minute", 60)
+        columns = ", ".join(group_by + ["bucket"])
+        with self.lock:
+            rows = self._open().execute(
+                f"SELECT {columns}, SUM(requests), SUM(failures), SUM(cached), SUM(fallbacks), SUM(latency_ms), "
+                f"SUM(cost_usd) FROM rollups WHERE {where} GROUP BY {columns}", params
+            ).fetchall()
+        groups: Dict[Tuple, Dict] = {}
+        n = len(group_by)
+        for row in rows:
+            key, bucket, (requests, failures, cached, fallbacks, latency_sum, cost) = row[:n], row[n], row[n + 1:]
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = {"requests": 0, "failures": 0, "cached": 0, "fallbacks": 0,
+                                       "latency_sum": 0.0, "cost_usd": 0.0, "buckets": defaultdict(int)}
+            group["requests"] += requests
+            group["failures"] += failures
+            group["cached"] += cached
+            group["fallbacks"] += fallbacks
+            group["cost_usd"] += cost
+            if bucket >= 0:
+                group["latency_sum"] += latency_sum
+                group["buckets"][bucket] += requests
+        results = []
+        for key, group in sorted(groups.items(), key=lambda item: -item[1]["requests"]):
+            buckets = sorted(group["buckets"].items())
+            timed = sum(count for _, count in buckets)
+
+            def percentile(p: float) -> Optional[float]:
+                if not timed:
+                    return None
+                rank, seen = p * timed, 0
+                for bucket, count in buckets:
+                    if seen + count >= rank:
+                        # Interpolated within the bucket, on a log scale
+                        share = (rank - seen) / count
+                        return round(math.exp((bucket + share) * LATENCY_BUCKET_BASE), 1)
+                    seen += count
+                return round(math.exp((buckets[-1][0] + 1) * LATENCY_BUCKET_BASE), 1)
+
+            requests = group["requests"]
+            results.append({
+                **dict(zip(group_by, key)),
+                "requests": requests,
+                "failures": group["failures"],
+                "error_rate": round(group["failures"] / requests, 4),
+                "cached": group["cached"],
+                "fallback_rate": round(group["fallbacks"] / requests, 4),
+                "cost_usd": round(group["cost_usd"], 6),
+                "latency_ms": {"avg": round(group["latency_sum"] / timed, 1) if timed else None,
+                               "p50": percentile(0.5), "p95": percentile(0.95), "p99": percentile(0.99)},
+            })
+        return results
+
+    def events(self, since: float, until: float, filters: Dict[str, str], limit: int) -> List[Dict]:
+        """Raw events, newest first"""
+        self.flush()
+        where, params = self._filters(since, until, filters, "ts", 1)
+        with self.lock:
+            rows = self._open().execute(
+                f"SELECT {', '.join(EVENT_FIELDS)} FROM events WHERE {where} ORDER BY ts DESC LIMIT ?", params + [limit]
+            ).fetchall()
+        return [dict(zip(EVENT_FIELDS, row)) for row in rows]
+
+    def get_stats(self) -> Dict:
+        return {"db": self.path, "pending": len(self.pending), **self.stats}
+
+    def stop(self):
+        """Stop the writer thread and write what is left"""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=5.0)
+        self.flush()
+
+request_events = RequestEventStore()
+atexit.register(request_events.stop)
 
 # =============================================================================
 # METRICS
@@ -288,22 +1506,75 @@ circuit_breaker = CircuitBreaker()
 
 metrics_lock = threading.Lock()
 metrics = {
-    "requests_total": 0, "requests_success": 0, "requests_failed": 0,
+    "requests_total": 0, "requests_success": 0, "requests_failed": 0, "requests_aborted": 0,
     "model_usage": defaultdict(int), "category_usage": defaultdict(int),
     "provider_usage": defaultdict(int), "routing_mode_usage": defaultdict(int),
-    "total_latency_ms": 0, "total_cost_usd": 0.0, "recent_requests": []
+    "total_latency_ms": 0, "total_cost_usd": 0.0,
+    "routing_budget_exceeded": 0,
+    "hedges_fired": 0, "hedges_won": 0, "hedge_extra_cost_usd": 0.0,
+    "cache_hits": 0, "cache_latency_ms": 0.0,
+    "cached_prompt_tokens": 0, "cache_write_tokens": 0, "prompt_cache_saved_usd": 0.0
+}
+
+# Price of prompt tokens read from / written to a provider prompt cache, relative to
+# "input", when the model's costs have no "cached_input" / "cache_write" for the model.
+# Keyed by vendor, so it also applies behind OpenRouter.
+CACHE_PRICE_FACTORS = {
+    "anthropic": {"read": 0.1, "write": 1.25},
+    "google": {"read": 0.25, "write": 1.0},
+    "openai": {"read": 0.5, "write": 1.0},
 }
 
-def estimate_cost(model: str, input_tokens: int, output_tokens: int) -> float:
-    costs = MODEL_COSTS.get(model, {"input": 0.05, "output": 0.15})
-    return (input_tokens / 1_000_000) * costs["input"] + (output_tokens / 1_000_000) * costs["output"]
+def model_vendor(model: str) -> str:
+    parts = model.split("/")
+    return parts[1] if parts[0] == "openrouter" and len(parts) > 2 else parts[0]
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int,
+                  cached_tokens: int = 0, cache_write_tokens: int = 0) -> float:
+    """Cost in USD. input_tokens includes cached and cache-write tokens, as in OpenAI usage"""
+    costs = routing_table.model_costs.get(model, {"input": 0.05, "output": 0.15})
+    factors = CACHE_PRICE_FACTORS.get(model_vendor(model), {})
+    cached_price = costs.get("cached_input", costs["input"] * factors.get("read", 1.0))
+    write_price = costs.get("cache_write", costs["input"] * factors.get("write", 1.0))
+    uncached = max(0, input_tokens - cached_tokens - cache_write_tokens)
+    return (uncached * costs["input"] + cached_tokens * cached_price + cache_write_tokens * write_price
+            + output_tokens * costs["output"]) / 1_000_000
+
+def usage_tokens(usage: Dict) -> Tuple[int, int, int, int]:
+    """(prompt, completion, cached, cache_write) tokens of an OpenAI-style usage object"""
+    details = usage.get("prompt_tokens_details") or {}
+    return (usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0,
+            details.get("cached_tokens") or 0, details.get("cache_write_tokens") or 0)
+
+def usage_cost(model: str, usage: Dict) -> float:
+    return estimate_cost(model, *usage_tokens(usage))
+
+def track_prompt_cache(model: str, usage: Dict):
+    """Count cached prompt tokens and what they saved against full input price"""
+    _, _, cached, written = usage_tokens(usage)
+    if not cached and not written:
+        return
+    saved = estimate_cost(model, cached + written, 0) - estimate_cost(model, cached + written, 0, cached, written)
+    with metrics_lock:
+        metrics["cached_prompt_tokens"] += cached
+        metrics["cache_write_tokens"] += written
+        metrics["prompt_cache_saved_usd"] += saved
+    if cached:
+        prom_prompt_cache_tokens.inc(model, "read", amount=cached)
+    if written:
+        prom_prompt_cache_tokens.inc(model, "write", amount=written)
 
 def track_request(category: str, model: str, latency_ms: float, success: bool, 
-                  routing_mode: str = "keywords", cost_usd: float = 0.0, provider: str = None, error: str = None):
+                  routing_mode: str = "keywords", cost_usd: float = 0.0, provider: str = None, error: str = None,
+                  cached: bool = False, user: Optional[str] = None, attempts: Optional[int] = None,
+                  aborted: bool = False):
+    """Count a finished request; aborted = the client went away before the end of the stream"""
     with metrics_lock:
         metrics["requests_total"] += 1
         if success:
             metrics["requests_success"] += 1
+        elif aborted:
+            metrics["requests_aborted"] += 1
         else:
             metrics["requests_failed"] += 1
         metrics["model_usage"][model] += 1
@@ -311,228 +1582,3567 @@ def track_request(category: str, model: str, latency_ms: float, success: bool,
         if provider:
             metrics["provider_usage"][provider] += 1
         metrics["routing_mode_usage"][routing_mode] += 1
-        metrics["total_latency_ms"] += latency_ms
+        if cached:
+            # Own latency bucket so cache hits do not hide upstream latency
+            metrics["cache_hits"] += 1
+            metrics["cache_latency_ms"] += latency_ms
+        else:
+            metrics["total_latency_ms"] += latency_ms
         metrics["total_cost_usd"] += cost_usd
-        
-        entry = {
-            "timestamp": datetime.utcnow().isoformat() + "Z",
-            "category": category, "model": model, "provider": provider,
-            "latency_ms": round(latency_ms, 2), "success": success,
-            "routing_mode": routing_mode, "cost_usd": round(cost_usd, 6)
-        }
-        if error:
-            entry["error"] = error[:200]
-        metrics["recent_requests"].append(entry)
-        if len(metrics["recent_requests"]) > 100:
-            metrics["recent_requests"] = metrics["recent_requests"][-100:]
+    
+    request_events.record(category, model, provider, user, routing_mode, latency_ms, cost_usd, success, cached,
+                          attempts, error)
+    provider_label = provider or "none"
+    status = "cached" if cached else ("success" if success else ("aborted" if aborted else "error"))
+    prom_requests.inc(category, model, provider_label, status)
+    if not cached:
+        # Cache hits would drag the latency distribution down; they are counted in prom_requests
+        prom_latency.observe(latency_ms / 1000, category, model, provider_label)
+    if cost_usd:
+        prom_cost.inc(category, model, provider_label, amount=cost_usd)
 
 # =============================================================================
-# PYDANTIC MODELS
+# PROMETHEUS / OPENMETRICS
 # =============================================================================
 
-class Message(BaseModel):
-    role: str
-    content: Any
-    name: Optional[str] = None
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "")  # Shared dir when running several workers
+PROMETHEUS_SYNC_SEC = float(os.getenv("PROMETHEUS_SYNC_SEC", "5"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
 
-class ChatCompletionRequest(BaseModel):
-    model: str
-    messages: List[Message]
-    temperature: Optional[float] = 1.0
-    top_p: Optional[float] = 1.0
-    n: Optional[int] = 1
-    stream: Optional[bool] = False
-    stop: Optional[List[str]] = None
-    max_tokens: Optional[int] = None
-    presence_penalty: Optional[float] = 0
-    frequency_penalty: Optional[float] = 0
-    user: Optional[str] = None
-    tools: Optional[List[Dict[str, Any]]] = None
-    tool_choice: Optional[Any] = None
+class Metric:
+    """One metric family: counter, gauge or histogram, keyed by label values.
     
-    class Config:
-        extra = "ignore"
+    Updates only happen on the event loop thread, so they take no lock: a counter
+    increment is a dict update. Gauges can be computed at scrape time via collect().
+    """
+    
+    def __init__(self, name: str, help_text: str, kind: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS, collect: Optional[Callable[[], Dict]] = None,
+                 aggregate: str = "sum"):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.collect = collect
+        self.aggregate = aggregate  # How gauges from several workers are merged: sum | max
+        self.values: Dict[Tuple[str, ...], Any] = {}
+    
+    def inc(self, *labels: str, amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+    
+    def set(self, *labels: str, value: float):
+        self.values[labels] = value
+    
+    def observe(self, value: float, *labels: str):
+        state = self.values.get(labels)
+        if state is None:
+            # Per-bucket (non-cumulative) counts, then sum and count
+            state = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+    
+    def snapshot(self) -> Dict:
+        values = self.collect() if self.collect else self.values
+        return {
+            "kind": self.kind, "help": self.help, "labelnames": list(self.labelnames),
+            "buckets": list(self.buckets), "aggregate": self.aggregate,
+            "samples": {"\x1f".join(k): (list(v) if isinstance(v, list) else v) for k, v in values.items()}
+        }
 
-class CategoryConfig(BaseModel):
-    name: str
-    models: List[str]
-    keywords: Optional[List[str]] = None
-    description: Optional[str] = None
+DEAD_WORKERS_FILE = "metrics_dead.json"  # Totals of the workers that exited
 
-class ModelMappingUpdate(BaseModel):
-    category: str
-    models: List[str]
+def worker_alive(filename: str) -> bool:
+    """Whether the worker that wrote metrics_<pid>.json still runs"""
+    pid = filename[len("metrics_"):-len(".json")]
+    if not pid.isdigit():
+        return True
+    if fcntl is None:
+        return True  # Not POSIX: os.kill(pid, 0) would not be a mere check
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # Exists, owned by another user
+    return True
+
+class MetricsRegistry:
+    def __init__(self, multiproc_dir: str = PROMETHEUS_MULTIPROC_DIR):
+        self.metrics: Dict[str, Metric] = {}
+        self.multiproc_dir = multiproc_dir
+        if multiproc_dir:
+            os.makedirs(multiproc_dir, exist_ok=True)
+    
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+    
+    def snapshot(self) -> Dict[str, Dict]:
+        families = {}
+        for name, metric in self.metrics.items():
+            try:
+                families[name] = metric.snapshot()
+            except Exception as e:
+                print(f"Error collecting {name}: {e}")
+        return families
+    
+    def _path(self, pid: int) -> str:
+        return os.path.join(self.multiproc_dir, f"metrics_{pid}.json")
+    
+    def dump(self, families: Dict[str, Dict]):
+        """Publish this worker's snapshot for the other workers"""
+        atomic_write_json(self._path(os.getpid()), families, indent=None)
+    
+    @staticmethod
+    def _merge(families: Dict[str, Dict], other: Dict[str, Dict], gauges: bool = True):
+        """Add the samples of another snapshot into families, in place"""
+        for name, family in other.items():
+            if family["kind"] == "gauge" and not gauges:
+                continue
+            target = families.get(name)
+            if target is None:
+                families[name] = family
+                continue
+            samples = target["samples"]
+            for key, value in family["samples"].items():
+                if key not in samples:
+                    samples[key] = value
+                elif isinstance(value, list):
+                    samples[key] = [a + b for a, b in zip(samples[key], value)]
+                elif family["kind"] == "gauge" and family.get("aggregate") == "max":
+                    samples[key] = max(samples[key], value)
+                else:
+                    samples[key] += value
+    
+    def _read(self, filename: str) -> Optional[Dict[str, Dict]]:
+        try:
+            with open(os.path.join(self.multiproc_dir, filename), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            return {}
+    
+    def reap(self, dead: List[str]):
+        """Fold the files of dead workers into DEAD_WORKERS_FILE and delete them.
+        
+        Their counters and histograms stay in the totals (a counter going down would
+        read as a reset), their gauges are dropped. Workers scraping at the same time
+        take turns on a lock file, so no file is folded twice.
+        """
+        if fcntl is None:
+            return
+        archive_path = os.path.join(self.multiproc_dir, DEAD_WORKERS_FILE)
+        with open(os.path.join(self.multiproc_dir, ".reap.lock"), "a") as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            archive = self._read(DEAD_WORKERS_FILE) or {}
+            folded = []
+            for filename in dead:
+                other = self._read(filename)
+                if other is None:
+                    continue  # Folded by another worker
+                self._merge(archive, other, gauges=False)
+                folded.append(filename)
+            if not folded:
+                return
+            atomic_write_json(archive_path, archive, indent=None)
+            for filename in folded:
+                try:
+                    os.remove(os.path.join(self.multiproc_dir, filename))
+                except FileNotFoundError:
+                    pass
+    
+    def merged(self, families: Dict[str, Dict]) -> Dict[str, Dict]:
+        """Merge this worker's live snapshot with the files of the other workers"""
+        if not self.multiproc_dir:
+            return families
+        def other_files() -> List[str]:
+            own = os.path.basename(self._path(os.getpid()))
+            return [f for f in os.listdir(self.multiproc_dir)
+                    if f != own and f.startswith("metrics_") and f.endswith(".json")]
+        
+        filenames = other_files()
+        dead = [f for f in filenames if f != DEAD_WORKERS_FILE and not worker_alive(f)]
+        if dead:
+            try:
+                self.reap(dead)
+                filenames = other_files()
+            except OSError as e:
+                print(f"Error folding metrics of dead workers: {e}")
+        for filename in filenames:
+            other = self._read(filename)
+            if other:
+                # Only live workers' gauges: a dead worker's open circuits or connections are gone
+                self._merge(families, other, gauges=filename != DEAD_WORKERS_FILE and worker_alive(filename))
+        return families
+    
+    @staticmethod
+    def render(families: Dict[str, Dict], openmetrics: bool = False) -> str:
+        def fmt_labels(names, values, extra=None):
+            pairs = list(zip(names, values))
+            if extra:
+                pairs.append(extra)
+            if not pairs:
+                return ""
+            escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+            return "{" + ",".join(f'{n}="{v}"' for (n, _), v in zip(pairs, escaped)) + "}"
+        
+        lines = []
+        for name, family in families.items():
+            kind, labelnames = family["kind"], family["labelnames"]
+            family_name = name if openmetrics or kind != "counter" else f"{name}_total"
+            lines.append(f"# HELP {family_name} {family['help']}")
+            lines.append(f"# TYPE {family_name} {kind}")
+            for key, value in sorted(family["samples"].items()):
+                values = key.split("\x1f") if labelnames else []
+                if kind == "counter":
+                    lines.append(f"{name}_total{fmt_labels(labelnames, values)} {value}")
+                elif kind == "gauge":
+                    lines.append(f"{name}{fmt_labels(labelnames, values)} {value}")
+                else:
+                    cumulative = 0
+                    for bound, count in zip(list(family["buckets"]) + ["+Inf"], value):
+                        cumulative += count
+                        le = bound if bound == "+Inf" else repr(float(bound))
+                        lines.append(f"{name}_bucket{fmt_labels(labelnames, values, ('le', le))} {cumulative}")
+                    lines.append(f"{name}_sum{fmt_labels(labelnames, values)} {value[-2]}")
+                    lines.append(f"{name}_count{fmt_labels(labelnames, values)} {value[-1]}")
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+registry = MetricsRegistry()
+prom_requests = registry.register(Metric(
+    "llm_router_requests", "Chat completion requests", "counter", ("category", "model", "provider", "status")))
+prom_latency = registry.register(Metric(
+    "llm_router_request_latency_seconds", "End-to-end request latency", "histogram", ("category", "model", "provider")))
+prom_upstream_latency = registry.register(Metric(
+    "llm_router_upstream_latency_seconds", "Latency of successful provider calls", "histogram", ("model", "provider")))
+prom_routing_latency = registry.register(Metric(
+    "llm_router_routing_latency_seconds", "Category classification latency", "histogram", ("mode",)))
+prom_fallback_depth = registry.register(Metric(
+    "llm_router_fallback_depth", "Requests by number of models attempted before success", "counter", ("category", "depth")))
+prom_cost = registry.register(Metric(
+    "llm_router_cost_usd", "Estimated cost in USD", "counter", ("category", "model", "provider")))
+prom_circuit_state = registry.register(Metric(
+    "llm_router_circuit_open", "1 if the circuit of a model is open", "gauge", ("model",), aggregate="max",
+    collect=lambda: {(m,): 1.0 if circuit_breaker.state(m) == "open" else 0.0 for m in circuit_breaker.failures.keys() | circuit_breaker.states.keys()}))
+prom_circuit_half_open = registry.register(Metric(
+    "llm_router_circuit_half_open", "1 if the circuit of a model is half-open (trial calls only)", "gauge", ("model",),
+    aggregate="max",
+    collect=lambda: {(m,): 1.0 if circuit_breaker.state(m) == "half_open" else 0.0 for m in circuit_breaker.failures.keys() | circuit_breaker.states.keys()}))
+prom_circuit_trips = registry.register(Metric(
+    "llm_router_circuit_trips", "Circuit trips by reason", "counter", ("reason",),
+    collect=lambda: {(r,): float(n) for r, n in list(circuit_breaker.trip_reasons.items())}))
+prom_circuit_failures = registry.register(Metric(
+    "llm_router_circuit_failures", "Consecutive failures per model", "gauge", ("model",), aggregate="max",
+    collect=lambda: {(m,): float(v) for m, v in circuit_breaker.failures.items()}))
+prom_rate_limited = registry.register(Metric(
+    "llm_router_rate_limited", "Calls held back by rate limits", "counter", ("model", "outcome")))
+prom_rate_limit_wait = registry.register(Metric(
+    "llm_router_rate_limit_wait_seconds", "Time spent waiting for rate-limit admission", "histogram", ("provider",)))
+prom_rate_limit_queue = registry.register(Metric(
+    "llm_router_rate_limit_queue_depth", "Requests waiting for rate-limit admission", "gauge", ("model",),
+    collect=lambda: {(m,): float(d) for m, d in list(rate_limiter.depth.items())}))
+prom_coalesced = registry.register(Metric(
+    "llm_router_coalesced", "Calls served by an identical in-flight call (upstream calls saved)", "counter", ("kind",)))
+prom_pool_connections = registry.register(Metric(
+    "llm_router_pool_connections", "HTTP connections per provider and state", "gauge", ("provider", "state"),
+    collect=lambda: {(p, state): float(st[state]) for p, st in provider_pools.get_stats()["providers"].items()
+                     for state in ("in_use", "idle", "waiting")}))
+prom_cache_hits = registry.register(Metric(
+    "llm_router_cache_hits", "Cache hits", "counter", ("cache",),
+    collect=lambda: {("routing",): float(routing_cache.hits), ("session",): float(session_affinity.stats["hits"]),
+                     ("response",): float(response_cache.stats["hits_memory"] + response_cache.stats["hits_disk"])}))
+prom_prompt_cache_tokens = registry.register(Metric(
+    "llm_router_prompt_cache_tokens", "Prompt tokens read from or written to provider prompt caches", "counter",
+    ("model", "kind")))
+prom_health_probes = registry.register(Metric(
+    "llm_router_health_probes", "Background health probes by provider, kind and result", "counter",
+    ("provider", "kind", "result")))
+prom_hedges = registry.register(Metric(
+    "llm_router_hedges", "Hedged requests fired and won", "counter", ("result",),
+    collect=lambda: {("fired",): float(metrics["hedges_fired"]), ("won",): float(metrics["hedges_won"])}))
+
+async def metrics_sync_loop():
+    """Periodically publish this worker's metrics when running multi-worker"""
+    while True:
+        await asyncio.sleep(PROMETHEUS_SYNC_SEC)
+        try:
+            await asyncio.to_thread(registry.dump, registry.snapshot())
+        except Exception as e:
+            print(f"Error publishing metrics: {e}")
 
 # =============================================================================
-# ROUTING LOGIC
+# SHARED STATE (multi-worker)
 # =============================================================================
 
-ROUTER_PROMPT = """Tu es un routeur de modèles LLM. Analyse la requête et choisis la meilleure catégorie.
+SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "local")  # local | mmap | sqlite | redis
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", "")  # File for mmap/sqlite backends
+SHARED_STATE_URL = os.getenv("SHARED_STATE_URL", "redis://localhost:6379/0")
+SHARED_STATE_SYNC_SEC = float(os.getenv("SHARED_STATE_SYNC_SEC", "1.0"))
+
+def apply_counter_deltas(counters: Dict[str, float], deltas: Dict[str, float]):
+    for key, delta in deltas.items():
+        counters[key] = counters.get(key, 0.0) + delta
+
+def apply_breaker_ops(breakers: Dict[str, Dict], ops: Dict[str, Dict]):
+    """Merge queued breaker changes into a shared breaker table in place.
+    
+    A success resets the shared count to the failures seen after it; failures
+    add up across workers; last_failure keeps the most recent timestamp and the
+    most recent state transition wins. A reset of all circuits is kept as a "*"
+    record so other workers close theirs too.
+    """
+    if "*" in ops:
+        breakers.clear()
+    for model, op in ops.items():
+        record = breakers.setdefault(model, {"failures": 0, "last_failure": 0.0, "state": None, "state_at": 0.0, "trips": 0})
+        record["failures"] = op["failures"] if op["reset"] else record["failures"] + op["failures"]
+        record["last_failure"] = max(record["last_failure"], op["last_failure"])
+        if op["state"] and op["state_at"] > record.get("state_at", 0.0):
+            record.update(state=op["state"], state_at=op["state_at"], trips=op["trips"])
+
+class MmapBackend:
+    """Length-prefixed JSON document in a memory-mapped file, guarded by flock"""
+    
+    def __init__(self, path: str, size: int = 4 * 1024 * 1024):
+        if fcntl is None:
+            raise RuntimeError("mmap shared state requires fcntl (POSIX)")
+        self.size = size
+        self.file = open(path, "a+b")
+        if os.path.getsize(path) < size:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+    
+    def _read(self) -> Dict:
+        length = struct.unpack_from("<I", self.map, 0)[0]
+        if not length or length > self.size - 4:
+            return {}
+        try:
+            return json.loads(self.map[4:4 + length])
+        except ValueError:
+            return {}  # Torn write from a crashed worker: start over
+    
+    def _write(self, document: Dict):
+        data = json.dumps(document, separators=(",", ":")).encode("utf-8")
+        if len(data) + 4 > self.size:
+            raise RuntimeError("Shared state segment is full")
+        self.map[4:4 + len(data)] = data
+        struct.pack_into("<I", self.map, 0, len(data))
+    
+    def sync(self, deltas: Dict[str, float], ops: Dict[str, Dict]) -> Tuple[Dict, Dict]:
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        try:
+            document = self._read()
+            counters = document.setdefault("counters", {})
+            breakers = document.setdefault("breakers", {})
+            if deltas or ops:
+                apply_counter_deltas(counters, deltas)
+                apply_breaker_ops(breakers, ops)
+                self._write(document)
+            return counters, breakers
+        finally:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+    
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+class SQLiteBackend:
+    """Shared tables in a SQLite database in WAL mode"""
+    
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10.0, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value REAL NOT NULL)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS breakers (model TEXT PRIMARY KEY, failures INTEGER NOT NULL, "
+            "last_failure REAL NOT NULL, state TEXT, state_at REAL NOT NULL DEFAULT 0, trips INTEGER NOT NULL DEFAULT 0)"
+        )
+    
+    def sync(self, deltas: Dict[str, float], ops: Dict[str, Dict]) -> Tuple[Dict, Dict]:
+        with self.lock:
+            if deltas or ops:
+                self.db.execute("BEGIN IMMEDIATE")
+                try:
+                    self.db.executemany(
+                        "INSERT INTO counters (key, value) VALUES (?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+                        list(deltas.items())
+                    )
+                    if "*" in ops:
+                        self.db.execute("DELETE FROM breakers")
+                    self.db.executemany(
+                        "INSERT INTO breakers (model, failures, last_failure, state, state_at, trips) "
+                        "VALUES (:model, :failures, :last_failure, :state, :state_at, :trips) "
+                        "ON CONFLICT(model) DO UPDATE SET "
+                        "failures = CASE WHEN :reset THEN excluded.failures ELSE failures + excluded.failures END, "
+                        "last_failure = MAX(last_failure, excluded.last_failure), "
+                        "state = CASE WHEN excluded.state_at > state_at THEN excluded.state ELSE state END, "
+                        "trips = CASE WHEN excluded.state_at > state_at THEN excluded.trips ELSE trips END, "
+                        "state_at = MAX(state_at, excluded.state_at)",
+                        [dict(op, model=model, reset=1 if op["reset"] else 0) for model, op in ops.items()]
+                    )
+                    self.db.execute("COMMIT")
+                except Exception:
+                    self.db.execute("ROLLBACK")
+                    raise
+            counters = dict(self.db.execute("SELECT key, value FROM counters").fetchall())
+            breakers = {m: {"failures": f, "last_failure": t, "state": st, "state_at": at, "trips": n}
+                        for m, f, t, st, at, n in self.db.execute(
+                            "SELECT model, failures, last_failure, state, state_at, trips FROM breakers")}
+            return counters, breakers
+    
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class RedisBackend:
+    """Minimal RESP2 client: one pipelined round trip per sync"""
+    
+    def __init__(self, url: str, prefix: str = "llm_router:"):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.sock = None
+        self.reader = None
+    
+    def _connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=5.0)
+        self.reader = self.sock.makefile("rb")
+        setup = []
+        if self.password:
+            setup.append(["AUTH", self.password])
+        if self.db:
+            setup.append(["SELECT", str(self.db)])
+        if setup:
+            self._pipeline(setup)
+    
+    @staticmethod
+    def _encode(command: List[str]) -> bytes:
+        parts = [f"*{len(command)}\r\n".encode()]
+        for arg in command:
+            data = str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+    
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RuntimeError(f"Redis error: {rest.decode()}")
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            count = int(rest)
+            return None if count < 0 else [self._read_reply() for _ in range(count)]
+        raise RuntimeError(f"Unexpected Redis reply: {line!r}")
+    
+    def _pipeline(self, commands: List[List[str]]) -> List:
+        self.sock.sendall(b"".join(self._encode(c) for c in commands))
+        return [self._read_reply() for _ in commands]
+    
+    def sync(self, deltas: Dict[str, float], ops: Dict[str, Dict]) -> Tuple[Dict, Dict]:
+        counters_key = self.prefix + "counters"
+        failures_key = self.prefix + "breaker_failures"
+        last_failure_key = self.prefix + "breaker_last_failure"
+        state_key = self.prefix + "breaker_state"
+        commands = [["HINCRBYFLOAT", counters_key, k, repr(v)] for k, v in deltas.items()]
+        if "*" in ops:
+            commands.append(["DEL", failures_key, last_failure_key, state_key])
+        for model, op in ops.items():
+            if op["reset"]:
+                commands.append(["HSET", failures_key, model, str(op["failures"])])
+            else:
+                commands.append(["HINCRBY", failures_key, model, str(op["failures"])])
+            if op["last_failure"]:
+                commands.append(["HSET", last_failure_key, model, repr(op["last_failure"])])
+            if op["state"]:
+                commands.append(["HSET", state_key, model, f"{op['state']}|{op['state_at']!r}|{op['trips']}"])
+        commands += [["HGETALL", counters_key], ["HGETALL", failures_key],
+                     ["HGETALL", last_failure_key], ["HGETALL", state_key]]
+        with self.lock:
+            try:
+                if self.sock is None:
+                    self._connect()
+                replies = self._pipeline(commands)
+            except Exception:
+                self.close()
+                raise
+        
+        def pairs(reply):
+            return dict(zip(reply[::2], reply[1::2])) if reply else {}
+        
+        counters = {k: float(v) for k, v in pairs(replies[-4]).items()}
+        failures = pairs(replies[-3])
+        last_failures = pairs(replies[-2])
+        states = pairs(replies[-1])
+        breakers = {}
+        for model in set(failures) | set(states):
+            state, state_at, trips = (states.get(model) or "||0").split("|")
+            breakers[model] = {"failures": int(failures.get(model, 0)),
+                               "last_failure": float(last_failures.get(model, 0.0)),
+                               "state": state or None, "state_at": float(state_at or 0.0), "trips": int(trips)}
+        return counters, breakers
+    
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.reader = None
+
+def create_shared_backend(name: str):
+    if name == "mmap":
+        return MmapBackend(SHARED_STATE_PATH or "shared_state.mmap")
+    if name == "sqlite":
+        return SQLiteBackend(SHARED_STATE_PATH or "shared_state.db")
+    if name == "redis":
+        return RedisBackend(SHARED_STATE_URL)
+    return None
+
+class SharedState:
+    """Periodic sync of breaker state and metrics counters across workers.
+    
+    Requests only touch local state. Every SHARED_STATE_SYNC_SEC the worker pushes
+    the counter deltas and breaker changes accumulated since the last sync, and
+    pulls the merged totals back, in a single backend call off the event loop.
+    """
+    
+    def __init__(self, backend_name: str = SHARED_STATE_BACKEND):
+        self.backend_name = backend_name
+        self.backend = None
+        try:
+            self.backend = create_shared_backend(backend_name)
+        except Exception as e:
+            print(f"Error opening shared state backend '{backend_name}': {e}")
+        self.synced_local: Dict[str, float] = {}
+        self.shared_totals: Dict[str, float] = {}
+        self.syncs = 0
+        self.errors = 0
+        self.last_sync_ms = 0.0
+        self.last_sync_at: Optional[float] = None
+        if self.backend is not None:
+            circuit_breaker.shared = True
+    
+    @staticmethod
+    def flatten(source: Dict) -> Dict[str, float]:
+        """Numeric counters of the metrics dict as flat keys ("model_usage\x1fopenai/gpt-4o")"""
+        flat = {}
+        for name, value in source.items():
+            if isinstance(value, bool):
+                continue
+            if isinstance(value, (int, float)):
+                flat[name] = value
+            elif isinstance(value, dict):
+                for sub, sub_value in value.items():
+                    flat[f"{name}\x1f{sub}"] = sub_value
+        return flat
+    
+    def overlay(self, source: Dict) -> Dict:
+        """Metrics dict with cluster-wide counters (caller holds metrics_lock)"""
+        if self.backend is None or self.last_sync_at is None:
+            return source
+        view = {k: (dict(v) if isinstance(v, dict) else v) for k, v in source.items()}
+        local = self.flatten(source)
+        for key in set(local) | set(self.shared_totals):
+            value = self.shared_totals.get(key, 0.0) + local.get(key, 0.0) - self.synced_local.get(key, 0.0)
+            if not isinstance(local.get(key, 0), float) and float(value).is_integer():
+                value = int(value)
+            if "\x1f" in key:
+                name, sub = key.split("\x1f", 1)
+                view.setdefault(name, {})[sub] = value
+            else:
+                view[key] = value
+        return view
+    
+    async def sync(self):
+        if self.backend is None:
+            return
+        with metrics_lock:
+            local = self.flatten(metrics)
+        deltas = {k: v - self.synced_local.get(k, 0.0) for k, v in local.items() if v != self.synced_local.get(k, 0.0)}
+        ops = circuit_breaker.take_pending()
+        start = time.perf_counter()
+        try:
+            counters, breakers = await asyncio.to_thread(self.backend.sync, deltas, ops)
+        except Exception as e:
+            circuit_breaker.restore_pending(ops)
+            self.errors += 1
+            print(f"Shared state sync failed: {e}")
+            return
+        self.last_sync_ms = (time.perf_counter() - start) * 1000
+        self.synced_local = local
+        self.shared_totals = counters
+        circuit_breaker.apply_shared(breakers)
+        self.syncs += 1
+        self.last_sync_at = time.time()
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(SHARED_STATE_SYNC_SEC)
+            await self.sync()
+    
+    def close(self):
+        if self.backend is not None:
+            self.backend.close()
+    
+    def get_status(self) -> Dict:
+        return {
+            "backend": self.backend_name if self.backend is not None else "local",
+            "sync_interval_sec": SHARED_STATE_SYNC_SEC,
+            "syncs": self.syncs,
+            "errors": self.errors,
+            "last_sync_ms": round(self.last_sync_ms, 2),
+            "last_sync_at": datetime.fromtimestamp(self.last_sync_at).isoformat() if self.last_sync_at else None
+        }
+
+shared_state = SharedState()
+
+# =============================================================================
+# PYDANTIC MODELS
+# =============================================================================
+
+class Message(BaseModel):
+    role: str
+    content: Any
+    name: Optional[str] = None
+    
+    class Config:
+        extra = "allow"  # tool_calls, tool_call_id, ... are forwarded upstream
+
+class ChatCompletionRequest(BaseModel):
+    model: str
+    messages: List[Message]
+    temperature: Optional[float] = 1.0
+    top_p: Optional[float] = 1.0
+    n: Optional[int] = 1
+    stream: Optional[bool] = False
+    stop: Optional[List[str]] = None
+    max_tokens: Optional[int] = None
+    presence_penalty: Optional[float] = 0
+    frequency_penalty: Optional[float] = 0
+    user: Optional[str] = None
+    tools: Optional[List[Dict[str, Any]]] = None
+    tool_choice: Optional[Any] = None
+    # Messages as the client sent them, dumped once (or the decoded body, when a caller has it)
+    _raw_messages: Optional[List[Dict]] = PrivateAttr(default=None)
+    # Uncalibrated prompt token estimate, computed once per request
+    _prompt_tokens: Optional[int] = PrivateAttr(default=None)
+    
+    class Config:
+        extra = "ignore"
+
+class CategoryConfig(BaseModel):
+    name: str
+    models: List[str]
+    keywords: Optional[List[str]] = None
+    description: Optional[str] = None
+
+class ModelMappingUpdate(BaseModel):
+    category: str
+    models: List[str]
+
+# =============================================================================
+# ROUTING CACHE
+# =============================================================================
+
+ROUTING_CACHE_SIZE = int(os.getenv("ROUTING_CACHE_SIZE", "5000"))
+ROUTING_CACHE_TTL_SEC = float(os.getenv("ROUTING_CACHE_TTL_SEC", "3600"))
+ROUTING_CACHE_FILE = os.getenv("ROUTING_CACHE_FILE", "")  # Empty: no persistence
+
+WHITESPACE_RE = re.compile(r"\s+")
+
+def message_text(content: Any) -> str:
+    """Text of a message content (plain string or list of OpenAI content parts)"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return " ".join(p.get("text", "") for p in content if isinstance(p, dict) and p.get("type") == "text")
+    return "" if content is None else str(content)
+
+class RoutingCache:
+    """LRU + TTL cache of LLM classification results.
+    
+    Keyed by a hash of the normalized last user message and the set of categories.
+    Entries are dropped as soon as the routing config fingerprint changes.
+    """
+    
+    def __init__(self, max_size: int = ROUTING_CACHE_SIZE, ttl_sec: float = ROUTING_CACHE_TTL_SEC, path: str = ""):
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        # key -> (category, routing_mode, created_at, classifier_latency_ms)
+        self.entries: "OrderedDict[str, Tuple[str, str, float, float]]" = OrderedDict()
+        self.fingerprint = routing_config_fingerprint
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.saved_latency_ms = 0.0
+        self.lock = threading.Lock()
+        self.persister = StatePersister(path, self._snapshot) if path else None
+        if path:
+            self._load(path)
+    
+    def _load(self, path: str):
+        state = load_json_file(path)
+        if not state or state.get("fingerprint") != routing_config_fingerprint:
+            return
+        now = time.time()
+        for key, category, mode, created_at, latency_ms in state.get("entries", []):
+            if now - created_at < self.ttl_sec:
+                self.entries[key] = (category, mode, created_at, latency_ms)
+        print(f"Routing cache loaded ({len(self.entries)} entries)")
+    
+    def _snapshot(self) -> Dict:
+        with self.lock:
+            return {"fingerprint": self.fingerprint, "entries": [[k, *v] for k, v in self.entries.items()]}
+    
+    def _check_fingerprint(self):
+        if self.fingerprint != routing_config_fingerprint:
+            self.fingerprint = routing_config_fingerprint
+            if self.entries:
+                self.entries.clear()
+                self.invalidations += 1
+    
+    def make_key(self, message: Any, table: RoutingSnapshot) -> str:
+        normalized = WHITESPACE_RE.sub(" ", message_text(message)).strip().lower()
+        categories = ",".join(sorted(table.model_mappings.keys()))
+        return hashlib.sha256(f"{categories}\x00{normalized}".encode("utf-8")).hexdigest()
+    
+    def get(self, key: str, table: RoutingSnapshot) -> Optional[Tuple[str, str]]:
+        with self.lock:
+            self._check_fingerprint()
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry[2] > self.ttl_sec or entry[0] not in table.model_mappings:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.saved_latency_ms += entry[3]
+            return entry[0], entry[1]
+    
+    def put(self, key: str, category: str, routing_mode: str, latency_ms: float):
+        with self.lock:
+            self._check_fingerprint()
+            self.entries[key] = (category, routing_mode, time.time(), latency_ms)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        if self.persister:
+            self.persister.mark_dirty()
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.invalidations += 1
+        if self.persister:
+            self.persister.mark_dirty()
+    
+    def get_stats(self) -> Dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "ttl_sec": self.ttl_sec,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+                "invalidations": self.invalidations,
+                "saved_latency_ms": round(self.saved_latency_ms, 2),
+                "persistent": self.persister is not None
+            }
+
+routing_cache = RoutingCache(path=ROUTING_CACHE_FILE)
+if routing_cache.persister:
+    atexit.register(routing_cache.persister.stop)
+
+# =============================================================================
+# REQUEST COALESCING (single-flight)
+# =============================================================================
+
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "true").lower() == "true"
+
+class SingleFlight:
+    """One call per key at a time: concurrent callers with the same key share its result.
+    
+    The call runs in its own task, so a caller giving up (routing budget, client
+    disconnect) does not cancel it for the others. It is cancelled once no caller
+    is left waiting.
+    """
+    
+    def __init__(self, enabled: bool = COALESCE_REQUESTS):
+        self.enabled = enabled
+        self.calls: Dict[str, List] = {}  # key -> [task, waiters]
+        self.stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {"calls": 0, "shared": 0})
+    
+    async def run(self, key: str, factory: Callable, kind: str) -> Tuple[Any, bool]:
+        """Returns (result, shared); shared is True when another caller made the call"""
+        if not self.enabled:
+            return await factory(), False
+        entry = self.calls.get(key)
+        shared = entry is not None
+        if entry is None:
+            entry = self.calls[key] = [asyncio.ensure_future(factory()), 0]
+            entry[0].add_done_callback(lambda _: self.calls.pop(key) if self.calls.get(key) is entry else None)
+            self.stats[kind]["calls"] += 1
+        else:
+            self.stats[kind]["shared"] += 1
+            prom_coalesced.inc(kind)
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0]), shared
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                entry[0].cancel()
+    
+    def get_stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self.calls),
+            "upstream_calls_saved": sum(s["shared"] for s in self.stats.values()),
+            **{kind: dict(s) for kind, s in self.stats.items()}
+        }
+
+single_flight = SingleFlight()
+
+# =============================================================================
+# SEMANTIC ROUTING
+# =============================================================================
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    np = None
+    NUMPY_AVAILABLE = False
+
+# hash | ollama/<model> | <provider>/<model> (OpenAI-compatible /embeddings) | local/<sentence-transformers model>
+SEMANTIC_EMBEDDER = os.getenv("SEMANTIC_EMBEDDER", "hash")
+SEMANTIC_FALLBACK = os.getenv("SEMANTIC_FALLBACK", "keywords")  # keywords | ollama | api | hybrid
+SEMANTIC_HASH_DIM = int(os.getenv("SEMANTIC_HASH_DIM", "2048"))
+
+SEMANTIC_DEFAULTS = {
+    "threshold": None,  # Minimum cosine similarity of the best category (None: 0.2 for hash, 0.5 for models)
+    "margin": 0.0,      # Minimum lead over the second best category
+    "utterances": {},   # category -> example requests, merged over DEFAULT_UTTERANCES
+}
+
+DEFAULT_UTTERANCES = {
+    "code": [
+        "write a python function that parses a csv file",
+        "fix this bug in my javascript code",
+        "why does this code throw a null pointer exception",
+        "refactor this class to use dependency injection",
+        "how do I undo the last git commit",
+        "write a sql query joining orders and customers",
+    ],
+    "reasoning": [
+        "explain why the sky is blue",
+        "prove that the square root of two is irrational",
+        "analyze the pros and cons of remote work",
+        "solve this math problem step by step",
+        "what would happen to the economy if interest rates doubled",
+        "compare these two approaches and recommend one",
+    ],
+    "conversation": [
+        "hello how are you today",
+        "thanks a lot for your help",
+        "tell me a joke",
+        "what is your favourite movie",
+        "good morning, nice to meet you",
+        "can you recommend a good book to read",
+    ],
+}
+
+def hash_features(text: str, dim: int = SEMANTIC_HASH_DIM) -> Dict[int, float]:
+    """Dependency-free sparse embedding: signed feature hashing of words, word bigrams
+    and character trigrams (log term frequency). Weighted by IDF over the utterances,
+    it matches paraphrases sharing vocabulary, not synonyms."""
+    counts: Dict[int, float] = defaultdict(float)
+    words = WORD_TOKEN_RE.findall(text.lower())
+    features = words + [a + " " + b for a, b in zip(words, words[1:])]
+    for word in words:
+        padded = f"<{word}>"
+        features += [padded[i:i + 3] for i in range(len(padded) - 2)]
+    for feature in features:
+        h = zlib.crc32(feature.encode("utf-8"))
+        counts[h % dim] += 1.0 if h & 0x80000000 else -1.0
+    return {d: math.copysign(1 + math.log(abs(c)), c) for d, c in counts.items() if c}
+
+class SemanticRouter:
+    """Nearest-utterance classifier over an in-memory index of example requests.
+
+    Utterances are embedded once per config into normalized vectors, rows grouped
+    by category. A request is embedded once and scored against every row at once:
+    a NumPy matrix product when available, otherwise an inverted index over the
+    non-zero dimensions. A category scores its best utterance.
+    """
+
+    def __init__(self, embedder: str = SEMANTIC_EMBEDDER):
+        self.embedder = embedder
+        self.vectors: Dict[str, Dict[int, float]] = {}  # utterance -> model embedding, survives reloads
+        self.idf: Dict[int, float] = {}  # hash embedder only
+        self.default_idf = 1.0
+        self.categories: List[str] = []
+        self.offsets: List[int] = []  # First row of each category
+        self.n_rows = 0
+        self.matrix = None
+        self.postings: Dict[int, List[Tuple[int, float]]] = {}
+        self.version = None
+        self.build_lock = asyncio.Lock()
+        self.local_model = None
+        self.stats = {"classified": 0, "below_threshold": 0, "errors": 0, "total_ms": 0.0, "builds": 0}
+
+    def config(self) -> Dict:
+        return {**SEMANTIC_DEFAULTS, **semantic_config}
+
+    def utterances(self) -> Dict[str, List[str]]:
+        merged = {**DEFAULT_UTTERANCES, **self.config()["utterances"]}
+        return {category: merged[category] for category in model_mappings if merged.get(category)}
+
+    async def embed(self, texts: List[str]) -> List[Dict[int, float]]:
+        """Raw (unweighted, unnormalized) sparse embeddings"""
+        if self.embedder == "hash":
+            return [hash_features(t) for t in texts]
+        provider, model = parse_model_id(self.embedder)
+        if provider == "local":
+            if self.local_model is None:
+                from sentence_transformers import SentenceTransformer  # Optional dependency
+                self.local_model = await asyncio.to_thread(SentenceTransformer, model)
+            vectors = await asyncio.to_thread(self.local_model.encode, texts)
+        else:
+            prov_config = PROVIDERS[provider]
+            client = provider_pools.get(provider)
+            if provider == "ollama":
+                response = await client.post(f"{prov_config['base_url']}/api/embed",
+                                             json={"model": model, "input": texts}, timeout=15.0)
+                response.raise_for_status()
+                vectors = response.json()["embeddings"]
+            else:
+                headers = {"Content-Type": "application/json"}
+                if prov_config.get("api_key"):
+                    headers[prov_config["auth_header"]] = prov_config["auth_prefix"] + prov_config["api_key"]
+                response = await client.post(f"{prov_config['base_url']}/embeddings", headers=headers,
+                                             json={"model": model, "input": texts}, timeout=15.0)
+                response.raise_for_status()
+                vectors = [item["embedding"] for item in sorted(response.json()["data"], key=lambda d: d["index"])]
+        return [{d: float(v) for d, v in enumerate(vector)} for vector in vectors]
+
+    def weight(self, vector: Dict[int, float]) -> Dict[int, float]:
+        """IDF-weighted (hash embedder) and L2-normalized"""
+        if self.idf:
+            vector = {d: v * self.idf.get(d, self.default_idf) for d, v in vector.items()}
+        norm = math.sqrt(sum(v * v for v in vector.values()))
+        return {d: v / norm for d, v in vector.items()} if norm else vector
+
+    async def ensure_index(self):
+        """(Re)build the index if the categories or utterances changed since the last build"""
+        version = semantic_fingerprint
+        if self.version == version:
+            return
+        async with self.build_lock:
+            if self.version == version:
+                return
+            utterances = self.utterances()
+            texts = [t for category_texts in utterances.values() for t in category_texts]
+            if self.embedder == "hash":
+                raw = dict(zip(texts, await self.embed(texts)))
+                df: Dict[int, int] = defaultdict(int)
+                for vector in raw.values():
+                    for d in vector:
+                        df[d] += 1
+                # Smoothed IDF: dimensions shared by many utterances ("please", "the") weigh less
+                self.default_idf = math.log(len(raw) + 1) + 1
+                self.idf = {d: math.log((len(raw) + 1) / (n + 1)) + 1 for d, n in df.items()}
+            else:
+                missing = sorted(set(texts) - self.vectors.keys())
+                for i in range(0, len(missing), 256):
+                    batch = missing[i:i + 256]
+                    self.vectors.update(zip(batch, await self.embed(batch)))
+                raw = self.vectors
+            categories, offsets, rows = [], [], []
+            for category, category_texts in utterances.items():
+                categories.append(category)
+                offsets.append(len(rows))
+                rows.extend(self.weight(raw[t]) for t in category_texts)
+            if NUMPY_AVAILABLE and rows:
+                dim = SEMANTIC_HASH_DIM if self.embedder == "hash" else max(max(r, default=0) for r in rows) + 1
+                matrix = np.zeros((len(rows), dim), dtype=np.float32)
+                for i, row in enumerate(rows):
+                    matrix[i, list(row)] = list(row.values())
+                self.matrix, self.postings = matrix, {}
+            else:
+                postings: Dict[int, List[Tuple[int, float]]] = defaultdict(list)
+                for i, row in enumerate(rows):
+                    for d, v in row.items():
+                        postings[d].append((i, v))
+                self.matrix, self.postings = None, dict(postings)
+            self.categories, self.offsets, self.n_rows = categories, offsets, len(rows)
+            self.version = version
+            self.stats["builds"] += 1
+
+    def scores(self, query: Dict[int, float]) -> List[float]:
+        """Best cosine similarity per category"""
+        if self.matrix is not None:
+            vector = np.zeros(self.matrix.shape[1], dtype=np.float32)
+            dims = [d for d in query if d < len(vector)]
+            vector[dims] = [query[d] for d in dims]
+            similarities = self.matrix @ vector
+            return np.maximum.reduceat(similarities, self.offsets).tolist()
+        similarities = [0.0] * self.n_rows
+        for d, q in query.items():
+            for i, v in self.postings.get(d, ()):
+                similarities[i] += q * v
+        bounds = self.offsets + [self.n_rows]
+        return [max(similarities[bounds[c]:bounds[c + 1]]) for c in range(len(self.categories))]
+
+    async def classify(self, message: Any) -> Optional[Tuple[str, float]]:
+        """(category, similarity), or None below the threshold or on embedder errors"""
+        start = time.perf_counter()
+        try:
+            await self.ensure_index()
+            if not self.categories:
+                return None
+            query = self.weight((await self.embed([message_text(message)[:ROUTER_MAX_CHARS]]))[0])
+            scores = self.scores(query)
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"Semantic routing failed: {e}")
+            return None
+        finally:
+            self.stats["total_ms"] += (time.perf_counter() - start) * 1000
+        cfg = self.config()
+        ranked = sorted(range(len(scores)), key=lambda c: scores[c], reverse=True)
+        best = scores[ranked[0]]
+        runner_up = scores[ranked[1]] if len(ranked) > 1 else -1.0
+        threshold = cfg["threshold"] if cfg["threshold"] is not None else (0.2 if self.embedder == "hash" else 0.5)
+        if best < threshold or best - runner_up < cfg["margin"]:
+            self.stats["below_threshold"] += 1
+            return None
+        self.stats["classified"] += 1
+        return self.categories[ranked[0]], best
+
+    def get_stats(self) -> Dict:
+        calls = self.stats["classified"] + self.stats["below_threshold"] + self.stats["errors"]
+        return {
+            "embedder": self.embedder,
+            "numpy": NUMPY_AVAILABLE,
+            "fallback": SEMANTIC_FALLBACK,
+            "categories": len(self.categories),
+            "utterances": self.n_rows,
+            "classified": self.stats["classified"],
+            "below_threshold": self.stats["below_threshold"],
+            "errors": self.stats["errors"],
+            "index_builds": self.stats["builds"],
+            "avg_ms": round(self.stats["total_ms"] / calls, 3) if calls else 0,
+        }
+
+semantic_router = SemanticRouter()
+
+# =============================================================================
+# SESSION AFFINITY
+# =============================================================================
+
+SESSION_AFFINITY_DEFAULTS = {
+    "enabled": True,
+    "ttl_sec": 1800,              # Idle time after which a conversation is classified again
+    "max_sessions": 10000,
+    "reclassify_on_new_tools": True,   # Tools the session has not used before
+    "topic_shift_threshold": 0.1,      # Reclassify below this similarity to the session's topic (0 = never)
+    "topic_min_words": 6,              # Shorter messages never count as a topic shift
+    "topic_decay": 0.5,                # Weight of earlier turns in the session's topic
+    "max_turns": 0,                    # Reclassify every N pinned turns (0 = never)
+    "pin_model": True,                 # Try the model that last answered the session first
+}
+
+# Frequent words of 4+ letters that say nothing about the topic
+TOPIC_STOPWORDS = frozenset(
+    "that this with what from have your about would could should there their they them then than when which "
+    "will into some like just also more very here want need make please thanks thank can't don't does".split())
+
+class SessionAffinity:
+    """Pins a conversation to its routed category and to the model that last answered it.
+    
+    A conversation is identified by the client's X-Session-Id, or else by its user
+    and opening user message. Later turns reuse the decision, so they stay on one
+    provider (whose prompt cache is warm) without paying for classification, until
+    a reclassify signal: new tools, a topic shift, TTL or max_turns.
+    """
+    
+    def __init__(self):
+        # key -> {category, mode, model, tools, topic, routing_ms, turns, last_seen}
+        self.sessions: "OrderedDict[str, Dict]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "assigned": 0, "model_pins": 0, "saved_latency_ms": 0.0}
+        self.reclassified: Dict[str, int] = defaultdict(int)
+    
+    def config(self) -> Dict:
+        return {**SESSION_AFFINITY_DEFAULTS, **session_affinity_config}
+    
+    def session_key(self, session_id: Optional[str], user: Optional[str], messages: List[Dict]) -> Optional[str]:
+        if not self.config()["enabled"]:
+            return None
+        if session_id:
+            return "id\x00" + session_id
+        opening = next((m.get("content") for m in messages if m.get("role") == "user"), None)
+        if opening is None:
+            return None
+        digest = hashlib.sha256(message_text(opening).encode("utf-8")).hexdigest()[:32]
+        return f"{user or ''}\x00{digest}"
+    
+    @staticmethod
+    def topic_features(text: str) -> Dict[int, float]:
+        """Normalized bag of content words: words of 4+ letters, hashed, log term frequency.
+        Unlike hash_features, no character n-grams, which any two texts share."""
+        counts: Dict[int, int] = defaultdict(int)
+        for word in WORD_TOKEN_RE.findall(text.lower()):
+            if len(word) > 3 and word not in TOPIC_STOPWORDS:
+                counts[zlib.crc32(word.encode("utf-8"))] += 1
+        features = {d: 1 + math.log(c) for d, c in counts.items()}
+        norm = math.sqrt(sum(v * v for v in features.values())) or 1.0
+        return {d: v / norm for d, v in features.items()}
+    
+    def reclassify_reason(self, entry: Dict, text: str, tools: List[str], cfg: Dict,
+                          table: RoutingSnapshot) -> Optional[str]:
+        if entry["category"] not in table.model_mappings:
+            return "config"
+        if cfg["reclassify_on_new_tools"] and not set(tools) <= entry["tools"]:
+            return "new_tools"
+        if bool(tools) != (entry["category"] == "tools"):
+            return "tools_changed"
+        if cfg["max_turns"] and entry["turns"] >= cfg["max_turns"]:
+            return "max_turns"
+        if cfg["topic_shift_threshold"] and len(text.split()) >= cfg["topic_min_words"] and entry["topic"]:
+            features = self.topic_features(text)
+            topic = entry["topic"]
+            norm = math.sqrt(sum(v * v for v in topic.values())) or 1.0
+            similarity = sum(v * topic.get(d, 0.0) for d, v in features.items()) / norm
+            if similarity < cfg["topic_shift_threshold"]:
+                return "topic_shift"
+        return None
+    
+    def follow_topic(self, entry: Dict, text: str, cfg: Dict):
+        if len(text.split()) < cfg["topic_min_words"]:
+            return
+        decay = cfg["topic_decay"]
+        topic = {d: v * decay for d, v in entry["topic"].items() if abs(v * decay) > 1e-3}
+        for d, v in self.topic_features(text).items():
+            topic[d] = topic.get(d, 0.0) + v
+        entry["topic"] = topic
+    
+    def lookup(self, key: Optional[str], text: str, tools: List[str], table: RoutingSnapshot) -> Optional[str]:
+        """Pinned category of the session, or None to classify"""
+        if key is None:
+            return None
+        cfg = self.config()
+        entry = self.sessions.get(key)
+        if entry is None or time.time() - entry["last_seen"] > cfg["ttl_sec"]:
+            self.stats["misses"] += 1
+            return None
+        reason = self.reclassify_reason(entry, text, tools, cfg, table)
+        if reason:
+            self.reclassified[reason] += 1
+            self.stats["misses"] += 1
+            return None
+        entry["turns"] += 1
+        entry["last_seen"] = time.time()
+        self.sessions.move_to_end(key)
+        self.follow_topic(entry, text, cfg)
+        self.stats["hits"] += 1
+        self.stats["saved_latency_ms"] += entry["routing_ms"]
+        return entry["category"]
+    
+    def assign(self, key: Optional[str], category: str, routing_mode: str, routing_ms: float, text: str, tools: List[str]):
+        if key is None:
+            return
+        cfg = self.config()
+        previous = self.sessions.pop(key, None)
+        same = previous is not None and previous["category"] == category
+        entry = {"category": category, "mode": routing_mode, "routing_ms": routing_ms, "turns": 0,
+                 "last_seen": time.time(), "topic": previous["topic"] if same else {},
+                 "tools": set(tools) | (previous["tools"] if previous else set()),
+                 # The pinned model only carries over if the category did not change
+                 "model": previous["model"] if same else None}
+        self.follow_topic(entry, text, cfg)
+        self.sessions[key] = entry
+        self.stats["assigned"] += 1
+        now = time.time()
+        while self.sessions:
+            oldest_key, oldest = next(iter(self.sessions.items()))
+            if len(self.sessions) <= cfg["max_sessions"] and now - oldest["last_seen"] <= cfg["ttl_sec"]:
+                break
+            del self.sessions[oldest_key]
+    
+    def order(self, key: Optional[str], models: List[str]) -> List[str]:
+        """Chain with the session's last successful model first, when it is still in it"""
+        entry = self.sessions.get(key) if key is not None else None
+        model = entry["model"] if entry else None
+        if not model or not models or model == models[0] or model not in models:
+            return models
+        # Only pin to a closed circuit: is_available would take a half-open trial slot here,
+        # and the chain's own check would then be refused
+        if not self.config()["pin_model"] or circuit_breaker.state(model) != "closed":
+            return models
+        self.stats["model_pins"] += 1
+        return [model] + [m for m in models if m != model]
+    
+    def succeeded(self, key: Optional[str], category: str, model_id: str):
+        entry = self.sessions.get(key) if key is not None else None
+        if entry is not None and entry["category"] == category:
+            entry["model"] = model_id
+    
+    def get_stats(self) -> Dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            "enabled": self.config()["enabled"],
+            "sessions": len(self.sessions),
+            "hits": self.stats["hits"],
+            "misses": self.stats["misses"],
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0,
+            "reclassified": dict(self.reclassified),
+            "model_pins": self.stats["model_pins"],
+            "saved_latency_ms": round(self.stats["saved_latency_ms"], 2),
+        }
+
+session_affinity = SessionAffinity()
+
+# =============================================================================
+# ROUTING LOGIC
+# =============================================================================
+
+ROUTER_PROMPT = """Tu es un routeur de modèles LLM. Analyse la requête et choisis la meilleure catégorie.
 
 Catégories disponibles: {categories}
 
-Réponds UNIQUEMENT avec le nom de la catégorie."""
+Réponds UNIQUEMENT avec le nom de la catégorie."""
+
+ROUTER_MAX_CHARS = int(os.getenv("ROUTER_MAX_CHARS", "4000"))  # Message excerpt sent to the classifier
+ROUTING_BUDGET_MS = float(os.getenv("ROUTING_BUDGET_MS", "1500"))  # Overall LLM classification deadline
+HYBRID_STRATEGY = os.getenv("HYBRID_STRATEGY", "race")  # race | cascade
+HYBRID_LOCAL_SHARE = float(os.getenv("HYBRID_LOCAL_SHARE", "0.5"))  # cascade: budget share for Ollama
+
+def parse_model_id(model_id: str) -> Tuple[str, str]:
+    """Parse 'provider/model' or 'model' (default provider)"""
+    if "/" in model_id:
+        parts = model_id.split("/", 1)
+        return parts[0], parts[1]
+    return DEFAULT_PROVIDER, model_id
+
+def detect_category_keywords(message: str, table: RoutingSnapshot) -> str:
+    return table.keyword_matcher.match(message) or "conversation"
+
+async def route_with_ollama(message: str, table: RoutingSnapshot) -> Tuple[str, str]:
+    categories = list(table.model_mappings.keys())
+    prompt = ROUTER_PROMPT.format(categories=", ".join(categories))
+    
+    client = provider_pools.get("ollama")
+    try:
+        response = await client.post(
+            f"{PROVIDERS['ollama']['base_url']}/api/generate",
+            json={"model": OLLAMA_ROUTER_MODEL, "system": prompt, "prompt": message_text(message)[:ROUTER_MAX_CHARS],
+                  "stream": False, "options": {"temperature": 0.1, "num_predict": 20}},
+            timeout=15.0
+        )
+        response.raise_for_status()
+        category = response.json().get("response", "").strip().lower().split()[0]
+        if category in table.model_mappings:
+            return category, "ollama"
+    except Exception as e:
+        print(f"Ollama routing failed: {e}")
+    raise Exception("Ollama routing failed")
+
+async def route_with_api(message: str, table: RoutingSnapshot) -> Tuple[str, str]:
+    categories = list(table.model_mappings.keys())
+    prompt = ROUTER_PROMPT.format(categories=", ".join(categories))
+    
+    provider, model = parse_model_id(ROUTER_API_MODEL)
+    if provider not in PROVIDERS:
+        # "qwen/qwen3-1.7b" is a bare model id for the default provider
+        provider, model = DEFAULT_PROVIDER, ROUTER_API_MODEL
+    prov_config = PROVIDERS[provider]
+    
+    client = provider_pools.get(provider)
+    try:
+        headers = {"Content-Type": "application/json"}
+        if prov_config.get("api_key"):
+            headers[prov_config["auth_header"]] = prov_config["auth_prefix"] + prov_config["api_key"]
+        
+        response = await client.post(
+            f"{prov_config['base_url']}/chat/completions",
+            headers=headers,
+            json={"model": model, "messages": [{"role": "system", "content": prompt},
+                                               {"role": "user", "content": message_text(message)[:ROUTER_MAX_CHARS]}],
+                  "max_tokens": 20, "temperature": 0.1},
+            timeout=10.0
+        )
+        response.raise_for_status()
+        category = response.json()["choices"][0]["message"]["content"].strip().lower().split()[0]
+        if category in table.model_mappings:
+            return category, "api"
+    except Exception as e:
+        print(f"API routing failed: {e}")
+    raise Exception("API routing failed")
+
+async def first_success(coros: List, timeout_sec: float) -> Optional[Tuple[str, str]]:
+    """Run classifier coroutines concurrently, return the first successful result.
+    
+    Returns None once all failed or the deadline passed; pending calls are cancelled.
+    """
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout_sec
+    pending = set(tasks)
+    try:
+        while pending:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                with metrics_lock:
+                    metrics["routing_budget_exceeded"] += 1
+                return None
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() is None:
+                    return task.result()
+        return None
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+async def coalesced(classifier: Callable, message: Any, table: RoutingSnapshot) -> Optional[Tuple[str, str]]:
+    """Classifier call shared with concurrent requests carrying the same message and categories"""
+    key = f"{classifier.__name__}\x1f{table.fingerprint}\x1f{message_text(message)}"
+    result, _ = await single_flight.run(key, lambda: classifier(message, table), "classifier")
+    return result
+
+async def classify_with_llm(message: Any, mode: str, table: RoutingSnapshot) -> Optional[Tuple[str, str]]:
+    """LLM classification for the given mode within ROUTING_BUDGET_MS"""
+    budget_sec = ROUTING_BUDGET_MS / 1000
+    if mode == "ollama":
+        return await first_success([coalesced(route_with_ollama, message, table)], budget_sec)
+    if mode == "api":
+        return await first_success([coalesced(route_with_api, message, table)], budget_sec)
+    if mode == "hybrid":
+        if HYBRID_STRATEGY == "cascade":
+            start = time.monotonic()
+            result = await first_success([coalesced(route_with_ollama, message, table)], budget_sec * HYBRID_LOCAL_SHARE)
+            if result is not None:
+                return result
+            remaining = budget_sec - (time.monotonic() - start)
+            return await first_success([coalesced(route_with_api, message, table)], remaining)
+        return await first_success([coalesced(route_with_ollama, message, table),
+                                    coalesced(route_with_api, message, table)], budget_sec)
+    return None
+
+def last_user_text(messages: List[Dict]) -> str:
+    for msg in reversed(messages):
+        if msg.get("role") == "user":
+            return message_text(msg.get("content"))
+    return ""
+
+async def route_message(messages: List[Dict], table: RoutingSnapshot, session_key: Optional[str] = None,
+                        tool_names: List[str] = ()) -> Tuple[str, str]:
+    """(category, routing_mode): the conversation's pinned category, else a new classification.
+    
+    Everything is decided against `table`, the snapshot the request also takes its chain from.
+    """
+    text = last_user_text(messages)
+    pinned = session_affinity.lookup(session_key, text, tool_names, table)
+    if pinned is not None:
+        return pinned, "session"
+    start = time.time()
+    category, routing_mode = await classify_message(messages, table, bool(tool_names))
+    if routing_mode not in ("none", "continuation"):
+        session_affinity.assign(session_key, category, routing_mode, (time.time() - start) * 1000, text, tool_names)
+    return category, routing_mode
+
+async def classify_message(messages: List[Dict], table: RoutingSnapshot, has_tools: bool = False) -> Tuple[str, str]:
+    if not messages:
+        return "conversation", "none"
+    if has_tools:
+        return "tools", "direct"
+    
+    last_user_msg = None
+    for msg in reversed(messages):
+        if msg.get("role") == "user":
+            last_user_msg = msg.get("content", "")
+            break
+    
+    if not last_user_msg:
+        return "conversation", "none"
+    
+    # Short continuation check
+    if isinstance(last_user_msg, str) and len(last_user_msg.split()) < 4:
+        return "conversation", "continuation"
+    
+    mode = ROUTING_MODE
+    if mode == "semantic":
+        # The index follows the current table: a category the request's table lacks falls back
+        result = await semantic_router.classify(last_user_msg)
+        if result is not None and result[0] in table.model_mappings:
+            return result[0], "semantic"
+        # Below the confidence threshold: the configured fallback mode decides
+        mode = SEMANTIC_FALLBACK
+    
+    cache_key = None
+    if mode in ["ollama", "api", "hybrid"]:
+        cache_key = routing_cache.make_key(last_user_msg, table)
+        cached = routing_cache.get(cache_key, table)
+        if cached:
+            return cached[0], "cache"
+    
+    start = time.time()
+    result = await classify_with_llm(last_user_msg, mode, table)
+    if result is not None:
+        routing_cache.put(cache_key, result[0], result[1], (time.time() - start) * 1000)
+        return result
+    
+    return detect_category_keywords(message_text(last_user_msg), table), "keywords"
+
+# =============================================================================
+# TOKEN-AWARE ROUTING
+# =============================================================================
+
+TOKEN_ROUTING_DEFAULTS = {
+    "fit_check": True,                   # Skip models whose context window cannot hold the request
+    "fit_margin": 0.9,                   # Share of the context window usable, for estimate error
+    "min_completion_tokens": 256,        # Room left for the answer when max_tokens is not set
+    "expected_completion_tokens": 256,   # Answer size assumed by cost and speed estimates
+    "small_prompt_tokens": 0,            # Prompts up to this size follow `prefer` (0 = off)
+    "prefer": "none",                    # none | cost | speed
+    "default_tokens_per_sec": 50,        # Throughput of models without metadata
+    "calibration_alpha": 0.1,            # EWMA weight of reported/estimated prompt tokens
+    "models": {},                        # Metadata overrides, same fields as MODEL_METADATA
+}
+
+CHARS_PER_TOKEN = 4.0
+IMAGE_TOKENS = 765       # A 1024x1024 image at high detail
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def estimate_tokens(text: str) -> int:
+    """Token count from a byte heuristic: ~4 ASCII chars per token, about one token
+    per two extra UTF-8 bytes for accents, CJK and emoji"""
+    if not text:
+        return 0
+    if text.isascii():
+        return max(1, round(len(text) / CHARS_PER_TOKEN))
+    extra = len(text.encode("utf-8")) - len(text)
+    return max(1, round((len(text) - extra / 2) / CHARS_PER_TOKEN + extra / 2))
+
+def content_tokens(content: Any) -> int:
+    if isinstance(content, str):
+        return estimate_tokens(content)
+    if isinstance(content, list):
+        tokens = 0
+        for part in content:
+            if not isinstance(part, dict):
+                continue
+            if part.get("type") == "text":
+                tokens += estimate_tokens(part.get("text", ""))
+            elif part.get("type") in ("image_url", "image"):
+                tokens += IMAGE_TOKENS
+        return tokens
+    return 0 if content is None else estimate_tokens(str(content))
+
+def estimate_prompt_tokens(request: ChatCompletionRequest) -> int:
+    """Prompt tokens of the request (messages, tool calls and tool definitions), cached on it"""
+    if request._prompt_tokens is None:
+        tokens = 0
+        for message in upstream_messages(request):
+            tokens += MESSAGE_OVERHEAD_TOKENS + content_tokens(message.get("content"))
+            if message.get("tool_calls"):
+                tokens += round(len(json_dumps(message["tool_calls"])) / CHARS_PER_TOKEN)
+        if request.tools:
+            tokens += round(len(json_dumps(request.tools)) / CHARS_PER_TOKEN)
+        request._prompt_tokens = tokens
+    return request._prompt_tokens
+
+class TokenRouter:
+    """Fits the fallback chain to the request size, from MODEL_METADATA.
+
+    The byte heuristic is calibrated per model with the prompt_tokens providers
+    report, so tokenizers that count differently converge without being loaded.
+    Models without metadata are assumed to fit.
+    """
+
+    def __init__(self):
+        self.ratios: Dict[str, float] = {}
+        self.stats = {"skipped": 0, "no_fit": 0, "reordered": 0, "estimated_cost_usd": 0.0}
+
+    def config(self) -> Dict:
+        return {**TOKEN_ROUTING_DEFAULTS, **token_routing_config}
+
+    def metadata(self, model_id: str) -> Dict:
+        return routing_table.model_metadata.get(model_id, {})
+
+    def prompt_tokens(self, model_id: str, request: ChatCompletionRequest) -> int:
+        return round(estimate_prompt_tokens(request) * self.ratios.get(model_id, 1.0))
+
+    def completion_tokens(self, request: ChatCompletionRequest, cfg: Dict) -> int:
+        return request.max_tokens or cfg["expected_completion_tokens"]
+
+    def fits(self, model_id: str, request: ChatCompletionRequest, cfg: Dict) -> bool:
+        meta = self.metadata(model_id)
+        if request.max_tokens and meta.get("max_output") and request.max_tokens > meta["max_output"]:
+            return False
+        if not meta.get("context_window"):
+            return True
+        needed = self.prompt_tokens(model_id, request) + (request.max_tokens or cfg["min_completion_tokens"])
+        return needed <= meta["context_window"] * cfg["fit_margin"]
+
+    def plan(self, models: List[str], request: ChatCompletionRequest) -> List[str]:
+        """Chain without the models the request cannot fit, cheapest or fastest first for small prompts"""
+        cfg = self.config()
+        if cfg["fit_check"] and models:
+            fitting = [m for m in models if self.fits(m, request, cfg)]
+            if not fitting:
+                # The estimate may be off: still try the largest window rather than fail without a call
+                fitting = [max(models, key=lambda m: self.metadata(m).get("context_window", 0))]
+                self.stats["no_fit"] += 1
+            self.stats["skipped"] += len(models) - len(fitting)
+            models = fitting
+        if cfg["prefer"] in ("cost", "speed") and len(models) > 1 \
+                and estimate_prompt_tokens(request) <= cfg["small_prompt_tokens"]:
+            if cfg["prefer"] == "cost":
+                key = lambda m: self.estimate_cost(m, request, cfg)
+            else:
+                key = lambda m: 1 / (self.metadata(m).get("tokens_per_sec") or cfg["default_tokens_per_sec"])
+            ordered = sorted(models, key=key)  # Stable: ties keep the configured order
+            if ordered != models:
+                self.stats["reordered"] += 1
+            models = ordered
+        return models
+
+    def estimate_cost(self, model_id: str, request: ChatCompletionRequest, cfg: Optional[Dict] = None) -> float:
+        """Cost of the call before it is made, with max_tokens (or the expected answer size) as output"""
+        cfg = cfg or self.config()
+        return estimate_cost(model_id, self.prompt_tokens(model_id, request), self.completion_tokens(request, cfg))
+
+    def estimate(self, model_id: str, request: ChatCompletionRequest) -> Dict:
+        """Pre-call estimate for the first model of the chain, counted in the stats"""
+        cost = self.estimate_cost(model_id, request)
+        self.stats["estimated_cost_usd"] += cost
+        return {"prompt_tokens_est": self.prompt_tokens(model_id, request), "cost_usd_est": round(cost, 6)}
+
+    def observe(self, model_id: str, provider: str, request: ChatCompletionRequest, prompt_tokens: Optional[int]):
+        """Calibrate the estimate with the prompt tokens the provider reported"""
+        estimated = estimate_prompt_tokens(request)
+        # Ollama reports only the tokens it evaluated: a cached prefix would skew the ratio
+        if not prompt_tokens or provider == "ollama" or estimated < 50:
+            return
+        ratio = min(4.0, max(0.25, prompt_tokens / estimated))
+        alpha = self.config()["calibration_alpha"]
+        previous = self.ratios.get(model_id)
+        self.ratios[model_id] = ratio if previous is None else previous * (1 - alpha) + ratio * alpha
+
+    def get_stats(self) -> Dict:
+        cfg = self.config()
+        return {
+            "fit_check": cfg["fit_check"],
+            "prefer": cfg["prefer"],
+            "skipped_models": self.stats["skipped"],
+            "no_fit": self.stats["no_fit"],
+            "reordered": self.stats["reordered"],
+            "estimated_cost_usd": round(self.stats["estimated_cost_usd"], 6),
+            "calibration": {m: round(r, 3) for m, r in self.ratios.items()},
+        }
+
+token_router = TokenRouter()
+
+# =============================================================================
+# RATE LIMITING
+# =============================================================================
+
+RATE_LIMIT_DEFAULTS = {
+    "max_queue": 100,                  # Requests waiting per model before new ones are refused
+    "max_wait_ms": 10000,              # Longest admission wait
+    "spill_over": True,                # Go to the next model of the chain instead of waiting, if there is one
+    "default_completion_tokens": 512,  # Tokens reserved for the answer when max_tokens is not set
+    "default_retry_after_sec": 5,      # Pause after an upstream 429 without Retry-After
+}
+
+class RateLimited(Exception):
+    """A call was not made (local limit) or refused with 429 by the provider"""
+    
+    def __init__(self, model_id: str, retry_after: float, upstream: bool = False):
+        source = "provider returned 429" if upstream else "local rate limit"
+        super().__init__(f"{model_id}: {source}, retry after {retry_after:.1f}s")
+        self.model_id = model_id
+        self.retry_after = retry_after
+        self.upstream = upstream
+
+class TokenBucket:
+    """Holds up to `per_minute` units, refilled continuously"""
+    
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+    
+    def wait_time(self, amount: float, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # A request bigger than the bucket goes through once the bucket is full
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+    
+    def take(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After as seconds from now (delta-seconds or HTTP date)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class RateLimiter:
+    """Per-provider and per-model token buckets (requests and tokens per minute).
+    
+    Admission is FIFO per model: a request either takes its share of every bucket
+    that applies, waits in a bounded queue, or is refused with RateLimited so the
+    fallback chain can move on. Runs on the event loop only, so no thread lock.
+    """
+    
+    def __init__(self):
+        self.buckets: Dict[Tuple[str, str, str], TokenBucket] = {}  # (scope, name, rpm|tpm)
+        self.blocked_until: Dict[str, float] = {}  # model -> monotonic time, from upstream 429
+        self.locks: Dict[str, asyncio.Lock] = {}
+        self.depth: Dict[str, int] = defaultdict(int)
+        self.stats = {"admitted": 0, "waited": 0, "wait_ms_total": 0.0, "spilled": 0, "rejected": 0, "upstream_429": 0}
+    
+    def config(self) -> Dict:
+        return {**RATE_LIMIT_DEFAULTS, **rate_limit_config}
+    
+    def _bucket(self, scope: str, name: str, unit: str, per_minute: Optional[float]) -> Optional[TokenBucket]:
+        if not per_minute:
+            self.buckets.pop((scope, name, unit), None)
+            return None
+        bucket = self.buckets.get((scope, name, unit))
+        if bucket is None or bucket.capacity != per_minute:
+            bucket = self.buckets[(scope, name, unit)] = TokenBucket(per_minute)
+        return bucket
+    
+    def _limits(self, provider: str, model_id: str, cfg: Dict) -> List[Tuple[TokenBucket, str]]:
+        limits = []
+        for scope, name in (("providers", provider), ("models", model_id)):
+            entry = cfg.get(scope, {}).get(name)
+            if not entry:
+                continue
+            for unit in ("rpm", "tpm"):
+                bucket = self._bucket(scope, name, unit, entry.get(unit))
+                if bucket is not None:
+                    limits.append((bucket, unit))
+        return limits
+    
+    def _wait_time(self, model_id: str, limits: List[Tuple[TokenBucket, str]], tokens: int) -> float:
+        now = time.monotonic()
+        wait = self.blocked_until.get(model_id, now) - now
+        for bucket, unit in limits:
+            wait = max(wait, bucket.wait_time(1 if unit == "rpm" else tokens, now))
+        return wait
+    
+    def reserve_tokens(self, request: ChatCompletionRequest) -> int:
+        return estimate_prompt_tokens(request) + (request.max_tokens or self.config()["default_completion_tokens"])
+    
+    async def acquire(self, provider: str, model_id: str, tokens: int, spill: bool):
+        """Wait for capacity; raises RateLimited instead if spilling or the wait is too long"""
+        cfg = self.config()
+        limits = self._limits(provider, model_id, cfg)
+        if not limits and model_id not in self.blocked_until:
+            return
+        lock = self.locks.setdefault(model_id, asyncio.Lock())
+        wait = self._wait_time(model_id, limits, tokens)
+        if wait <= 0 and not lock.locked():
+            self._take(limits, tokens)
+            return
+        if spill and cfg["spill_over"]:
+            self._count("spilled", model_id)
+            raise RateLimited(model_id, wait)
+        max_wait = cfg["max_wait_ms"] / 1000
+        if self.depth[model_id] >= cfg["max_queue"] or wait > max_wait:
+            self._count("rejected", model_id)
+            raise RateLimited(model_id, wait)
+        
+        start = time.monotonic()
+        deadline = start + max_wait
+        self.depth[model_id] += 1
+        try:
+            await asyncio.wait_for(lock.acquire(), timeout=max_wait)
+            try:
+                while (wait := self._wait_time(model_id, limits, tokens)) > 0:
+                    if time.monotonic() + wait > deadline:
+                        self._count("rejected", model_id)
+                        raise RateLimited(model_id, wait)
+                    await asyncio.sleep(wait)
+                self._take(limits, tokens)
+            finally:
+                lock.release()
+        except asyncio.TimeoutError:
+            self._count("rejected", model_id)
+            raise RateLimited(model_id, self._wait_time(model_id, limits, tokens))
+        finally:
+            self.depth[model_id] -= 1
+        waited = time.monotonic() - start
+        self.stats["waited"] += 1
+        self.stats["wait_ms_total"] += waited * 1000
+        prom_rate_limit_wait.observe(waited, provider)
+    
+    def _count(self, outcome: str, model_id: str):
+        self.stats[outcome] += 1
+        prom_rate_limited.inc(model_id, outcome)
+    
+    def _take(self, limits: List[Tuple[TokenBucket, str]], tokens: int):
+        for bucket, unit in limits:
+            bucket.take(1 if unit == "rpm" else tokens)
+        self.stats["admitted"] += 1
+    
+    def settle(self, provider: str, model_id: str, reserved: int, used: Optional[int]):
+        """Correct the token buckets once the real usage is known"""
+        if not used:
+            return
+        for scope, name in (("providers", provider), ("models", model_id)):
+            bucket = self.buckets.get((scope, name, "tpm"))
+            if bucket is not None:
+                bucket.tokens -= used - reserved
+    
+    def upstream_limited(self, model_id: str, retry_after: Optional[str]) -> float:
+        """Pause a model after a 429; returns the delay in seconds"""
+        delay = parse_retry_after(retry_after)
+        if delay is None:
+            delay = self.config()["default_retry_after_sec"]
+        self.blocked_until[model_id] = max(self.blocked_until.get(model_id, 0.0), time.monotonic() + delay)
+        self._count("upstream_429", model_id)
+        return delay
+    
+    def get_stats(self) -> Dict:
+        now = time.monotonic()
+        for model_id in [m for m, t in self.blocked_until.items() if t <= now]:
+            del self.blocked_until[model_id]
+        return {
+            **self.stats,
+            "wait_ms_total": round(self.stats["wait_ms_total"], 1),
+            "avg_wait_ms": round(self.stats["wait_ms_total"] / self.stats["waited"], 1) if self.stats["waited"] else 0,
+            "queue_depth": {m: d for m, d in self.depth.items() if d},
+            "blocked_sec": {m: round(t - now, 1) for m, t in self.blocked_until.items()},
+            "buckets": {f"{scope}/{name}/{unit}": round(max(b.tokens, 0.0), 1)
+                        for (scope, name, unit), b in self.buckets.items()},
+            "config": {k: v for k, v in self.config().items() if k not in ("providers", "models")}
+        }
+
+rate_limiter = RateLimiter()
+
+# =============================================================================
+# MODEL CALLING
+# =============================================================================
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    orjson = None
+    ORJSON_AVAILABLE = False
+
+def json_dumps(data: Any, sort_keys: bool = False) -> bytes:
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys).encode("utf-8")
+
+def json_loads(data: Any) -> Any:
+    return orjson.loads(data) if ORJSON_AVAILABLE else json.loads(data)
+
+USAGE_KEY_RE = re.compile(rb'"usage"\s*:\s*')
+
+class UpstreamResponse:
+    """Upstream JSON body kept as bytes, so it can be returned to the client untouched.
+    
+    Only the "usage" object is parsed, from the end of the body where providers put
+    it; the full document is decoded lazily if something needs it.
+    """
+    
+    __slots__ = ("body", "_usage", "_data")
+    
+    def __init__(self, body: bytes):
+        self.body = body
+        self._usage = None
+        self._data = None
+    
+    @classmethod
+    def from_data(cls, data: Dict) -> "UpstreamResponse":
+        """Response translated from a native API: encoded once, usage already known"""
+        result = cls(json_dumps(data))
+        result._data = data
+        result._usage = data.get("usage") or {}
+        return result
+    
+    def json(self) -> Dict:
+        if self._data is None:
+            self._data = json_loads(self.body)
+        return self._data
+    
+    @property
+    def usage(self) -> Dict:
+        if self._usage is None:
+            self._usage = self._parse_usage()
+        return self._usage
+    
+    def _parse_usage(self) -> Dict:
+        index = self.body.rfind(b'"usage"')
+        match = USAGE_KEY_RE.match(self.body, index) if index >= 0 else None
+        if match is None:
+            return {}
+        try:
+            usage, _ = json.JSONDecoder().raw_decode(self.body[match.end():].decode("utf-8"))
+        except ValueError:
+            usage = self.json().get("usage")
+        return usage if isinstance(usage, dict) else {}
+
+def upstream_messages(request: ChatCompletionRequest) -> List[Dict]:
+    """Messages for the upstream payload, as the client sent them; built once per request"""
+    if request._raw_messages is None:
+        request._raw_messages = [msg.model_dump(exclude_unset=True) for msg in request.messages]
+    return request._raw_messages
+
+def build_upstream_request(model_id: str, request: ChatCompletionRequest, stream: bool = False) -> Tuple[str, str, str, Dict, Dict]:
+    """Build (provider, model_name, url, headers, payload) for a provider call"""
+    provider, model_name = parse_model_id(model_id)
+    prov_config = PROVIDERS.get(provider)
+    
+    if not prov_config:
+        raise ValueError(f"Unknown provider: {provider}")
+    
+    if not prov_config.get("api_key") and provider != "ollama":
+        raise ValueError(f"No API key configured for provider: {provider}")
+    
+    headers = provider_headers(provider, prov_config)
+    url, payload = adapter_for(provider).build(prov_config, model_name, request, stream)
+    return provider, model_name, url, headers, payload
+
+def provider_headers(provider: str, prov_config: Dict) -> Dict[str, str]:
+    """Auth, attribution and API version headers of a provider call"""
+    headers = {"Content-Type": "application/json"}
+    if prov_config.get("api_key") and prov_config.get("auth_header"):
+        headers[prov_config["auth_header"]] = prov_config["auth_prefix"] + prov_config["api_key"]
+    
+    # Add attribution headers for OpenRouter
+    if provider == "openrouter":
+        headers["HTTP-Referer"] = ROUTER_URL
+        headers["X-Title"] = ROUTER_NAME
+    
+    headers.update(adapter_for(provider).headers)
+    return headers
+
+# Per-provider concurrency slots of the batch being run; None for interactive requests
+provider_slots: contextvars.ContextVar = contextvars.ContextVar("provider_slots", default=None)
+
+async def call_model(model_id: str, request: ChatCompletionRequest, spill: bool = False) -> Tuple[UpstreamResponse, str]:
+    """Call a model via the appropriate provider. Returns (response, provider_name)"""
+    slots = provider_slots.get()
+    if slots is None:
+        return await send_model_request(model_id, request, spill)
+    async with slots.get(parse_model_id(model_id)[0]):
+        return await send_model_request(model_id, request, spill)
+
+async def send_model_request(model_id: str, request: ChatCompletionRequest, spill: bool) -> Tuple[UpstreamResponse, str]:
+    provider, model_name, url, headers, payload = build_upstream_request(model_id, request)
+    reserved = rate_limiter.reserve_tokens(request)
+    await rate_limiter.acquire(provider, model_id, reserved, spill)
+    
+    client = provider_pools.get(provider)
+    adapter = adapter_for(provider)
+    response = await client.post(url, headers=headers, content=json_dumps(payload))
+    if response.status_code == 429:
+        raise RateLimited(model_id, rate_limiter.upstream_limited(model_id, response.headers.get("retry-after")), True)
+    if response.status_code >= 400:
+        adapter.failed(payload, response.status_code)
+    response.raise_for_status()
+    if response.content.lstrip()[:1] != b"{":
+        raise ValueError(f"Invalid JSON response from {model_id}")
+    result = adapter.response(response.content, model_name)
+    rate_limiter.settle(provider, model_id, reserved, result.usage.get("total_tokens"))
+    return result, provider
+
+# =============================================================================
+# STREAMING
+# =============================================================================
+
+def sse_event(data: Any) -> bytes:
+    if isinstance(data, str):
+        return f"data: {data}\n\n".encode("utf-8")
+    return b"data: " + json_dumps(data) + b"\n\n"
+
+class StreamStats:
+    """Usage collected while relaying a stream (final usage chunk or counted text)"""
+    
+    def __init__(self):
+        self.usage: Optional[Dict] = None
+        self.completion_chars = 0
+    
+    def observe(self, chunk: Dict):
+        if chunk.get("usage"):
+            self.usage = chunk["usage"]
+        for choice in chunk.get("choices") or []:
+            content = (choice.get("delta") or {}).get("content")
+            if isinstance(content, str):
+                self.completion_chars += len(content)
+
+async def iter_openai_stream(response: httpx.Response, stats: StreamStats):
+    """Relay OpenAI-style SSE events as they arrive"""
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            break
+        try:
+            stats.observe(json.loads(data))
+        except ValueError:
+            pass
+        yield f"data: {data}\n\n".encode("utf-8")
+    yield b"data: [DONE]\n\n"
+
+async def iter_ollama_stream(response: httpx.Response, model_name: str, stats: StreamStats):
+    """Translate Ollama NDJSON /api/chat chunks into OpenAI chat.completion.chunk events"""
+    chunk_id = f"chatcmpl-{int(time.time() * 1000)}"
+    created = int(time.time())
+    first = True
+    tool_count = 0
+    async for line in response.aiter_lines():
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError:
+            continue
+        if data.get("error"):
+            raise Exception(f"Ollama stream error: {data['error']}")
+        delta = {}
+        if first:
+            delta["role"] = "assistant"
+            first = False
+        content = (data.get("message") or {}).get("content")
+        if content:
+            delta["content"] = content
+        tool_calls = (data.get("message") or {}).get("tool_calls")
+        if tool_calls:
+            delta["tool_calls"] = [{"index": tool_count + i, "id": f"call_{os.urandom(12).hex()}", "type": "function",
+                                    "function": {"name": (c.get("function") or {}).get("name"),
+                                                 "arguments": json_dumps((c.get("function") or {}).get("arguments") or {}).decode("utf-8")}}
+                                   for i, c in enumerate(tool_calls)]
+            tool_count += len(tool_calls)
+        finish_reason = ("tool_calls" if tool_count else "stop") if data.get("done") else None
+        chunk = {
+            "id": chunk_id, "object": "chat.completion.chunk", "created": created, "model": model_name,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+        if data.get("done"):
+            prompt_tokens = data.get("prompt_eval_count", 0)
+            completion_tokens = data.get("eval_count", 0)
+            chunk["usage"] = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                              "total_tokens": prompt_tokens + completion_tokens}
+        stats.observe(chunk)
+        yield sse_event(chunk)
+        if data.get("done"):
+            break
+    yield b"data: [DONE]\n\n"
+
+async def open_model_stream(model_id: str, request: ChatCompletionRequest, stats: StreamStats, spill: bool = False):
+    """Open an upstream stream and wait for its first chunk.
+    
+    Returns (first_chunk, chunk_iterator, response, provider). Raises before any byte
+    has been sent to the client, so the caller can still fall back to the next model.
+    """
+    provider, model_name, url, headers, payload = build_upstream_request(model_id, request, stream=True)
+    await rate_limiter.acquire(provider, model_id, rate_limiter.reserve_tokens(request), spill)
+    client = provider_pools.get(provider)
+    response = await client.send(client.build_request("POST", url, headers=headers, content=json_dumps(payload)), stream=True)
+    try:
+        if response.status_code == 429:
+            raise RateLimited(model_id, rate_limiter.upstream_limited(model_id, response.headers.get("retry-after")), True)
+        adapter = adapter_for(provider)
+        if response.status_code >= 400:
+            adapter.failed(payload, response.status_code)
+            await response.aread()
+            response.raise_for_status()
+        chunks = adapter.stream(response, model_name, stats)
+        first_chunk = await chunks.__anext__()
+    except BaseException:
+        await response.aclose()
+        raise
+    return first_chunk, chunks, response, provider
+
+async def stream_chat_completion(request: ChatCompletionRequest, category: str, routing_mode: str,
+                                 models_to_try: List[str], start_time: float,
+                                 session_key: Optional[str] = None) -> StreamingResponse:
+    last_error = None
+    last_model_tried = None
+    attempts = 0
+    retry_after = None
+    only_rate_limited = True
+    
+    for position, model_id in enumerate(models_to_try):
+        if not circuit_breaker.is_available(model_id):
+            print(f"Skipping {model_id} - circuit open")
+            continue
+        
+        last_model_tried = model_id
+        attempts += 1
+        stats = StreamStats()
+        
+        try:
+            opened_at = time.time()
+            spill = position < len(models_to_try) - 1
+            first_chunk, chunks, response, provider = await open_model_stream(model_id, request, stats, spill)
+            first_chunk_ms = (time.time() - opened_at) * 1000
+        except RateLimited as e:
+            last_error = str(e)
+            retry_after = min(retry_after or e.retry_after, e.retry_after)
+            circuit_breaker.release(model_id)
+            continue
+        except Exception as e:
+            last_error = str(e)
+            only_rate_limited = False
+            record_outcome(model_id, None, False)
+            circuit_breaker.record_failure(model_id)
+            continue
+        
+        async def relay(model_id=model_id, first_chunk=first_chunk, chunks=chunks, response=response,
+                        provider=provider, stats=stats, opened_at=opened_at, attempts=attempts,
+                        first_chunk_ms=first_chunk_ms):
+            error = None
+            aborted = False
+            try:
+                yield first_chunk
+                async for chunk in chunks:
+                    yield chunk
+            except Exception as e:
+                error = str(e)
+            except (asyncio.CancelledError, GeneratorExit):
+                # The client went away: says nothing about the model
+                aborted = True
+                error = "client closed the stream"
+                raise
+            finally:
+                # No await before the bookkeeping: after a disconnect the cancelled scope
+                # would cancel it, and nothing below would run
+                usage = stats.usage or {}
+                token_router.observe(model_id, provider, request, usage.get("prompt_tokens"))
+                prompt_tokens = usage.get("prompt_tokens") or token_router.prompt_tokens(model_id, request)
+                completion_tokens = usage.get("completion_tokens") or stats.completion_chars // 4
+                usage = {**usage, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+                cost = usage_cost(model_id, usage)
+                track_prompt_cache(model_id, usage)
+                rate_limiter.settle(provider, model_id, rate_limiter.reserve_tokens(request), prompt_tokens + completion_tokens)
+                latency_ms = (time.time() - start_time) * 1000
+                track_request(category, model_id, latency_ms, error is None, routing_mode, cost, provider, error,
+                              user=request.user, attempts=attempts, aborted=aborted)
+                annotate_access_log(model=model_id, provider=provider, attempts=attempts, error=error and error[:200],
+                                    cached_tokens=usage_tokens(usage)[2] or None)
+                if aborted:
+                    circuit_breaker.release(model_id)
+                else:
+                    record_outcome(model_id, (time.time() - opened_at) * 1000, error is None)
+                    if error is None:
+                        prom_fallback_depth.inc(category, str(attempts))
+                        circuit_breaker.record_success(model_id, first_chunk_ms)
+                        session_affinity.succeeded(session_key, category, model_id)
+                    else:
+                        circuit_breaker.record_failure(model_id)
+                with anyio.CancelScope(shield=True):
+                    await response.aclose()
+        
+        return StreamingResponse(relay(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    
+    latency_ms = (time.time() - start_time) * 1000
+    track_request(category, last_model_tried or "unknown", latency_ms, False, routing_mode, 0, None, last_error,
+                  user=request.user)
+    annotate_access_log(model=last_model_tried, error=(last_error or "")[:200])
+    
+    if retry_after is not None and only_rate_limited:
+        raise HTTPException(429, f"All models are rate limited. Last error: {last_error}",
+                            headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+    raise HTTPException(500, f"All models failed. Last error: {last_error}")
+
+# =============================================================================
+# PROVIDER ADAPTERS
+# =============================================================================
+
+# Requests are built from the OpenAI chat format and responses / stream chunks are
+# returned in it, whatever the provider's native API. PROVIDERS[...]["api"] picks the
+# adapter: "openai" passes through, the others translate.
+
+PROMPT_CACHE_DEFAULTS = {
+    "enabled": True,
+    "min_tokens": 1024,          # Smallest prefix worth an Anthropic cache breakpoint
+    "anthropic_ttl": "5m",       # 5m | 1h
+    "cache_messages": True,      # Also mark the conversation so far, for agent loops
+    "gemini": True,              # Explicit Gemini context caches for system + tools
+    "gemini_min_tokens": 4096,
+    "gemini_min_hits": 2,        # Sightings of a prefix before a context cache is created
+    "gemini_ttl_sec": 3600,
+}
+
+def prompt_cache_settings() -> Dict:
+    return {**PROMPT_CACHE_DEFAULTS, **prompt_cache_config}
+
+def completion_id() -> str:
+    return f"chatcmpl-{int(time.time() * 1000)}"
+
+def tool_arguments(arguments: Any) -> Dict:
+    """Tool call arguments as an object (OpenAI sends a JSON string)"""
+    if isinstance(arguments, dict):
+        return arguments
+    try:
+        value = json_loads(arguments or "{}")
+    except ValueError:
+        return {}
+    return value if isinstance(value, dict) else {}
+
+def image_url_of(part: Dict) -> str:
+    image = part.get("image_url")
+    return image.get("url", "") if isinstance(image, dict) else (image or "")
+
+def split_data_url(url: str) -> Tuple[str, str]:
+    """(media_type, base64 data) of a data: URL"""
+    header, _, data = url.partition(",")
+    return header[5:].split(";")[0] or "application/octet-stream", data
+
+def completion_message(text: str, tool_calls: List[Dict]) -> Dict:
+    message = {"role": "assistant", "content": text if text or not tool_calls else None}
+    if tool_calls:
+        message["tool_calls"] = tool_calls
+    return message
+
+def completion_body(chunk_id: str, model_name: str, message: Dict, finish_reason: str, usage: Dict) -> Dict:
+    return {
+        "id": chunk_id, "object": "chat.completion", "created": int(time.time()), "model": model_name,
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+        "usage": usage
+    }
+
+def openai_usage(prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0, cache_write_tokens: int = 0) -> Dict:
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+             "total_tokens": prompt_tokens + completion_tokens}
+    if cached_tokens or cache_write_tokens:
+        usage["prompt_tokens_details"] = {"cached_tokens": cached_tokens, "cache_write_tokens": cache_write_tokens}
+    return usage
+
+class ChunkWriter:
+    """Builds the chat.completion.chunk events of one translated stream"""
+    
+    def __init__(self, model_name: str, stats: StreamStats):
+        self.id = completion_id()
+        self.created = int(time.time())
+        self.model_name = model_name
+        self.stats = stats
+        self.started = False
+    
+    def event(self, delta: Dict, finish_reason: Optional[str] = None, usage: Optional[Dict] = None) -> bytes:
+        if not self.started:
+            delta = {"role": "assistant", **delta}
+            self.started = True
+        chunk = {
+            "id": self.id, "object": "chat.completion.chunk", "created": self.created, "model": self.model_name,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+        if usage:
+            chunk["usage"] = usage
+        self.stats.observe(chunk)
+        return sse_event(chunk)
+
+class ProviderAdapter:
+    """OpenAI-compatible API: /chat/completions, bodies passed through untouched"""
+    
+    headers: Dict[str, str] = {}
+    
+    def build(self, prov_config: Dict, model_name: str, request: ChatCompletionRequest, stream: bool) -> Tuple[str, Dict]:
+        payload = {
+            "model": prov_config.get("models_prefix", "") + model_name,
+            "messages": upstream_messages(request),
+            "temperature": request.temperature,
+            "max_tokens": request.max_tokens,
+            "stop": request.stop,
+            "tools": request.tools,
+            "tool_choice": request.tool_choice
+        }
+        payload = {k: v for k, v in payload.items() if v is not None}
+        if stream:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
+        return f"{prov_config['base_url']}/chat/completions", payload
+    
+    def response(self, body: bytes, model_name: str) -> UpstreamResponse:
+        return UpstreamResponse(body)
+    
+    def stream(self, response: httpx.Response, model_name: str, stats: StreamStats):
+        return iter_openai_stream(response, stats)
+    
+    def failed(self, payload: Dict, status_code: int):
+        """Upstream answered an error status (before raise_for_status)"""
+
+class OllamaAdapter(ProviderAdapter):
+    """Ollama /api/chat: JSON or NDJSON stream"""
+    
+    def build(self, prov_config: Dict, model_name: str, request: ChatCompletionRequest, stream: bool) -> Tuple[str, Dict]:
+        messages = upstream_messages(request)
+        if any(m.get("tool_calls") for m in messages):
+            # Ollama wants tool call arguments as objects
+            messages = [{**m, "tool_calls": [{"function": {"name": (c.get("function") or {}).get("name"),
+                                                          "arguments": tool_arguments((c.get("function") or {}).get("arguments"))}}
+                                             for c in m["tool_calls"]]}
+                        if m.get("tool_calls") else m for m in messages]
+        payload = {
+            "model": model_name,
+            "messages": messages,
+            "stream": stream,
+            "options": {"temperature": 1.0 if request.temperature is None else request.temperature}
+        }
+        if request.max_tokens:
+            payload["options"]["num_predict"] = request.max_tokens
+        if request.stop:
+            payload["options"]["stop"] = request.stop
+        if request.tools:
+            payload["tools"] = request.tools
+        return f"{prov_config['base_url']}/api/chat", payload
+    
+    def response(self, body: bytes, model_name: str) -> UpstreamResponse:
+        data = json_loads(body)
+        message = data.get("message") or {}
+        tool_calls = [{"id": f"call_{os.urandom(12).hex()}", "type": "function",
+                       "function": {"name": (c.get("function") or {}).get("name"),
+                                    "arguments": json_dumps((c.get("function") or {}).get("arguments") or {}).decode("utf-8")}}
+                      for c in message.get("tool_calls") or []]
+        finish_reason = "tool_calls" if tool_calls else ("length" if data.get("done_reason") == "length" else "stop")
+        usage = openai_usage(data.get("prompt_eval_count", 0), data.get("eval_count", 0))
+        return UpstreamResponse.from_data(completion_body(
+            completion_id(), data.get("model", model_name), completion_message(message.get("content", ""), tool_calls),
+            finish_reason, usage))
+    
+    def stream(self, response: httpx.Response, model_name: str, stats: StreamStats):
+        return iter_ollama_stream(response, model_name, stats)
+
+ANTHROPIC_FINISH_REASONS = {"end_turn": "stop", "stop_sequence": "stop", "max_tokens": "length",
+                            "tool_use": "tool_calls", "refusal": "content_filter"}
+
+def anthropic_content(content: Any) -> List[Dict]:
+    if isinstance(content, str):
+        return [{"type": "text", "text": content}] if content else []
+    blocks = []
+    for part in content or []:
+        if not isinstance(part, dict):
+            continue
+        if part.get("type") == "text" and part.get("text"):
+            blocks.append({"type": "text", "text": part["text"]})
+        elif part.get("type") == "image_url":
+            url = image_url_of(part)
+            if url.startswith("data:"):
+                media_type, data = split_data_url(url)
+                source = {"type": "base64", "media_type": media_type, "data": data}
+            else:
+                source = {"type": "url", "url": url}
+            blocks.append({"type": "image", "source": source})
+    return blocks
+
+def anthropic_messages(messages: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+    """(system blocks, messages) in Messages API format"""
+    system = []
+    result = []
+    
+    def append(role: str, blocks: List[Dict]):
+        # Consecutive turns of a role are merged: parallel tool results must share one user turn
+        if not blocks:
+            return
+        if result and result[-1]["role"] == role:
+            result[-1]["content"] += blocks
+        else:
+            result.append({"role": role, "content": blocks})
+    
+    for message in messages:
+        role = message.get("role")
+        content = message.get("content")
+        if role in ("system", "developer"):
+            system += anthropic_content(content)
+            continue
+        if role == "tool":
+            append("user", [{"type": "tool_result", "tool_use_id": message.get("tool_call_id", ""),
+                             "content": anthropic_content(content) if isinstance(content, list) else (content or "")}])
+            continue
+        blocks = anthropic_content(content)
+        if role == "assistant":
+            for call in message.get("tool_calls") or []:
+                function = call.get("function") or {}
+                blocks.append({"type": "tool_use", "id": call.get("id", ""), "name": function.get("name", ""),
+                               "input": tool_arguments(function.get("arguments"))})
+        append("assistant" if role == "assistant" else "user", blocks)
+    return system, result
+
+def anthropic_tool_choice(tool_choice: Any) -> Optional[Dict]:
+    if tool_choice in ("auto", "none"):
+        return {"type": tool_choice}
+    if tool_choice == "required":
+        return {"type": "any"}
+    if isinstance(tool_choice, dict) and tool_choice.get("function"):
+        return {"type": "tool", "name": tool_choice["function"].get("name", "")}
+    return None
+
+def anthropic_usage(usage: Dict) -> Dict:
+    cache_read = usage.get("cache_read_input_tokens") or 0
+    cache_write = usage.get("cache_creation_input_tokens") or 0
+    prompt_tokens = (usage.get("input_tokens") or 0) + cache_read + cache_write
+    return openai_usage(prompt_tokens, usage.get("output_tokens") or 0, cache_read, cache_write)
+
+class AnthropicAdapter(ProviderAdapter):
+    """Anthropic Messages API, with cache_control breakpoints on long stable prefixes.
+    
+    Breakpoints go after the tools and system prompt, and after the last message so the
+    next turn of an agent loop reads the whole conversation from cache. Prefixes under
+    min_tokens are left unmarked: the provider would not cache them anyway.
+    """
+    
+    headers = {"anthropic-version": "2023-06-01"}
+    
+    def build(self, prov_config: Dict, model_name: str, request: ChatCompletionRequest, stream: bool) -> Tuple[str, Dict]:
+        system, messages = anthropic_messages(upstream_messages(request))
+        max_output = token_router.metadata(f"anthropic/{model_name}").get("max_output", 4096)
+        payload = {"model": model_name, "messages": messages, "max_tokens": request.max_tokens or min(4096, max_output)}
+        if system:
+            payload["system"] = system
+        if request.temperature is not None:
+            payload["temperature"] = min(request.temperature, 1.0)
+        if request.stop:
+            payload["stop_sequences"] = request.stop
+        if request.tools:
+            payload["tools"] = [{"name": t["function"]["name"], "description": t["function"].get("description", ""),
+                                 "input_schema": t["function"].get("parameters") or {"type": "object", "properties": {}}}
+                                for t in request.tools if t.get("function")]
+            tool_choice = anthropic_tool_choice(request.tool_choice)
+            if tool_choice:
+                payload["tool_choice"] = tool_choice
+        if stream:
+            payload["stream"] = True
+        self.mark_cache(payload, request)
+        return f"{prov_config['base_url']}/messages", payload
+    
+    def mark_cache(self, payload: Dict, request: ChatCompletionRequest):
+        cfg = prompt_cache_settings()
+        if not cfg["enabled"]:
+            return
+        marker = {"type": "ephemeral"}
+        if cfg["anthropic_ttl"] != "5m":
+            marker["ttl"] = cfg["anthropic_ttl"]
+        prefix_tokens = sum(estimate_tokens(b["text"]) for b in payload.get("system", []) if b["type"] == "text")
+        if payload.get("tools"):
+            prefix_tokens += round(len(json_dumps(payload["tools"])) / CHARS_PER_TOKEN)
+        if prefix_tokens >= cfg["min_tokens"]:
+            last = payload["system"][-1] if payload.get("system") else payload["tools"][-1]
+            last["cache_control"] = marker
+        if cfg["cache_messages"] and payload["messages"] and estimate_prompt_tokens(request) >= cfg["min_tokens"]:
+            payload["messages"][-1]["content"][-1]["cache_control"] = marker
+    
+    def response(self, body: bytes, model_name: str) -> UpstreamResponse:
+        data = json_loads(body)
+        text = []
+        tool_calls = []
+        for block in data.get("content") or []:
+            if block.get("type") == "text":
+                text.append(block.get("text", ""))
+            elif block.get("type") == "tool_use":
+                tool_calls.append({"id": block.get("id"), "type": "function",
+                                   "function": {"name": block.get("name"),
+                                                "arguments": json_dumps(block.get("input") or {}).decode("utf-8")}})
+        return UpstreamResponse.from_data(completion_body(
+            data.get("id") or completion_id(), data.get("model", model_name), completion_message("".join(text), tool_calls),
+            ANTHROPIC_FINISH_REASONS.get(data.get("stop_reason"), "stop"), anthropic_usage(data.get("usage") or {})))
+    
+    def stream(self, response: httpx.Response, model_name: str, stats: StreamStats):
+        return iter_anthropic_stream(response, model_name, stats)
+
+async def iter_anthropic_stream(response: httpx.Response, model_name: str, stats: StreamStats):
+    """Translate Messages API SSE events into OpenAI chat.completion.chunk events"""
+    writer = ChunkWriter(model_name, stats)
+    usage: Dict = {}
+    tool_positions: Dict[int, int] = {}  # Content block index -> tool_calls index
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        try:
+            event = json_loads(line[5:])
+        except ValueError:
+            continue
+        kind = event.get("type")
+        if kind == "message_start":
+            usage.update(event.get("message", {}).get("usage") or {})
+            yield writer.event({"content": ""})
+        elif kind == "content_block_start":
+            block = event.get("content_block") or {}
+            if block.get("type") == "tool_use":
+                position = tool_positions[event.get("index", 0)] = len(tool_positions)
+                yield writer.event({"tool_calls": [{"index": position, "id": block.get("id"), "type": "function",
+                                                    "function": {"name": block.get("name"), "arguments": ""}}]})
+        elif kind == "content_block_delta":
+            delta = event.get("delta") or {}
+            if delta.get("type") == "text_delta":
+                yield writer.event({"content": delta.get("text", "")})
+            elif delta.get("type") == "input_json_delta" and event.get("index", 0) in tool_positions:
+                yield writer.event({"tool_calls": [{"index": tool_positions[event.get("index", 0)],
+                                                    "function": {"arguments": delta.get("partial_json", "")}}]})
+        elif kind == "message_delta":
+            usage.update(event.get("usage") or {})
+            finish_reason = ANTHROPIC_FINISH_REASONS.get((event.get("delta") or {}).get("stop_reason"), "stop")
+            yield writer.event({}, finish_reason, anthropic_usage(usage))
+        elif kind == "message_stop":
+            break
+        elif kind == "error":
+            raise Exception(f"Anthropic stream error: {event.get('error')}")
+    yield b"data: [DONE]\n\n"
+
+GEMINI_FINISH_REASONS = {"STOP": "stop", "MAX_TOKENS": "length"}
+GEMINI_SCHEMA_DROP = ("additionalProperties", "$schema", "strict")
 
-def parse_model_id(model_id: str) -> Tuple[str, str]:
-    """Parse 'provider/model' or 'model' (default provider)"""
-    if "/" in model_id:
-        parts = model_id.split("/", 1)
-        return parts[0], parts[1]
-    return DEFAULT_PROVIDER, model_id
+def gemini_schema(schema: Any) -> Any:
+    """JSON schema without the keywords generateContent rejects"""
+    if isinstance(schema, dict):
+        return {k: gemini_schema(v) for k, v in schema.items() if k not in GEMINI_SCHEMA_DROP}
+    if isinstance(schema, list):
+        return [gemini_schema(v) for v in schema]
+    return schema
 
-def detect_category_keywords(message: str) -> str:
-    message_lower = message.lower()
-    for cat_name, cat_config in custom_categories.items():
-        for keyword in cat_config.get("keywords", []):
-            if keyword.lower() in message_lower:
-                return cat_name
-    for category, keywords in category_keywords.items():
-        for keyword in keywords:
-            if keyword.lower() in message_lower:
-                return category
-    return "conversation"
-
-async def route_with_ollama(message: str) -> Tuple[str, str]:
-    categories = list(model_mappings.keys())
-    prompt = ROUTER_PROMPT.format(categories=", ".join(categories))
+def gemini_parts(content: Any) -> List[Dict]:
+    if isinstance(content, str):
+        return [{"text": content}] if content else []
+    parts = []
+    for part in content or []:
+        if not isinstance(part, dict):
+            continue
+        if part.get("type") == "text" and part.get("text"):
+            parts.append({"text": part["text"]})
+        elif part.get("type") == "image_url":
+            url = image_url_of(part)
+            if url.startswith("data:"):
+                media_type, data = split_data_url(url)
+                parts.append({"inlineData": {"mimeType": media_type, "data": data}})
+            else:
+                parts.append({"fileData": {"mimeType": mimetypes.guess_type(url)[0] or "image/jpeg", "fileUri": url}})
+    return parts
+
+def gemini_contents(messages: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+    """(systemInstruction parts, contents) in generateContent format"""
+    system = []
+    contents = []
+    tool_names: Dict[str, str] = {}  # tool_call_id -> function name, for functionResponse
+    
+    def append(role: str, parts: List[Dict]):
+        if not parts:
+            return
+        if contents and contents[-1]["role"] == role:
+            contents[-1]["parts"] += parts
+        else:
+            contents.append({"role": role, "parts": parts})
+    
+    for message in messages:
+        role = message.get("role")
+        content = message.get("content")
+        if role in ("system", "developer"):
+            system += gemini_parts(content)
+        elif role == "assistant":
+            parts = gemini_parts(content)
+            for call in message.get("tool_calls") or []:
+                function = call.get("function") or {}
+                tool_names[call.get("id", "")] = function.get("name", "")
+                parts.append({"functionCall": {"name": function.get("name", ""),
+                                               "args": tool_arguments(function.get("arguments"))}})
+            append("model", parts)
+        elif role == "tool":
+            text = message_text(content)
+            try:
+                result = json_loads(text)
+            except ValueError:
+                result = text
+            name = message.get("name") or tool_names.get(message.get("tool_call_id", ""), "")
+            append("user", [{"functionResponse": {"name": name,
+                                                  "response": result if isinstance(result, dict) else {"content": result}}}])
+        else:
+            append("user", gemini_parts(content))
+    return system, contents
+
+def gemini_tool_config(tool_choice: Any) -> Optional[Dict]:
+    if tool_choice == "none":
+        return {"functionCallingConfig": {"mode": "NONE"}}
+    if tool_choice == "auto":
+        return {"functionCallingConfig": {"mode": "AUTO"}}
+    if tool_choice == "required":
+        return {"functionCallingConfig": {"mode": "ANY"}}
+    if isinstance(tool_choice, dict) and tool_choice.get("function"):
+        return {"functionCallingConfig": {"mode": "ANY", "allowedFunctionNames": [tool_choice["function"].get("name", "")]}}
+    return None
+
+def gemini_usage(usage: Dict) -> Dict:
+    completion_tokens = (usage.get("candidatesTokenCount") or 0) + (usage.get("thoughtsTokenCount") or 0)
+    return openai_usage(usage.get("promptTokenCount") or 0, completion_tokens, usage.get("cachedContentTokenCount") or 0)
+
+def gemini_output(data: Dict) -> Tuple[str, List[Dict], Optional[str]]:
+    """(text, tool_calls, raw finishReason) of the first candidate"""
+    candidate = (data.get("candidates") or [{}])[0]
+    text = []
+    tool_calls = []
+    for part in (candidate.get("content") or {}).get("parts") or []:
+        if "text" in part and not part.get("thought"):
+            text.append(part["text"])
+        elif "functionCall" in part:
+            call = part["functionCall"]
+            tool_calls.append({"id": f"call_{os.urandom(12).hex()}", "type": "function",
+                               "function": {"name": call.get("name"),
+                                            "arguments": json_dumps(call.get("args") or {}).decode("utf-8")}})
+    return "".join(text), tool_calls, candidate.get("finishReason")
+
+def gemini_finish_reason(reason: Optional[str], has_tool_calls: bool) -> str:
+    if has_tool_calls:
+        return "tool_calls"
+    return GEMINI_FINISH_REASONS.get(reason, "content_filter") if reason else "stop"
+
+class GeminiContextCache:
+    """Explicit Gemini context caches (cachedContents) for system instruction + tools.
+    
+    A prefix gets a cache from its gemini_min_hits-th sighting, created in the
+    background: the request that triggers it is sent whole, later ones reference it.
+    Failed creations are remembered for a TTL so they are not retried on every call.
+    """
     
-    async with httpx.AsyncClient(timeout=15.0) as client:
+    def __init__(self):
+        self.entries: Dict[str, Tuple[Optional[str], float]] = {}  # key -> (cache name, expires at)
+        self.sightings: OrderedDict = OrderedDict()
+        self.tasks: set = set()
+        self.stats = {"created": 0, "used": 0, "errors": 0, "invalidated": 0}
+    
+    def lookup(self, prov_config: Dict, model_name: str, prefix: Dict, cfg: Dict) -> Optional[str]:
+        key = hashlib.sha256(json_dumps([model_name, prefix], sort_keys=True)).hexdigest()[:32]
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            name, expires_at = entry
+            if expires_at > now + 30:  # Never reference a cache about to expire in flight
+                if name:
+                    self.stats["used"] += 1
+                return name
+            del self.entries[key]
+        seen = self.sightings.pop(key, 0) + 1
+        self.sightings[key] = seen
+        while len(self.sightings) > 1024:
+            self.sightings.popitem(last=False)
+        if seen >= cfg["gemini_min_hits"] and not any(t.get_name() == key for t in self.tasks):
+            task = asyncio.get_running_loop().create_task(
+                self.create(key, prov_config, model_name, prefix, cfg["gemini_ttl_sec"]), name=key)
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return None
+    
+    async def create(self, key: str, prov_config: Dict, model_name: str, prefix: Dict, ttl: float):
+        body = {"model": f"models/{model_name}", **prefix, "ttl": f"{int(ttl)}s"}
+        headers = provider_headers("google", prov_config)
         try:
-            response = await client.post(
-                f"{PROVIDERS['ollama']['base_url']}/api/generate",
-                json={"model": OLLAMA_ROUTER_MODEL, "prompt": prompt, "stream": False, "options": {"temperature": 0.1, "num_predict": 20}}
-            )
+            response = await provider_pools.get("google").post(f"{prov_config['base_url']}/cachedContents",
+                                                               headers=headers, content=json_dumps(body))
             response.raise_for_status()
-            category = response.json().get("response", "").strip().lower().split()[0]
-            if category in model_mappings:
-                return category, "ollama"
+            self.entries[key] = (response.json()["name"], time.time() + ttl)
+            self.stats["created"] += 1
         except Exception as e:
-            print(f"Ollama routing failed: {e}")
-    raise Exception("Ollama routing failed")
+            self.entries[key] = (None, time.time() + ttl)
+            self.stats["errors"] += 1
+            print(f"Gemini context cache creation failed for {model_name}: {e}")
+        now = time.time()
+        for stale in [k for k, (_, expires_at) in self.entries.items() if expires_at <= now]:
+            del self.entries[stale]
+    
+    def invalidate(self, name: str):
+        for key, (entry_name, _) in list(self.entries.items()):
+            if entry_name == name:
+                del self.entries[key]
+                self.stats["invalidated"] += 1
+    
+    def get_stats(self) -> Dict:
+        return {**self.stats, "active": sum(1 for name, _ in self.entries.values() if name)}
 
-async def route_with_api(message: str) -> Tuple[str, str]:
-    categories = list(model_mappings.keys())
-    prompt = ROUTER_PROMPT.format(categories=", ".join(categories))
+gemini_cache = GeminiContextCache()
+
+class GoogleAdapter(ProviderAdapter):
+    """Gemini generateContent / streamGenerateContent, with context caching of long
+    system instructions and tool declarations"""
     
-    provider, model = parse_model_id(ROUTER_API_MODEL)
-    prov_config = PROVIDERS.get(provider, PROVIDERS["openrouter"])
+    def build(self, prov_config: Dict, model_name: str, request: ChatCompletionRequest, stream: bool) -> Tuple[str, Dict]:
+        system, contents = gemini_contents(upstream_messages(request))
+        prefix = {}
+        if system:
+            prefix["systemInstruction"] = {"parts": system}
+        if request.tools:
+            declarations = []
+            for tool in request.tools:
+                function = tool.get("function")
+                if not function:
+                    continue
+                declaration = {"name": function["name"], "description": function.get("description", "")}
+                if (function.get("parameters") or {}).get("properties"):
+                    declaration["parameters"] = gemini_schema(function["parameters"])
+                declarations.append(declaration)
+            prefix["tools"] = [{"functionDeclarations": declarations}]
+            tool_config = gemini_tool_config(request.tool_choice)
+            if tool_config:
+                prefix["toolConfig"] = tool_config
+        
+        payload = {"contents": contents}
+        cfg = prompt_cache_settings()
+        cache_name = None
+        if cfg["enabled"] and cfg["gemini"] and prefix and \
+                len(json_dumps(prefix)) / CHARS_PER_TOKEN >= cfg["gemini_min_tokens"]:
+            cache_name = gemini_cache.lookup(prov_config, model_name, prefix, cfg)
+        if cache_name:
+            payload["cachedContent"] = cache_name
+        else:
+            payload.update(prefix)
+        
+        generation = {"temperature": request.temperature, "maxOutputTokens": request.max_tokens,
+                      "stopSequences": request.stop}
+        generation = {k: v for k, v in generation.items() if v is not None}
+        if generation:
+            payload["generationConfig"] = generation
+        method = "streamGenerateContent?alt=sse" if stream else "generateContent"
+        return f"{prov_config['base_url']}/{prov_config.get('models_prefix', '')}{model_name}:{method}", payload
     
-    async with httpx.AsyncClient(timeout=10.0) as client:
+    def response(self, body: bytes, model_name: str) -> UpstreamResponse:
+        data = json_loads(body)
+        text, tool_calls, reason = gemini_output(data)
+        return UpstreamResponse.from_data(completion_body(
+            data.get("responseId") or completion_id(), data.get("modelVersion", model_name),
+            completion_message(text, tool_calls), gemini_finish_reason(reason, bool(tool_calls)),
+            gemini_usage(data.get("usageMetadata") or {})))
+    
+    def stream(self, response: httpx.Response, model_name: str, stats: StreamStats):
+        return iter_gemini_stream(response, model_name, stats)
+    
+    def failed(self, payload: Dict, status_code: int):
+        # An expired or deleted context cache: the fallback chain retries, later calls send the prefix
+        if payload.get("cachedContent") and status_code in (400, 403, 404):
+            gemini_cache.invalidate(payload["cachedContent"])
+
+async def iter_gemini_stream(response: httpx.Response, model_name: str, stats: StreamStats):
+    """Translate streamGenerateContent SSE responses into OpenAI chat.completion.chunk events"""
+    writer = ChunkWriter(model_name, stats)
+    usage = None
+    reason = None
+    tool_count = 0
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
         try:
-            headers = {"Content-Type": "application/json"}
-            if prov_config.get("api_key"):
-                headers[prov_config["auth_header"]] = prov_config["auth_prefix"] + prov_config["api_key"]
+            data = json_loads(line[5:])
+        except ValueError:
+            continue
+        if data.get("error"):
+            raise Exception(f"Gemini stream error: {data['error']}")
+        if data.get("usageMetadata"):
+            usage = gemini_usage(data["usageMetadata"])
+        text, tool_calls, chunk_reason = gemini_output(data)
+        reason = chunk_reason or reason
+        delta = {}
+        if text:
+            delta["content"] = text
+        if tool_calls:
+            delta["tool_calls"] = [{"index": tool_count + i, **call} for i, call in enumerate(tool_calls)]
+            tool_count += len(tool_calls)
+        if delta or not writer.started:
+            yield writer.event(delta)
+    yield writer.event({}, gemini_finish_reason(reason, tool_count > 0), usage)
+    yield b"data: [DONE]\n\n"
+
+PROVIDER_ADAPTERS: Dict[str, ProviderAdapter] = {
+    "openai": ProviderAdapter(),
+    "anthropic": AnthropicAdapter(),
+    "google": GoogleAdapter(),
+    "ollama": OllamaAdapter(),
+}
+
+def adapter_for(provider: str) -> ProviderAdapter:
+    return PROVIDER_ADAPTERS[PROVIDERS[provider].get("api", "openai")]
+
+# =============================================================================
+# FALLBACK CHAIN & HEDGING
+# =============================================================================
+
+LATENCY_WINDOW = int(os.getenv("LATENCY_WINDOW", "200"))
+
+HEDGE_DEFAULTS = {
+    "enabled": False,
+    "percentile": 95,         # Primary latency percentile used as hedge delay
+    "min_delay_ms": 200,
+    "max_delay_ms": 10000,
+    "default_delay_ms": 2000,  # Until enough samples are collected
+    "min_samples": 20,
+    "max_hedges": 1,
+}
+
+class LatencyTracker:
+    """Sliding window of recent successful call latencies per model"""
+    
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.window = window
+        self.samples: Dict[str, deque] = {}
+    
+    def record(self, model: str, latency_ms: float):
+        samples = self.samples.get(model)
+        if samples is None:
+            samples = self.samples[model] = deque(maxlen=self.window)
+        samples.append(latency_ms)
+    
+    def percentile(self, model: str, pct: float, min_samples: int = 1) -> Optional[float]:
+        samples = self.samples.get(model)
+        if not samples or len(samples) < min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+latency_tracker = LatencyTracker()
+
+ADAPTIVE_DEFAULTS = {
+    "enabled": False,
+    "strategy": "score",     # score | p2c (power of two choices)
+    "alpha": 0.2,            # EWMA smoothing factor
+    "prior_weight": 0.5,     # Penalty per position in the configured chain
+    "error_penalty": 4.0,    # Score multiplier per unit of error rate
+    "cost_weight": 0.0,      # Penalty for relative output price within the chain
+    "default_latency_ms": 1000,
+    "explore_rate": 0.05,    # Share of requests that try the least-sampled model first
+}
+
+class AdaptiveSelector:
+    """Per-model EWMA latency and error rate, used to reorder a category chain.
+    
+    The configured order is kept as a prior: each position down the chain
+    multiplies the score by (1 + prior_weight). Lower score is better.
+    """
+    
+    def __init__(self):
+        self.latency_ewma: Dict[str, float] = {}
+        self.error_ewma: Dict[str, float] = {}
+        self.samples: Dict[str, int] = defaultdict(int)
+        self.decisions = {"reordered": 0, "kept": 0}
+    
+    def config(self) -> Dict:
+        return {**ADAPTIVE_DEFAULTS, **adaptive_config}
+    
+    def record(self, model: str, latency_ms: Optional[float], success: bool):
+        alpha = self.config()["alpha"]
+        self.samples[model] += 1
+        error = 0.0 if success else 1.0
+        self.error_ewma[model] = self.error_ewma.get(model, error) * (1 - alpha) + error * alpha
+        if success and latency_ms is not None:
+            previous = self.latency_ewma.get(model)
+            self.latency_ewma[model] = latency_ms if previous is None else previous * (1 - alpha) + latency_ms * alpha
+    
+    def score(self, model: str, position: int, cfg: Dict, max_price: float) -> float:
+        latency = self.latency_ewma.get(model, cfg["default_latency_ms"])
+        score = latency * (1 + cfg["error_penalty"] * self.error_ewma.get(model, 0.0))
+        score *= (1 + cfg["prior_weight"]) ** position
+        if cfg["cost_weight"] and max_price > 0:
+            score *= 1 + cfg["cost_weight"] * routing_table.model_costs.get(model, {}).get("output", 0) / max_price
+        return score
+    
+    def order(self, models: List[str]) -> List[str]:
+        cfg = self.config()
+        if not cfg["enabled"] or len(models) < 2:
+            return models
+        max_price = max(routing_table.model_costs.get(m, {}).get("output", 0) for m in models)
+        scores = {m: self.score(m, i, cfg, max_price) for i, m in enumerate(models)}
+        ordered = sorted(models, key=lambda m: scores[m])
+        if cfg["explore_rate"] and random.random() < cfg["explore_rate"]:
+            least = min(models, key=lambda m: self.samples.get(m, 0))
+            ordered = [least] + [m for m in ordered if m != least]
+        elif cfg["strategy"] == "p2c":
+            a, b = random.sample(models, 2)
+            first = a if scores[a] <= scores[b] else b
+            ordered = [first] + [m for m in ordered if m != first]
+        self.decisions["reordered" if ordered != list(models) else "kept"] += 1
+        return ordered
+    
+    def get_status(self) -> Dict:
+        cfg = self.config()
+        return {
+            "enabled": cfg["enabled"],
+            "strategy": cfg["strategy"],
+            "decisions": dict(self.decisions),
+            "models": {
+                m: {
+                    "latency_ewma_ms": round(self.latency_ewma[m], 2) if m in self.latency_ewma else None,
+                    "error_rate": round(self.error_ewma.get(m, 0.0), 4),
+                    "samples": self.samples[m],
+                    "score": round(self.score(m, 0, cfg, 0), 2)
+                }
+                for m in list(self.samples)
+            }
+        }
+
+adaptive_selector = AdaptiveSelector()
+
+def record_outcome(model_id: str, latency_ms: Optional[float], success: bool):
+    if success:
+        latency_tracker.record(model_id, latency_ms)
+        prom_upstream_latency.observe(latency_ms / 1000, model_id, parse_model_id(model_id)[0])
+    adaptive_selector.record(model_id, latency_ms, success)
+
+def get_hedge_config(category: str) -> Optional[Dict]:
+    cfg = hedging_config.get(category)
+    if not cfg or not cfg.get("enabled"):
+        return None
+    return {**HEDGE_DEFAULTS, **cfg}
+
+def hedge_delay_sec(model_id: str, cfg: Dict) -> float:
+    delay_ms = latency_tracker.percentile(model_id, cfg["percentile"], cfg["min_samples"])
+    if delay_ms is None:
+        delay_ms = cfg["default_delay_ms"]
+    return min(max(delay_ms, cfg["min_delay_ms"]), cfg["max_delay_ms"]) / 1000
+
+class ChainFailure(Exception):
+    def __init__(self, last_error: Optional[str], last_model: Optional[str], retry_after: Optional[float] = None):
+        super().__init__(last_error)
+        self.last_error = last_error
+        self.last_model = last_model
+        self.retry_after = retry_after  # Set when every attempt was rate limited
+
+async def execute_chain(models_to_try: List[str], request: ChatCompletionRequest,
+                        hedge_cfg: Optional[Dict] = None) -> Tuple[Dict, str, str, int]:
+    """Walk the fallback chain. Returns (result, provider, model_id, attempts).
+    
+    Without hedging, models are tried one after the other. With hedging, if the
+    latest model has not answered after its hedge delay, the next available model
+    is started in parallel; the first success wins and the others are cancelled.
+    Raises ChainFailure when every model failed. A rate-limited model is skipped
+    without counting as a failure; all but the last model spill over instead of
+    waiting for admission.
+    """
+    candidates = iter(enumerate(models_to_try))
+    running: Dict[asyncio.Task, Tuple[str, float, bool]] = {}  # task -> (model_id, started, is_hedge)
+    hedges_left = hedge_cfg["max_hedges"] if hedge_cfg else 0
+    last_error = None
+    last_model = None
+    last_launch = 0.0
+    attempts = 0
+    retry_after = None
+    only_rate_limited = True
+    
+    def launch(is_hedge: bool) -> bool:
+        nonlocal last_model, last_launch, attempts
+        for position, model_id in candidates:
+            if not circuit_breaker.is_available(model_id):
+                print(f"Skipping {model_id} - circuit open")
+                continue
+            last_model = model_id
+            last_launch = time.time()
+            attempts += 1
+            spill = position < len(models_to_try) - 1
+            task = asyncio.ensure_future(call_model(model_id, request, spill))
+            running[task] = (model_id, last_launch, is_hedge)
+            return True
+        return False
+    
+    try:
+        launch(False)
+        while running:
+            timeout = None
+            if hedges_left > 0:
+                timeout = max(0.0, last_launch + hedge_delay_sec(last_model, hedge_cfg) - time.time())
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
             
-            response = await client.post(
-                f"{prov_config['base_url']}/chat/completions",
-                headers=headers,
-                json={"model": model, "messages": [{"role": "user", "content": prompt}], "max_tokens": 20, "temperature": 0.1}
+            if not done:
+                if launch(True):
+                    hedges_left -= 1
+                    with metrics_lock:
+                        metrics["hedges_fired"] += 1
+                else:
+                    hedges_left = 0
+                continue
+            
+            for task in done:
+                model_id, started, is_hedge = running.pop(task)
+                error = task.exception()
+                if error is None:
+                    result, provider = task.result()
+                    latency_ms = (time.time() - started) * 1000
+                    record_outcome(model_id, latency_ms, True)
+                    circuit_breaker.record_success(model_id, latency_ms)
+                    if running:
+                        # Losers were billed at least for their prompt
+                        prompt_tokens = estimate_prompt_tokens(request)
+                        extra_cost = sum(estimate_cost(m, prompt_tokens, 0) for m, _, _ in running.values())
+                        with metrics_lock:
+                            metrics["hedge_extra_cost_usd"] += extra_cost
+                            metrics["total_cost_usd"] += extra_cost
+                    if is_hedge:
+                        with metrics_lock:
+                            metrics["hedges_won"] += 1
+                    return result, provider, model_id, attempts
+                last_error = str(error)
+                if isinstance(error, RateLimited):
+                    retry_after = min(retry_after or error.retry_after, error.retry_after)
+                    circuit_breaker.release(model_id)
+                    continue
+                only_rate_limited = False
+                record_outcome(model_id, None, False)
+                circuit_breaker.record_failure(model_id)
+            
+            if not running:
+                launch(False)
+        
+        raise ChainFailure(last_error, last_model, retry_after if only_rate_limited else None)
+    finally:
+        for task, (model_id, _, _) in running.items():
+            task.cancel()
+            circuit_breaker.release(model_id)
+
+# =============================================================================
+# RESPONSE CACHE
+# =============================================================================
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+RESPONSE_CACHE_TTL_SEC = float(os.getenv("RESPONSE_CACHE_TTL_SEC", "3600"))
+RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB", "")  # Empty: memory tier only
+RESPONSE_CACHE_DB_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_DB_MAX_BYTES", str(500 * 1024 * 1024)))
+
+class ResponseCache:
+    """Exact-match cache of deterministic completions.
+    
+    Memory tier: LRU bounded by entry count and total bytes. Optional SQLite tier
+    (RESPONSE_CACHE_DB) for larger, restart-proof storage; it is only touched from
+    worker threads so the event loop never waits on disk. Values are the upstream
+    JSON body bytes plus the model and provider that produced them.
+    """
+    
+    def __init__(self, enabled: bool = RESPONSE_CACHE_ENABLED, max_entries: int = RESPONSE_CACHE_SIZE,
+                 max_bytes: int = RESPONSE_CACHE_MAX_BYTES, ttl_sec: float = RESPONSE_CACHE_TTL_SEC,
+                 db_path: str = RESPONSE_CACHE_DB, db_max_bytes: int = RESPONSE_CACHE_DB_MAX_BYTES):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_sec = ttl_sec
+        self.db_max_bytes = db_max_bytes
+        # key -> (body, model_id, provider, expires_at)
+        self.entries: "OrderedDict[str, Tuple[bytes, str, str, float]]" = OrderedDict()
+        self.bytes = 0
+        self.stats = {"hits_memory": 0, "hits_disk": 0, "misses": 0, "bypassed": 0, "stores": 0, "evictions": 0}
+        self.lock = threading.Lock()
+        self.db = None
+        self.db_lock = threading.Lock()
+        self._background: set = set()
+        if enabled and db_path:
+            self._open_db(db_path)
+    
+    def _open_db(self, path: str):
+        try:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, body BLOB, model TEXT, provider TEXT, expires_at REAL, size INTEGER)"
             )
-            response.raise_for_status()
-            category = response.json()["choices"][0]["message"]["content"].strip().lower().split()[0]
-            if category in model_mappings:
-                return category, "api"
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_expires ON responses(expires_at)")
+            self.db.commit()
         except Exception as e:
-            print(f"API routing failed: {e}")
-    raise Exception("API routing failed")
-
-async def route_message(messages: List[Dict], session_id: str, has_tools: bool = False) -> Tuple[str, str]:
-    if not messages:
-        return "conversation", "none"
-    if has_tools:
-        return "tools", "direct"
+            print(f"Error opening response cache DB: {e}")
+            self.db = None
     
-    last_user_msg = None
-    for msg in reversed(messages):
-        if msg.get("role") == "user":
-            last_user_msg = msg.get("content", "")
-            break
+    @staticmethod
+    def make_key(request: ChatCompletionRequest, category: str, models: List[str]) -> str:
+        canonical = {
+            "messages": upstream_messages(request),
+            "tools": request.tools,
+            "tool_choice": request.tool_choice,
+            "temperature": request.temperature,
+            "max_tokens": request.max_tokens,
+            "stop": request.stop,
+            "category": category,
+            "models": models,
+        }
+        return hashlib.sha256(json_dumps(canonical, sort_keys=True)).hexdigest()
     
-    if not last_user_msg:
-        return "conversation", "none"
+    def is_eligible(self, request: ChatCompletionRequest) -> bool:
+        return self.enabled and not request.stream and request.temperature == 0
     
-    # Short continuation check
-    if isinstance(last_user_msg, str) and len(last_user_msg.split()) < 4:
-        return "conversation", "continuation"
+    def _memory_put(self, key: str, value: Tuple[bytes, str, str, float]):
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= len(previous[0])
+            self.entries[key] = value
+            self.bytes += len(value[0])
+            while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= len(evicted[0])
+                self.stats["evictions"] += 1
     
-    if ROUTING_MODE in ["ollama", "hybrid"]:
-        try:
-            category, mode = await route_with_ollama(last_user_msg)
-            if ROUTING_MODE == "ollama":
-                return category, mode
-        except:
-            pass
+    async def get(self, key: str) -> Optional[Tuple[bytes, str, str]]:
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[3] > now:
+                    self.entries.move_to_end(key)
+                    self.stats["hits_memory"] += 1
+                    return entry[:3]
+                del self.entries[key]
+                self.bytes -= len(entry[0])
+        if self.db is not None:
+            row = await asyncio.to_thread(self._db_get, key, now)
+            if row is not None:
+                self._memory_put(key, row)
+                self.stats["hits_disk"] += 1
+                return row[:3]
+        self.stats["misses"] += 1
+        return None
+    
+    def put(self, key: str, body: bytes, model_id: str, provider: str):
+        if len(body) > self.max_bytes:
+            return
+        value = (body, model_id, provider, time.time() + self.ttl_sec)
+        self._memory_put(key, value)
+        self.stats["stores"] += 1
+        if self.db is not None:
+            task = asyncio.ensure_future(asyncio.to_thread(self._db_put, key, value))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
     
-    if ROUTING_MODE in ["api", "hybrid"]:
+    def _db_get(self, key: str, now: float) -> Optional[Tuple[bytes, str, str, float]]:
+        with self.db_lock:
+            row = self.db.execute(
+                "SELECT body, model, provider, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+        return (bytes(row[0]), row[1], row[2], row[3]) if row else None
+    
+    def _db_put(self, key: str, value: Tuple[bytes, str, str, float]):
+        body, model_id, provider, expires_at = value
         try:
-            return await route_with_api(last_user_msg)
-        except:
-            pass
+            with self.db_lock:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO responses (key, body, model, provider, expires_at, size) VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, body, model_id, provider, expires_at, len(body))
+                )
+                self.db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+                total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > self.db_max_bytes:
+                    # Drop the entries closest to expiry until back under the limit
+                    self.db.execute(
+                        "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY expires_at LIMIT "
+                        "(SELECT MAX(1, COUNT(*) / 10) FROM responses))"
+                    )
+                self.db.commit()
+        except Exception as e:
+            print(f"Error writing response cache DB: {e}")
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+        if self.db is not None:
+            with self.db_lock:
+                self.db.execute("DELETE FROM responses")
+                self.db.commit()
+    
+    def close(self):
+        if self.db is not None:
+            with self.db_lock:
+                self.db.close()
+            self.db = None
     
-    return detect_category_keywords(last_user_msg), "keywords"
+    def get_stats(self) -> Dict:
+        with self.lock:
+            return dict(
+                self.stats,
+                enabled=self.enabled,
+                entries=len(self.entries),
+                bytes=self.bytes,
+                max_bytes=self.max_bytes,
+                ttl_sec=self.ttl_sec,
+                disk_tier=self.db is not None
+            )
+
+response_cache = ResponseCache()
+
+def cache_directives(http_request: Request) -> Tuple[bool, bool]:
+    """(read, write) permissions from Cache-Control / X-Router-Cache request headers"""
+    cache_control = http_request.headers.get("cache-control", "").lower()
+    router_cache = http_request.headers.get("x-router-cache", "").lower()
+    if "no-store" in cache_control or router_cache in ("bypass", "off"):
+        return False, False
+    if "no-cache" in cache_control or router_cache == "refresh":
+        return False, True
+    return True, True
 
 # =============================================================================
-# MODEL CALLING
+# BATCH COMPLETIONS
 # =============================================================================
 
-async def call_model(model_id: str, request: ChatCompletionRequest) -> Tuple[Dict, str]:
-    """Call a model via the appropriate provider. Returns (response, provider_name)"""
-    provider, model_name = parse_model_id(model_id)
-    prov_config = PROVIDERS.get(provider)
+BATCH_DEFAULTS = {
+    "max_items": 10000,             # Items per batch request
+    "classify_concurrency": 16,     # Items classified at once (LLM routing modes)
+    "default_concurrency": 8,       # Upstream calls in flight per provider
+    "provider_concurrency": {},     # provider -> calls in flight, overrides default_concurrency
+    "max_retries": 2,               # Extra passes over the chain for a failed item
+    "retry_backoff_sec": 1.0,       # Doubled at each retry; Retry-After wins when rate limited
+}
+
+class ProviderSlots:
+    """Lazily created semaphore per provider, shared by every item of one batch"""
+
+    def __init__(self, cfg: Dict):
+        self.cfg = cfg
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def get(self, provider: str) -> asyncio.Semaphore:
+        semaphore = self.semaphores.get(provider)
+        if semaphore is None:
+            limit = self.cfg["provider_concurrency"].get(provider, self.cfg["default_concurrency"])
+            semaphore = self.semaphores[provider] = asyncio.Semaphore(max(1, int(limit)))
+        return semaphore
+
+def parse_batch_items(body: bytes) -> List[Tuple[str, Any]]:
+    """(custom_id, request body) pairs from a JSON array or JSONL.
+
+    Items are chat completion bodies, or OpenAI batch lines
+    ({"custom_id", "method", "url", "body"}). Raises ValueError on malformed input.
+    """
+    text = body.strip()
+    if text[:1] == b"[":
+        entries = json_loads(text)
+    else:
+        entries = [json_loads(line) for line in text.splitlines() if line.strip()]
+    items = []
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            raise ValueError(f"Item {index} is not a JSON object")
+        if "body" in entry and isinstance(entry["body"], dict):
+            items.append((str(entry.get("custom_id", index)), entry["body"]))
+        else:
+            items.append((str(entry.get("custom_id", index)), {k: v for k, v in entry.items() if k != "custom_id"}))
+    return items
+
+def batch_line(data: Dict, body: Optional[bytes] = None) -> bytes:
+    """JSONL line; an upstream body is spliced in as-is unless it spans several lines"""
+    if body is None:
+        return json_dumps(data) + b"\n"
+    body = body.strip()
+    if b"\n" in body:
+        body = json_dumps(json_loads(body))
+    line = json_dumps({**data, "response": None})
+    return line.replace(b'"response":null', b'"response":{"status_code":200,"body":' + body + b"}", 1) + b"\n"
+
+class BatchRunner:
+    """One batch: classify every item, then run them grouped by resolved model.
+
+    Upstream calls hold a slot of their provider (provider_slots), so fallbacks to
+    another provider are bounded too; rate limits still apply on top. Results are
+    queued as JSONL lines in completion order, followed by a summary line.
+    """
+
+    def __init__(self, items: List[Tuple[str, Any]], cfg: Dict):
+        self.id = f"batch_{int(time.time() * 1000):x}{random.getrandbits(24):06x}"
+        self.items = items
+        self.cfg = cfg
+        self.table = routing_table  # One routing table for the whole batch
+        self.lines: asyncio.Queue = asyncio.Queue()
+        self.start = time.time()
+        self.latencies: List[float] = []
+        self.models: Dict[str, int] = defaultdict(int)
+        self.totals = {"succeeded": 0, "failed": 0, "cost_usd": 0.0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    def emit(self, index: int, custom_id: str, router: Dict, body: Optional[bytes] = None,
+             error: Optional[Dict] = None):
+        data = {"id": f"{self.id}_{index}", "custom_id": custom_id, "router": router}
+        if error is not None:
+            self.totals["failed"] += 1
+            self.lines.put_nowait(batch_line({**data, "response": None, "error": error}))
+        else:
+            self.totals["succeeded"] += 1
+            self.lines.put_nowait(batch_line({**data, "error": None}, body))
+
+    async def classify(self, index: int, custom_id: str, body: Any, semaphore: asyncio.Semaphore):
+        """(index, custom_id, request, category, routing_mode, chain), or None once the error is emitted"""
+        try:
+            request = ChatCompletionRequest.model_validate(body)
+        except Exception as e:
+            self.emit(index, custom_id, {}, error={"code": "invalid_request", "message": str(e)[:500]})
+            return None
+        request.stream = False
+        if isinstance(body.get("messages"), list) and all(isinstance(m, dict) for m in body["messages"]):
+            request._raw_messages = body["messages"]
+        async with semaphore:
+            category, routing_mode = await classify_message(upstream_messages(request), self.table, bool(request.tools))
+        chain = self.table.chain(category)
+        return index, custom_id, request, category, routing_mode, chain
+
+    async def run_item(self, index: int, custom_id: str, request: ChatCompletionRequest, category: str,
+                       routing_mode: str, configured_chain: List[str]):
+        started = time.time()
+        router = {"category": category, "routing": routing_mode}
+        cache_key = response_cache.make_key(request, category, configured_chain) \
+            if response_cache.is_eligible(request) else None
+        if cache_key is not None:
+            cached = await response_cache.get(cache_key)
+            if cached is not None:
+                body, model_id, provider = cached
+                track_request(category, model_id, (time.time() - started) * 1000, True, routing_mode, 0.0, provider,
+                              cached=True, user=request.user)
+                self.models[model_id] += 1
+                self.emit(index, custom_id, {**router, "model": model_id, "provider": provider, "cache": "hit"}, body)
+                return
+        coalesce_key = cache_key or (response_cache.make_key(request, category, configured_chain)
+                                     if request.temperature == 0 else None)
+        chain = adaptive_selector.order(token_router.plan(configured_chain, request))
+        failure = None
+        for attempt in range(self.cfg["max_retries"] + 1):
+            if attempt:
+                backoff = self.cfg["retry_backoff_sec"] * 2 ** (attempt - 1)
+                await asyncio.sleep(failure.retry_after if failure.retry_after is not None else backoff)
+            try:
+                # Batch items are not hedged: throughput matters more than tail latency
+                (result, provider, model_id, attempts), shared = await single_flight.run(
+                    coalesce_key, lambda: execute_chain(chain, request), "chat"
+                ) if coalesce_key else (await execute_chain(chain, request), False)
+                break
+            except ChainFailure as e:
+                failure = e
+        else:
+            latency_ms = (time.time() - started) * 1000
+            track_request(category, failure.last_model or "unknown", latency_ms, False, routing_mode, 0, None,
+                          failure.last_error, user=request.user)
+            code = "rate_limited" if failure.retry_after is not None else "all_models_failed"
+            self.emit(index, custom_id, {**router, "model": failure.last_model, "latency_ms": round(latency_ms, 1)},
+                      error={"code": code, "message": (failure.last_error or "")[:500]})
+            return
+
+        usage = result.usage
+        cost = 0.0 if shared else usage_cost(model_id, usage)
+        if not shared:
+            track_prompt_cache(model_id, usage)
+        latency_ms = (time.time() - started) * 1000
+        track_request(category, model_id, latency_ms, True, routing_mode, cost, provider, user=request.user,
+                      attempts=attempts)
+        if not shared:
+            token_router.observe(model_id, provider, request, usage.get("prompt_tokens"))
+            prom_fallback_depth.inc(category, str(attempts))
+            if cache_key is not None:
+                response_cache.put(cache_key, result.body, model_id, provider)
+        self.latencies.append(latency_ms)
+        self.models[model_id] += 1
+        self.totals["cost_usd"] += cost
+        self.totals["prompt_tokens"] += usage.get("prompt_tokens", 0) or 0
+        self.totals["completion_tokens"] += usage.get("completion_tokens", 0) or 0
+        self.emit(index, custom_id, {**router, "model": model_id, "provider": provider, "attempts": attempts,
+                                     "retries": attempt, "coalesced": shared, "latency_ms": round(latency_ms, 1),
+                                     "cost_usd": round(cost, 6)}, result.body)
+
+    async def run_guarded(self, index: int, custom_id: str, *args):
+        try:
+            await self.run_item(index, custom_id, *args)
+        except Exception as e:
+            self.emit(index, custom_id, {}, error={"code": "internal_error", "message": str(e)[:500]})
+
+    async def run(self):
+        """Run every item; pushes None on the line queue when done"""
+        slots_token = provider_slots.set(ProviderSlots(self.cfg))
+        try:
+            semaphore = asyncio.Semaphore(self.cfg["classify_concurrency"])
+            classified = await asyncio.gather(*[self.classify(i, cid, body, semaphore)
+                                                for i, (cid, body) in enumerate(self.items)])
+            # Grouped by first model: each provider's slots serve one model's items in a row
+            ready = sorted((c for c in classified if c is not None), key=lambda c: c[5][0] if c[5] else "")
+            await asyncio.gather(*[self.run_guarded(*item) for item in ready])
+        finally:
+            provider_slots.reset(slots_token)
+            self.lines.put_nowait(None)
+
+    def summary(self) -> Dict:
+        latencies = sorted(self.latencies)
+        pick = lambda p: round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 1) if latencies else 0
+        return {
+            "object": "batch.summary",
+            "id": self.id,
+            "items": len(self.items),
+            "succeeded": self.totals["succeeded"],
+            "failed": self.totals["failed"],
+            "cost_usd": round(self.totals["cost_usd"], 6),
+            "prompt_tokens": self.totals["prompt_tokens"],
+            "completion_tokens": self.totals["completion_tokens"],
+            "latency_ms": round((time.time() - self.start) * 1000, 1),
+            "item_latency_ms": {"avg": round(sum(latencies) / len(latencies), 1) if latencies else 0,
+                                "p50": pick(0.5), "p95": pick(0.95)},
+            "models": dict(self.models),
+        }
+
+# =============================================================================
+# HEALTH CHECKS
+# =============================================================================
+
+HEALTH_CHECK_DEFAULTS = {
+    "enabled": True,
+    "interval_sec": 10,            # Scheduler tick: how late a recovery probe can be
+    "provider_interval_sec": 25,   # Cheap call per provider; below POOL_KEEPALIVE_EXPIRY it keeps connections open
+    "provider_failure_streak": 2,  # Failed provider probes in a row before they count against its models
+    # Model probes are paid completions: off unless configured
+    "model_interval_sec": 0,       # 1-token completion per model of the chains (0 = off)
+    "recover_by_probe": False,     # Half-open trials go to 1-token probes, never to user requests
+    "max_inconclusive": 3,         # Inconclusive probes in a row before a model's trials go back to users
+    "max_probes_per_min": 12,      # Budget per provider, all probe kinds together
+    "timeout_sec": 10,
+    "warm_connections": 2,         # Connections opened per provider at startup
+    "warm_timeout_sec": 5,         # Startup waits at most this long for them
+    "prompt": "ping",
+}
+
+# Model probe statuses that say nothing about the model: rate limited, or a request
+# the model rejects (e.g. max_tokens on reasoning models) while real ones would pass
+def probe_inconclusive(status: Any) -> bool:
+    return isinstance(status, int) and 400 <= status < 500 and status not in (401, 403, 404, 408)
+
+# Provider probe errors that mean the provider cannot be reached at all: no streak needed
+PROVIDER_DOWN_ERRORS = ("ConnectError", "ConnectTimeout")
+
+class HealthChecker:
+    """Background probes of the providers and models of the routing table.
     
-    if not prov_config:
-        raise ValueError(f"Unknown provider: {provider}")
+    Provider probes call a cheap endpoint (PROVIDERS[...]["health_path"]): they keep
+    pooled connections warm, and a provider that cannot be reached, or answers 5xx
+    provider_failure_streak times in a row, counts as a failure of each of its
+    models, so circuits open before users pay for the outage. Model probes are
+    opt-in 1-token completions through the adapters and the rate limiter: routine
+    ones every model_interval_sec, and with recover_by_probe, recovery ones as soon
+    as an open circuit's timeout is over; the breaker then leaves its trials to these
+    probes, so a recovered model comes back without a user request being the test,
+    unless its probes keep coming back inconclusive (a 4xx the probe itself causes).
+    All probes of a provider share a budget per minute.
+    """
     
-    if not prov_config.get("api_key") and provider != "ollama":
-        raise ValueError(f"No API key configured for provider: {provider}")
+    def __init__(self):
+        self.spent: Dict[str, deque] = defaultdict(deque)   # provider -> probe times in the last minute
+        self.provider_due: Dict[str, float] = {}
+        self.model_due: Dict[str, float] = {}
+        self.providers: Dict[str, Dict] = {}               # Last result and counts per provider
+        self.models: Dict[str, Dict] = {}
+        self.inconclusive: Dict[str, int] = {}             # model -> inconclusive probes in a row
+        self.provider_failures: Dict[str, int] = {}        # provider -> failed provider probes in a row
+        self.stats = {"rounds": 0, "probes": 0, "failures": 0, "inconclusive": 0,
+                      "recovered": 0, "over_budget": 0, "warmed": 0}
     
-    headers = {"Content-Type": "application/json"}
-    if prov_config.get("api_key") and prov_config.get("auth_header"):
-        headers[prov_config["auth_header"]] = prov_config["auth_prefix"] + prov_config["api_key"]
+    def config(self) -> Dict:
+        return {**HEALTH_CHECK_DEFAULTS, **health_check_config}
     
-    # Add attribution headers for OpenRouter
-    if provider == "openrouter":
-        headers["HTTP-Referer"] = ROUTER_URL
-        headers["X-Title"] = ROUTER_NAME
+    def targets(self) -> Dict[str, List[str]]:
+        """Models of the routing table by provider, for the configured providers"""
+        targets: Dict[str, List[str]] = {}
+        for chain in routing_table.model_mappings.values():
+            for model_id in chain:
+                provider = parse_model_id(model_id)[0]
+                prov_config = PROVIDERS.get(provider)
+                if not prov_config or not (prov_config.get("api_key") or provider == "ollama"):
+                    continue
+                models = targets.setdefault(provider, [])
+                if model_id not in models:
+                    models.append(model_id)
+        return targets
     
-    # Handle Anthropic's required version header
-    if prov_config.get("requires_version"):
-        headers["anthropic-version"] = "2023-06-01"
-    
-    payload = {
-        "model": prov_config.get("models_prefix", "") + model_name,
-        "messages": [msg.model_dump(exclude_none=True) for msg in request.messages],
-        "temperature": request.temperature,
-        "max_tokens": request.max_tokens,
-        "tools": request.tools,
-        "tool_choice": request.tool_choice
-    }
-    payload = {k: v for k, v in payload.items() if v is not None}
-    
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        # Ollama uses /api/generate or /api/chat
-        if prov_config.get("use_generate_api"):
-            # Convert to Ollama format
-            ollama_payload = {
-                "model": model_name,
-                "messages": payload["messages"],
-                "stream": False,
-                "options": {"temperature": payload.get("temperature", 1.0)}
-            }
-            response = await client.post(
-                f"{prov_config['base_url']}/api/chat",
-                headers={},
-                json=ollama_payload
-            )
+    def budget_left(self, provider: str, cfg: Dict, now: float) -> int:
+        spent = self.spent[provider]
+        while spent and spent[0] <= now - 60:
+            spent.popleft()
+        return cfg["max_probes_per_min"] - len(spent)
+    
+    def report(self, results: Dict[str, Dict], key: str, provider: str, kind: str, result: str,
+               status: Any, latency_ms: float):
+        self.stats["probes"] += 1
+        if result != "ok":
+            self.stats["failures" if result == "failed" else "inconclusive"] += 1
+        entry = results.setdefault(key, {"probes": 0, "failures": 0})
+        entry["probes"] += 1
+        entry["failures"] += result == "failed"
+        entry.update(result=result, status=status, latency_ms=round(latency_ms, 1), at=time.time())
+        prom_health_probes.inc(provider, kind, result)
+    
+    async def provider_call(self, provider: str, cfg: Dict) -> Tuple[Any, float]:
+        """(status code or exception name, latency ms) of the provider's health endpoint"""
+        prov_config = PROVIDERS[provider]
+        start = time.perf_counter()
+        try:
+            response = await provider_pools.get(provider).get(
+                prov_config["base_url"] + prov_config["health_path"],
+                headers=provider_headers(provider, prov_config), timeout=cfg["timeout_sec"])
+            status = response.status_code
+        except Exception as e:
+            status = type(e).__name__
+        return status, (time.perf_counter() - start) * 1000
+    
+    async def probe_provider(self, provider: str, models: List[str], cfg: Dict):
+        status, latency_ms = await self.provider_call(provider, cfg)
+        # Any answer below 500 means reachable: bad keys or models show up in model probes
+        ok = isinstance(status, int) and status < 500 and status != 408
+        self.report(self.providers, provider, provider, "provider", "ok" if ok else "failed", status, latency_ms)
+        if ok:
+            self.provider_failures.pop(provider, None)
+            return
+        streak = self.provider_failures[provider] = self.provider_failures.get(provider, 0) + 1
+        # One slow or 5xx answer of a health endpoint is not an outage of every model
+        if streak < cfg["provider_failure_streak"] and status not in PROVIDER_DOWN_ERRORS:
+            return
+        for model_id in models:
+            if circuit_breaker.state(model_id) == "closed":
+                circuit_breaker.record_failure(model_id)
+    
+    async def probe_model(self, model_id: str, cfg: Dict):
+        provider = parse_model_id(model_id)[0]
+        request = ChatCompletionRequest(model=model_id, messages=[Message(role="user", content=cfg["prompt"])],
+                                        max_tokens=1, temperature=0)
+        start = time.perf_counter()
+        status = None
+        try:
+            _, model_name, url, headers, payload = build_upstream_request(model_id, request)
+            reserved = rate_limiter.reserve_tokens(request)
+            # As a spill: refused at once rather than queued behind user requests
+            await rate_limiter.acquire(provider, model_id, reserved, True)
+            response = await provider_pools.get(provider).post(url, headers=headers, content=json_dumps(payload),
+                                                               timeout=cfg["timeout_sec"])
+            status = response.status_code
+            if status == 429:
+                rate_limiter.upstream_limited(model_id, response.headers.get("retry-after"))
+            elif status < 400:
+                completion = adapter_for(provider).response(response.content, model_name)
+                rate_limiter.settle(provider, model_id, reserved, completion.usage.get("total_tokens"))
+        except RateLimited:
+            status = 429
+        except Exception as e:
+            status = type(e).__name__ if status is None or status < 400 else status
+        latency_ms = (time.perf_counter() - start) * 1000
+        if probe_inconclusive(status):
+            result = "inconclusive"
+            self.inconclusive[model_id] = self.inconclusive.get(model_id, 0) + 1
+            circuit_breaker.release(model_id)
+        elif isinstance(status, int) and status < 400:
+            result = "ok"
+            self.inconclusive.pop(model_id, None)
+            was_closed = circuit_breaker.state(model_id) == "closed"
+            circuit_breaker.record_success(model_id, latency_ms)
+            if not was_closed and circuit_breaker.state(model_id) == "closed":
+                self.stats["recovered"] += 1
         else:
-            response = await client.post(
-                f"{prov_config['base_url']}/chat/completions",
-                headers=headers,
-                json=payload
-            )
-        
-        response.raise_for_status()
-        return response.json(), provider
+            result = "failed"
+            self.inconclusive.pop(model_id, None)
+            circuit_breaker.record_failure(model_id)
+        self.report(self.models, model_id, provider, "model", result, status, latency_ms)
+    
+    async def run_round(self):
+        cfg = self.config()
+        if not cfg["enabled"]:
+            circuit_breaker.probed = frozenset()
+            return
+        targets = self.targets()
+        # A model whose probes the provider keeps rejecting gets user trials back, or it would stay half-open
+        circuit_breaker.probed = frozenset(
+            m for models in targets.values() for m in models
+            if self.inconclusive.get(m, 0) < cfg["max_inconclusive"]) if cfg["recover_by_probe"] else frozenset()
+        now = time.monotonic()
+        probes = []
+        for provider, models in targets.items():
+            left = self.budget_left(provider, cfg, now)
+            planned = []
+            # Recovery first: is_available hands over the half-open trial once the open period is over
+            for model_id in models:
+                if model_id in circuit_breaker.probed and circuit_breaker.state(model_id) != "closed" \
+                        and len(planned) < left and circuit_breaker.is_available(model_id, probe=True):
+                    planned.append(self.probe_model(model_id, cfg))
+            if cfg["provider_interval_sec"] > 0 and now >= self.provider_due.get(provider, 0.0) and len(planned) < left:
+                self.provider_due[provider] = now + cfg["provider_interval_sec"]
+                planned.append(self.probe_provider(provider, models, cfg))
+            if cfg["model_interval_sec"] > 0:
+                for model_id in models:
+                    # First probes spread over one interval, not all at startup
+                    due = self.model_due.setdefault(model_id, now + random.uniform(0, cfg["model_interval_sec"]))
+                    if now < due or circuit_breaker.state(model_id) != "closed" \
+                            or rate_limiter.blocked_until.get(model_id, 0.0) > now:
+                        continue
+                    if len(planned) >= left:
+                        self.stats["over_budget"] += 1
+                        break
+                    self.model_due[model_id] = now + cfg["model_interval_sec"]
+                    planned.append(self.probe_model(model_id, cfg))
+            self.spent[provider].extend([now] * len(planned))
+            probes += planned
+        self.stats["rounds"] += 1
+        await asyncio.gather(*probes, return_exceptions=True)
+    
+    async def warm(self):
+        """Open warm_connections pooled connections to each provider before traffic arrives"""
+        cfg = self.config()
+        calls = [self.provider_call(provider, cfg) for provider in self.targets() for _ in range(cfg["warm_connections"])]
+        for status, _ in await asyncio.gather(*calls):
+            self.stats["warmed"] += isinstance(status, int)
+    
+    async def run(self):
+        try:
+            while True:
+                try:
+                    await self.run_round()
+                except Exception as e:
+                    print(f"Health check round failed: {e}")
+                await asyncio.sleep(self.config()["interval_sec"])
+        finally:
+            # Without probes, user requests must be able to run the trials again
+            circuit_breaker.probed = frozenset()
+    
+    def get_stats(self) -> Dict:
+        def described(results: Dict[str, Dict]) -> Dict[str, Dict]:
+            return {key: {**entry, "at": datetime.fromtimestamp(entry["at"]).isoformat()} for key, entry in results.items()}
+        now = time.monotonic()
+        cfg = self.config()
+        return {
+            **self.stats,
+            "probed_models": len(circuit_breaker.probed),
+            "inconclusive_streaks": dict(self.inconclusive),
+            "provider_failure_streaks": dict(self.provider_failures),
+            "budget_left": {p: self.budget_left(p, cfg, now) for p in list(self.spent)},
+            "providers": described(self.providers),
+            "models": described(self.models),
+            "config": cfg,
+        }
+
+health_checker = HealthChecker()
 
 # =============================================================================
 # ENDPOINTS
@@ -552,27 +5162,113 @@ async def health_check():
 @app.get("/metrics")
 async def get_metrics():
     with metrics_lock:
-        avg_latency = metrics["total_latency_ms"] / metrics["requests_total"] if metrics["requests_total"] > 0 else 0
+        m = shared_state.overlay(metrics)
+        upstream_requests = m["requests_total"] - m["cache_hits"]
+        avg_latency = m["total_latency_ms"] / upstream_requests if upstream_requests > 0 else 0
         return {
-            "requests": {"total": metrics["requests_total"], "success": metrics["requests_success"], "failed": metrics["requests_failed"]},
+            "requests": {"total": m["requests_total"], "success": m["requests_success"], "failed": m["requests_failed"],
+                         "aborted": m["requests_aborted"]},
             "avg_latency_ms": round(avg_latency, 2),
-            "total_cost_usd": round(metrics["total_cost_usd"], 4),
-            "model_distribution": dict(metrics["model_usage"]),
-            "category_distribution": dict(metrics["category_usage"]),
-            "provider_distribution": dict(metrics["provider_usage"]),
+            "total_cost_usd": round(m["total_cost_usd"], 4),
+            "model_distribution": dict(m["model_usage"]),
+            "category_distribution": dict(m["category_usage"]),
+            "provider_distribution": dict(m["provider_usage"]),
+            "routing": {
+                "mode_distribution": dict(m["routing_mode_usage"]),
+                "budget_ms": ROUTING_BUDGET_MS,
+                "budget_exceeded": m["routing_budget_exceeded"]
+            },
+            "hedging": {
+                "fired": m["hedges_fired"],
+                "won": m["hedges_won"],
+                "extra_cost_usd": round(m["hedge_extra_cost_usd"], 6)
+            },
+            "adaptive": adaptive_selector.get_status(),
             "circuit_breaker": circuit_breaker.get_status(),
-            "recent_requests": metrics["recent_requests"][-10:]
+            "rate_limits": rate_limiter.get_stats(),
+            "token_routing": token_router.get_stats(),
+            "config": config_store.get_stats(),
+            "semantic_routing": semantic_router.get_stats(),
+            "session_affinity": session_affinity.get_stats(),
+            "health_checks": health_checker.get_stats(),
+            "coalescing": single_flight.get_stats(),
+            "prompt_cache": {
+                "cached_tokens": m["cached_prompt_tokens"],
+                "cache_write_tokens": m["cache_write_tokens"],
+                "saved_usd": round(m["prompt_cache_saved_usd"], 6),
+                "gemini_contexts": gemini_cache.get_stats()
+            },
+            "batches": dict(batch_stats),
+            "access_log": access_log.stats if access_log else None,
+            "shared_state": shared_state.get_status(),
+            "connection_pools": provider_pools.get_stats(),
+            "routing_cache": routing_cache.get_stats(),
+            "response_cache": dict(
+                response_cache.get_stats(),
+                avg_hit_latency_ms=round(m["cache_latency_ms"] / m["cache_hits"], 2) if m["cache_hits"] else 0
+            ),
+            "request_events": request_events.get_stats(),
+            "recent_requests": request_events.recent_requests(10)
         }
 
+@app.get("/metrics/prometheus")
+async def get_prometheus_metrics(request: Request):
+    """Prometheus text format, or OpenMetrics when the scraper asks for it"""
+    openmetrics = "application/openmetrics-text" in request.headers.get("accept", "")
+    families = registry.snapshot()
+    if registry.multiproc_dir:
+        families = await asyncio.to_thread(registry.merged, families)
+    media_type = ("application/openmetrics-text; version=1.0.0; charset=utf-8" if openmetrics
+                  else "text/plain; version=0.0.4; charset=utf-8")
+    return Response(content=registry.render(families, openmetrics), media_type=media_type)
+
+def event_query(http_request: Request) -> Tuple[float, float, Dict[str, str]]:
+    """Time window (since, until) and equality filters of an /events query"""
+    params = http_request.query_params
+    now = time.time()
+    try:
+        since = parse_time(params.get("since") or params.get("window") or "1h", now)
+        until = parse_time(params.get("until"), now) or now
+    except ValueError as e:
+        raise HTTPException(400, f"Invalid time: {e}")
+    filters = {name: params[name] for name in EVENT_GROUPS if params.get(name)}
+    return since, until, filters
+
+@app.get("/events/stats")
+async def get_event_stats(http_request: Request, group_by: str = ""):
+    """Aggregates over a time window: ?window=24h&group_by=model,category&user=alice"""
+    since, until, filters = event_query(http_request)
+    groups = [g for g in group_by.split(",") if g]
+    unknown = [g for g in groups if g not in EVENT_GROUPS]
+    if unknown:
+        raise HTTPException(400, f"Unknown group_by {unknown}, choose from {list(EVENT_GROUPS)}")
+    results = await asyncio.to_thread(request_events.aggregate, since, until, groups, filters)
+    return {
+        "since": datetime.utcfromtimestamp(since).isoformat() + "Z",
+        "until": datetime.utcfromtimestamp(until).isoformat() + "Z",
+        "group_by": groups,
+        "filters": filters,
+        "groups": results
+    }
+
+@app.get("/events")
+async def get_events(http_request: Request, limit: int = 100):
+    """Raw request events, newest first: ?window=15m&model=openai/gpt-4o&limit=50"""
+    since, until, filters = event_query(http_request)
+    events = await asyncio.to_thread(request_events.events, since, until, filters, max(1, min(limit, 10000)))
+    return {"count": len(events), "events": events}
+
 @app.get("/config")
 async def get_config():
+    table = routing_table
     return {
         "routing_mode": ROUTING_MODE,
+        "version": table.version,
         "providers": {k: {"base_url": v["base_url"], "configured": bool(v.get("api_key"))} for k, v in PROVIDERS.items()},
-        "model_mappings": model_mappings,
-        "keywords": category_keywords,
-        "custom_categories": custom_categories,
-        "model_costs": MODEL_COSTS
+        "model_mappings": thaw(table.model_mappings),
+        "keywords": thaw(table.category_keywords),
+        "custom_categories": thaw(table.custom_categories),
+        "model_costs": thaw(table.model_costs)
     }
 
 @app.get("/providers")
@@ -584,55 +5280,67 @@ async def list_providers():
 
 @app.post("/config/category")
 async def add_category(config: CategoryConfig):
-    model_mappings[config.name] = config.models
-    if config.keywords:
-        category_keywords[config.name] = config.keywords
-    if config.description:
-        if config.name not in custom_categories:
-            custom_categories[config.name] = {}
-        custom_categories[config.name]["description"] = config.description
-        custom_categories[config.name]["models"] = config.models
+    def edit(current: Dict):
+        current["model_mappings"] = {**DEFAULT_MODEL_MAPPINGS, **current.get("model_mappings", {}), config.name: config.models}
         if config.keywords:
-            custom_categories[config.name]["keywords"] = config.keywords
-    save_config()
-    return {"status": "ok", "category": config.name, "models": config.models}
+            current["keywords"] = {**DEFAULT_KEYWORDS, **current.get("keywords", {}), config.name: config.keywords}
+        if config.description:
+            category = current.setdefault("custom_categories", {}).setdefault(config.name, {})
+            category["description"] = config.description
+            category["models"] = config.models
+            if config.keywords:
+                category["keywords"] = config.keywords
+    
+    table = await config_store.update(edit)
+    return {"status": "ok", "category": config.name, "models": config.models, "version": table.version}
 
 @app.post("/config/model-mapping")
 async def update_model_mapping(update: ModelMappingUpdate):
-    if update.category not in model_mappings:
-        raise HTTPException(404, f"Category '{update.category}' not found")
-    model_mappings[update.category] = update.models
-    save_config()
-    return {"status": "ok", "category": update.category, "models": update.models}
+    def edit(current: Dict):
+        if update.category not in routing_table.model_mappings:
+            raise HTTPException(404, f"Category '{update.category}' not found")
+        current["model_mappings"] = {**DEFAULT_MODEL_MAPPINGS, **current.get("model_mappings", {}), update.category: update.models}
+    
+    table = await config_store.update(edit)
+    return {"status": "ok", "category": update.category, "models": update.models, "version": table.version}
 
 @app.delete("/config/category/{category_name}")
 async def delete_category(category_name: str):
     if category_name in DEFAULT_MODEL_MAPPINGS:
         raise HTTPException(400, "Cannot delete default category")
-    if category_name in model_mappings:
-        del model_mappings[category_name]
-    if category_name in category_keywords:
-        del category_keywords[category_name]
-    if category_name in custom_categories:
-        del custom_categories[category_name]
-    save_config()
-    return {"status": "ok", "deleted": category_name}
+    
+    def edit(current: Dict):
+        for section in ("model_mappings", "keywords", "custom_categories"):
+            current.get(section, {}).pop(category_name, None)
+    
+    table = await config_store.update(edit)
+    return {"status": "ok", "deleted": category_name, "version": table.version}
 
 @app.post("/config/reload")
 async def reload_config():
     """Reload configuration from file without restart"""
-    if load_config():
-        return {
-            "status": "ok",
-            "message": "Config reloaded",
-            "categories": list(model_mappings.keys()),
-            "model_mappings": model_mappings
-        }
-    raise HTTPException(500, "Failed to reload config")
+    try:
+        table = await config_store.reload()
+    except Exception as e:
+        config_store.stats["errors"] += 1
+        config_store.stats["last_error"] = str(e)[:200]
+        raise HTTPException(400, f"Invalid config file, keeping routing table v{routing_table.version}: {e}")
+    return {
+        "status": "ok",
+        "message": "Config reloaded",
+        "version": table.version,
+        "categories": list(table.model_mappings.keys()),
+        "model_mappings": thaw(table.model_mappings)
+    }
+
+@app.post("/cache/clear")
+async def clear_response_cache():
+    await asyncio.to_thread(response_cache.clear)
+    return {"status": "ok", "message": "Response cache cleared"}
 
 @app.post("/circuit-breaker/reset/{model}")
 async def reset_circuit(model: str):
-    circuit_breaker.record_success(model)
+    circuit_breaker.reset(model)
     return {"status": "ok", "model": model}
 
 @app.post("/circuit-breaker/reset-all")
@@ -642,56 +5350,177 @@ async def reset_all_circuits():
 
 @app.post("/v1/chat/completions")
 @app.post("/chat/completions")
-async def chat_completions(request: ChatCompletionRequest):
+async def chat_completions(request: ChatCompletionRequest, http_request: Request):
     start_time = time.time()
+    table = routing_table  # The whole request reads this snapshot, even if the config is swapped meanwhile
     
-    session_id = request.user or "default_session"
-    has_tools = request.tools is not None and len(request.tools) > 0
+    tool_names = [(t.get("function") or {}).get("name", "") for t in request.tools or []]
     
-    category, routing_mode = await route_message(
-        [msg.model_dump() for msg in request.messages],
-        session_id, has_tools
-    )
+    session_key = session_affinity.session_key(http_request.headers.get("x-session-id"), request.user,
+                                               upstream_messages(request))
+    category, routing_mode = await route_message(upstream_messages(request), table, session_key, tool_names)
+    prom_routing_latency.observe(time.time() - start_time, routing_mode)
+    annotate_access_log(category=category, routing=routing_mode, stream=bool(request.stream))
     
-    models_to_try = model_mappings.get(category, model_mappings.get("conversation", [f"{DEFAULT_PROVIDER}/{DEFAULT_MODEL}"]))
+    models_to_try = table.chain(category)
     
-    last_error = None
-    last_model_tried = None
-    last_provider = None
+    cache_key = None
+    cache_read = cache_write = False
+    if response_cache.is_eligible(request):
+        cache_read, cache_write = cache_directives(http_request)
+        # Keyed on the configured chain, before adaptive reordering
+        cache_key = response_cache.make_key(request, category, models_to_try)
+        if cache_read:
+            cached = await response_cache.get(cache_key)
+            if cached is not None:
+                body, model_id, provider = cached
+                latency_ms = (time.time() - start_time) * 1000
+                track_request(category, model_id, latency_ms, True, routing_mode, 0.0, provider, cached=True,
+                              user=request.user)
+                annotate_access_log(model=model_id, provider=provider, cache="hit")
+                return Response(content=body, media_type="application/json", headers={"X-Router-Cache": "hit"})
+        else:
+            response_cache.stats["bypassed"] += 1
     
-    for model_id in models_to_try:
-        if not circuit_breaker.is_available(model_id):
-            print(f"Skipping {model_id} - circuit open")
-            continue
-        
-        last_model_tried = model_id
-        
-        try:
-            result, provider = await call_model(model_id, request)
-            last_provider = provider
-            
-            usage = result.get("usage", {})
-            cost = estimate_cost(model_id, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
-            
-            latency_ms = (time.time() - start_time) * 1000
-            track_request(category, model_id, latency_ms, True, routing_mode, cost, provider)
-            
-            circuit_breaker.record_success(model_id)
-            
-            return result
-        except Exception as e:
-            last_error = str(e)
-            circuit_breaker.record_failure(model_id)
-            continue
+    configured_chain = models_to_try
+    models_to_try = session_affinity.order(session_key, adaptive_selector.order(token_router.plan(models_to_try, request)))
+    if models_to_try:
+        annotate_access_log(**token_router.estimate(models_to_try[0], request))
+    
+    if request.stream:
+        return await stream_chat_completion(request, category, routing_mode, models_to_try, start_time, session_key)
+    
+    coalesce_key = None
+    if request.temperature == 0:
+        # Same key as the response cache; computed on the configured chain
+        coalesce_key = cache_key or response_cache.make_key(request, category, configured_chain)
+    
+    try:
+        (result, provider, model_id, attempts), shared = await single_flight.run(
+            coalesce_key, lambda: execute_chain(models_to_try, request, get_hedge_config(category)), "chat"
+        ) if coalesce_key else (await execute_chain(models_to_try, request, get_hedge_config(category)), False)
+    except ChainFailure as e:
+        latency_ms = (time.time() - start_time) * 1000
+        track_request(category, e.last_model or "unknown", latency_ms, False, routing_mode, 0, None, e.last_error,
+                      user=request.user)
+        annotate_access_log(model=e.last_model, error=(e.last_error or "")[:200])
+        if e.retry_after is not None:
+            raise HTTPException(429, f"All models are rate limited. Last error: {e.last_error}",
+                                headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))})
+        raise HTTPException(500, f"All models failed. Last error: {e.last_error}")
+    
+    usage = result.usage
+    session_affinity.succeeded(session_key, category, model_id)
+    if not shared:
+        token_router.observe(model_id, provider, request, usage.get("prompt_tokens"))
+    # The upstream call is billed once, to the request that made it
+    cost = 0.0 if shared else usage_cost(model_id, usage)
+    if not shared:
+        track_prompt_cache(model_id, usage)
     
     latency_ms = (time.time() - start_time) * 1000
-    track_request(category, last_model_tried or "unknown", latency_ms, False, routing_mode, 0, last_provider, last_error)
+    track_request(category, model_id, latency_ms, True, routing_mode, cost, provider, user=request.user,
+                  attempts=attempts)
+    annotate_access_log(model=model_id, provider=provider, attempts=attempts, coalesced=shared or None,
+                        cached_tokens=usage_tokens(usage)[2] or None)
+    if not shared:
+        prom_fallback_depth.inc(category, str(attempts))
     
-    raise HTTPException(500, f"All models failed. Last error: {last_error}")
+    if cache_key is not None:
+        if cache_write and not shared:
+            response_cache.put(cache_key, result.body, model_id, provider)
+        annotate_access_log(cache="miss" if cache_read else "bypass")
+        return Response(content=result.body, media_type="application/json",
+                        headers={"X-Router-Cache": "miss" if cache_read else "bypass"})
+    
+    # Upstream bytes as-is: no re-serialization
+    return Response(content=result.body, media_type="application/json")
+
+batch_stats = {"batches": 0, "items": 0, "failed": 0, "active": 0}
+
+@app.post("/v1/chat/completions/batch")
+@app.post("/chat/completions/batch")
+async def batch_chat_completions(http_request: Request):
+    """Run many chat completions; results stream back as JSONL, then a summary line"""
+    cfg = {**BATCH_DEFAULTS, **batch_config}
+    try:
+        items = parse_batch_items(await http_request.body())
+    except ValueError as e:
+        raise HTTPException(400, f"Invalid batch: {e}")
+    if not items:
+        raise HTTPException(400, "Empty batch")
+    if len(items) > cfg["max_items"]:
+        raise HTTPException(413, f"Batch of {len(items)} items exceeds max_items ({cfg['max_items']})")
+    
+    runner = BatchRunner(items, cfg)
+    batch_stats["batches"] += 1
+    batch_stats["items"] += len(items)
+    annotate_access_log(batch=runner.id, batch_items=len(items))
+    
+    async def lines():
+        batch_stats["active"] += 1
+        task = asyncio.create_task(runner.run())
+        try:
+            while (line := await runner.lines.get()) is not None:
+                yield line
+            await task
+            summary = runner.summary()
+            batch_stats["failed"] += summary["failed"]
+            annotate_access_log(batch_failed=summary["failed"], cost_usd=summary["cost_usd"])
+            yield json_dumps(summary) + b"\n"
+        finally:
+            batch_stats["active"] -= 1
+            # Client gone: stop the remaining items
+            if not task.done():
+                task.cancel()
+    
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers={"X-Router-Batch": runner.id})
+
+background_tasks: set = set()
 
 @app.on_event("startup")
 async def startup_event():
+    await provider_pools.start()
+    if health_checker.config()["enabled"]:
+        # Connect before the first request rather than during it
+        try:
+            await asyncio.wait_for(health_checker.warm(), health_checker.config()["warm_timeout_sec"])
+        except asyncio.TimeoutError:
+            print("Connection pre-warming timed out")
+    background_tasks.add(asyncio.create_task(health_checker.run()))
+    if CONFIG_WATCH_SEC > 0:
+        background_tasks.add(asyncio.create_task(config_store.watch()))
+    if registry.multiproc_dir:
+        background_tasks.add(asyncio.create_task(metrics_sync_loop()))
+    if ROUTING_MODE == "semantic":
+        # Embed the utterances before the first request rather than during it
+        try:
+            await semantic_router.ensure_index()
+        except Exception as e:
+            print(f"Semantic index build failed: {e}")
+    if shared_state.backend is not None:
+        await shared_state.sync()
+        background_tasks.add(asyncio.create_task(shared_state.run()))
     print(f"LLM Router v0.5.0 started")
     print(f"Routing mode: {ROUTING_MODE}")
     print(f"Providers: {list(PROVIDERS.keys())}")
     print(f"Categories: {list(model_mappings.keys())}")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    await shared_state.sync()
+    shared_state.close()
+    if registry.multiproc_dir:
+        await asyncio.to_thread(registry.dump, registry.snapshot())
+    await provider_pools.close()
+    await asyncio.to_thread(circuit_breaker.persister.stop)
+    if routing_cache.persister:
+        await asyncio.to_thread(routing_cache.persister.stop)
+    response_cache.close()
+    await asyncio.to_thread(request_events.stop)
+    if access_log:
+        await asyncio.to_thread(access_log.stop)
@@ -0,0 +1,79 @@
+# Shared setup: import main without picking up a local router config
+import os
+import sys
+import tempfile
+
+import httpx
+import pytest
+
+STATE_DIR = tempfile.mkdtemp(prefix="llm-router-tests-")
+os.environ.update({
+    "ROUTER_CONFIG_FILE": os.path.join(STATE_DIR, "router_config.json"),
+    "OPENAI_API_KEY": "test",
+    "OPENAI_BASE_URL": "http://openai.test/v1",
+    "EVENT_STORE_DB": "",
+    "CONFIG_WATCH_SEC": "0",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+@pytest.fixture
+def new_breaker(monkeypatch, tmp_path):
+    """Factory of CircuitBreakers persisting to tmp_path, stopped after the test"""
+    monkeypatch.setattr(main, "CIRCUIT_BREAKER_FILE", str(tmp_path / "circuit_breaker_state.json"))
+    created = []
+    
+    def create() -> main.CircuitBreaker:
+        cb = main.CircuitBreaker()
+        created.append(cb)
+        return cb
+    
+    yield create
+    for cb in created:
+        cb.persister.stop()
+
+@pytest.fixture
+def breaker(new_breaker, monkeypatch):
+    """A fresh CircuitBreaker with default settings, installed as main.circuit_breaker"""
+    monkeypatch.setattr(main, "circuit_breaker_config", {})
+    cb = new_breaker()
+    monkeypatch.setattr(main, "circuit_breaker", cb)
+    return cb
+
+@pytest.fixture
+def routing_config():
+    """Install a routing config for one test; the previous table comes back afterwards"""
+    previous = main.routing_table
+    yield main.config_store.apply
+    main.config_store.install(previous)
+
+def expire(cb, model: str):
+    """Move an open circuit past its recovery timeout"""
+    cb.opened_at[model] -= 10 ** 6
+
+def completion(request: httpx.Request) -> httpx.Response:
+    """A minimal OpenAI chat completion for whichever model was asked"""
+    model = main.json.loads(request.content)["model"]
+    return httpx.Response(200, json={
+        "id": "chatcmpl-test", "object": "chat.completion", "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 5, "completion_tokens": 1, "total_tokens": 6}})
+
+class Upstream(list):
+    """Requests seen by the mocked openai provider; `respond` answers them"""
+    
+    def __init__(self):
+        super().__init__()
+        self.respond = completion
+    
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.append(request)
+        return self.respond(request)
+
+@pytest.fixture
+def upstream(monkeypatch):
+    seen = Upstream()
+    client = httpx.AsyncClient(transport=httpx.MockTransport(seen))
+    monkeypatch.setitem(main.provider_pools.clients, "openai", client)
+    return seen
@@ -0,0 +1,299 @@
+import json
+
+import httpx
+import pytest
+
+import main
+
+TOOLS = [{"type": "function", "function": {
+    "name": "get_weather", "description": "Weather of a city",
+    "parameters": {"type": "object", "properties": {"city": {"type": "string"}}, "additionalProperties": False}}}]
+
+# An agent loop turn: two parallel tool calls answered, then a follow-up question
+CONVERSATION = [
+    {"role": "system", "content": "Be brief."},
+    {"role": "user", "content": "Weather in Paris and Lyon?"},
+    {"role": "assistant", "content": None, "tool_calls": [
+        {"id": "c1", "type": "function", "function": {"name": "get_weather", "arguments": '{"city": "Paris"}'}},
+        {"id": "c2", "type": "function", "function": {"name": "get_weather", "arguments": '{"city": "Lyon"}'}}]},
+    {"role": "tool", "tool_call_id": "c1", "content": '{"temp": 18}'},
+    {"role": "tool", "tool_call_id": "c2", "content": "sunny"},
+    {"role": "user", "content": "And tomorrow?"},
+]
+
+def chat(messages=CONVERSATION, **fields) -> main.ChatCompletionRequest:
+    return main.ChatCompletionRequest(model="router", messages=messages, **fields)
+
+def build(provider: str, model_name: str, request: main.ChatCompletionRequest, stream: bool = False):
+    return main.adapter_for(provider).build(main.PROVIDERS[provider], model_name, request, stream)
+
+async def translate(events) -> list:
+    """Decoded data: payloads of a translated stream, "[DONE]" included"""
+    out = []
+    async for event in events:
+        data = event.decode("utf-8")[len("data: "):].strip()
+        out.append(data if data == "[DONE]" else json.loads(data))
+    return out
+
+def sse(*events) -> httpx.Response:
+    return httpx.Response(200, content="".join(f"data: {json.dumps(e)}\n\n" for e in events).encode("utf-8"))
+
+def deltas(chunks: list) -> list:
+    return [c["choices"][0]["delta"] for c in chunks if c != "[DONE]"]
+
+def test_openai_payload_passes_fields_through():
+    url, payload = build("openai", "gpt-4o-mini", chat(stop=["END"], max_tokens=20, tools=TOOLS), stream=True)
+    assert url == main.PROVIDERS["openai"]["base_url"] + "/chat/completions"
+    assert payload["messages"] == CONVERSATION
+    assert payload["stop"] == ["END"]
+    assert payload["max_tokens"] == 20
+    assert payload["tools"] == TOOLS
+    assert payload["stream_options"] == {"include_usage": True}
+
+def test_anthropic_messages_translate_tool_turns():
+    system, messages = main.anthropic_messages(CONVERSATION)
+    assert system == [{"type": "text", "text": "Be brief."}]
+    assert [m["role"] for m in messages] == ["user", "assistant", "user"]
+    assert messages[1]["content"] == [
+        {"type": "tool_use", "id": "c1", "name": "get_weather", "input": {"city": "Paris"}},
+        {"type": "tool_use", "id": "c2", "name": "get_weather", "input": {"city": "Lyon"}},
+    ]
+    # Parallel results and the next user message share one user turn
+    assert messages[2]["content"] == [
+        {"type": "tool_result", "tool_use_id": "c1", "content": '{"temp": 18}'},
+        {"type": "tool_result", "tool_use_id": "c2", "content": "sunny"},
+        {"type": "text", "text": "And tomorrow?"},
+    ]
+
+def test_anthropic_content_parts():
+    _, messages = main.anthropic_messages([{"role": "user", "content": [
+        {"type": "text", "text": "What is this?"},
+        {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}},
+        {"type": "image_url", "image_url": {"url": "https://example.com/cat.jpg"}},
+    ]}])
+    assert messages[0]["content"][1:] == [
+        {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": "AAAA"}},
+        {"type": "image", "source": {"type": "url", "url": "https://example.com/cat.jpg"}},
+    ]
+
+def test_anthropic_payload(monkeypatch):
+    monkeypatch.setattr(main, "prompt_cache_config", {"enabled": False})
+    url, payload = build("anthropic", "claude-3-5-haiku-latest",
+                         chat(temperature=1.5, stop=["END"], tools=TOOLS, tool_choice="required"), stream=True)
+    assert url == main.PROVIDERS["anthropic"]["base_url"] + "/messages"
+    assert payload["temperature"] == 1.0
+    assert payload["stop_sequences"] == ["END"]
+    assert payload["max_tokens"] > 0
+    assert payload["tools"] == [{"name": "get_weather", "description": "Weather of a city",
+                                 "input_schema": TOOLS[0]["function"]["parameters"]}]
+    assert payload["tool_choice"] == {"type": "any"}
+    assert payload["stream"] is True
+    assert main.anthropic_tool_choice({"type": "function", "function": {"name": "f"}}) == {"type": "tool", "name": "f"}
+
+def cache_markers(payload: dict) -> dict:
+    return {
+        "system": [b.get("cache_control") for b in payload.get("system", [])],
+        "tools": [t.get("cache_control") for t in payload.get("tools", [])],
+        "messages": [b.get("cache_control") for m in payload["messages"] for b in m["content"]],
+    }
+
+def test_anthropic_cache_breakpoints_on_long_prefixes(monkeypatch):
+    monkeypatch.setattr(main, "prompt_cache_config", {"min_tokens": 100})
+    long_system = [{"role": "system", "content": "rules " * 100}, {"role": "user", "content": "hi"}]
+    _, payload = build("anthropic", "claude-3-5-haiku-latest", chat(long_system))
+    assert cache_markers(payload) == {"system": [{"type": "ephemeral"}], "tools": [],
+                                      "messages": [{"type": "ephemeral"}]}
+
+    # Tools come before the system prompt in the cached prefix: marking it covers both
+    long_tools = [{"type": "function", "function": {**TOOLS[0]["function"], "description": "x" * 500}}]
+    _, payload = build("anthropic", "claude-3-5-haiku-latest", chat(CONVERSATION, tools=long_tools))
+    assert cache_markers(payload)["system"] == [{"type": "ephemeral"}]
+    assert cache_markers(payload)["tools"] == [None]
+
+    # Without a system prompt the marker goes after the tools
+    _, payload = build("anthropic", "claude-3-5-haiku-latest", chat(CONVERSATION[1:], tools=long_tools))
+    markers = cache_markers(payload)
+    assert markers["tools"] == [{"type": "ephemeral"}]
+    # Only the last block of the conversation is marked (the whole prompt counts toward min_tokens)
+    assert markers["messages"] == [None] * (len(markers["messages"]) - 1) + [{"type": "ephemeral"}]
+
+def test_anthropic_cache_leaves_short_prompts_alone(monkeypatch):
+    monkeypatch.setattr(main, "prompt_cache_config", {})
+    _, payload = build("anthropic", "claude-3-5-haiku-latest", chat(tools=TOOLS))
+    markers = cache_markers(payload)
+    assert not any(markers["system"] + markers["tools"] + markers["messages"])
+
+def test_anthropic_cache_ttl_and_messages_setting(monkeypatch):
+    monkeypatch.setattr(main, "prompt_cache_config", {"min_tokens": 100, "anthropic_ttl": "1h", "cache_messages": False})
+    long_system = [{"role": "system", "content": "rules " * 100}, {"role": "user", "content": "hi"}]
+    _, payload = build("anthropic", "claude-3-5-haiku-latest", chat(long_system))
+    assert cache_markers(payload) == {"system": [{"type": "ephemeral", "ttl": "1h"}], "tools": [], "messages": [None]}
+
+def test_anthropic_response():
+    body = json.dumps({"id": "msg_1", "model": "claude-3-5-haiku-latest", "stop_reason": "tool_use",
+                       "content": [{"type": "text", "text": "Checking."},
+                                   {"type": "tool_use", "id": "t1", "name": "get_weather", "input": {"city": "Paris"}}],
+                       "usage": {"input_tokens": 10, "output_tokens": 5, "cache_read_input_tokens": 100}}).encode()
+    data = main.json_loads(main.AnthropicAdapter().response(body, "claude-3-5-haiku-latest").body)
+    choice = data["choices"][0]
+    assert choice["finish_reason"] == "tool_calls"
+    assert choice["message"]["content"] == "Checking."
+    assert choice["message"]["tool_calls"][0]["function"] == {"name": "get_weather", "arguments": '{"city":"Paris"}'}
+    assert data["usage"]["prompt_tokens"] == 110
+    assert data["usage"]["prompt_tokens_details"]["cached_tokens"] == 100
+
+@pytest.mark.asyncio
+async def test_anthropic_stream():
+    stats = main.StreamStats()
+    response = sse(
+        {"type": "message_start", "message": {"usage": {"input_tokens": 10, "cache_read_input_tokens": 5}}},
+        {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+        {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "Hel"}},
+        {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "lo"}},
+        {"type": "content_block_start", "index": 1, "content_block": {"type": "tool_use", "id": "t1", "name": "get_weather"}},
+        {"type": "content_block_delta", "index": 1, "delta": {"type": "input_json_delta", "partial_json": '{"city":'}},
+        {"type": "content_block_delta", "index": 1, "delta": {"type": "input_json_delta", "partial_json": '"Paris"}'}},
+        {"type": "message_delta", "delta": {"stop_reason": "tool_use"}, "usage": {"output_tokens": 7}},
+        {"type": "message_stop"},
+    )
+    chunks = await translate(main.iter_anthropic_stream(response, "claude-3-5-haiku-latest", stats))
+    assert chunks[-1] == "[DONE]"
+    found = deltas(chunks)
+    assert found[0]["role"] == "assistant"
+    assert "".join(d.get("content", "") for d in found) == "Hello"
+    calls = [c for d in found for c in d.get("tool_calls", [])]
+    assert calls[0] == {"index": 0, "id": "t1", "type": "function", "function": {"name": "get_weather", "arguments": ""}}
+    assert "".join(c["function"]["arguments"] for c in calls) == '{"city":"Paris"}'
+    assert {c["index"] for c in calls} == {0}
+    final = chunks[-2]
+    assert final["choices"][0]["finish_reason"] == "tool_calls"
+    assert final["usage"]["prompt_tokens"] == 15
+    assert final["usage"]["completion_tokens"] == 7
+    assert stats.usage == final["usage"]
+
+@pytest.mark.asyncio
+async def test_anthropic_stream_error_raises():
+    response = sse({"type": "message_start", "message": {"usage": {}}},
+                   {"type": "error", "error": {"type": "overloaded_error"}})
+    with pytest.raises(Exception, match="overloaded_error"):
+        await translate(main.iter_anthropic_stream(response, "claude-3-5-haiku-latest", main.StreamStats()))
+
+def test_gemini_contents_translate_tool_turns():
+    system, contents = main.gemini_contents(CONVERSATION)
+    assert system == [{"text": "Be brief."}]
+    assert [c["role"] for c in contents] == ["user", "model", "user"]
+    assert contents[1]["parts"] == [
+        {"functionCall": {"name": "get_weather", "args": {"city": "Paris"}}},
+        {"functionCall": {"name": "get_weather", "args": {"city": "Lyon"}}},
+    ]
+    # Function names come from the matching call; non-object results are wrapped
+    assert contents[2]["parts"] == [
+        {"functionResponse": {"name": "get_weather", "response": {"temp": 18}}},
+        {"functionResponse": {"name": "get_weather", "response": {"content": "sunny"}}},
+        {"text": "And tomorrow?"},
+    ]
+
+def test_google_payload(monkeypatch):
+    monkeypatch.setattr(main, "prompt_cache_config", {})
+    request = chat(temperature=0.2, max_tokens=50, stop=["END"], tools=TOOLS, tool_choice="auto")
+    url, payload = build("google", "gemini-2.0-flash", request)
+    assert url == main.PROVIDERS["google"]["base_url"] + "/models/gemini-2.0-flash:generateContent"
+    assert payload["systemInstruction"] == {"parts": [{"text": "Be brief."}]}
+    assert payload["tools"] == [{"functionDeclarations": [{
+        "name": "get_weather", "description": "Weather of a city",
+        "parameters": {"type": "object", "properties": {"city": {"type": "string"}}}}]}]
+    assert payload["toolConfig"] == {"functionCallingConfig": {"mode": "AUTO"}}
+    assert payload["generationConfig"] == {"temperature": 0.2, "maxOutputTokens": 50, "stopSequences": ["END"]}
+    assert "cachedContent" not in payload
+    url, _ = build("google", "gemini-2.0-flash", request, stream=True)
+    assert url.endswith(":streamGenerateContent?alt=sse")
+
+@pytest.mark.asyncio
+async def test_google_context_cache(monkeypatch):
+    monkeypatch.setattr(main, "prompt_cache_config", {"gemini_min_tokens": 100, "gemini_min_hits": 2})
+    monkeypatch.setattr(main, "gemini_cache", main.GeminiContextCache())
+    created = []
+
+    def respond(request: httpx.Request) -> httpx.Response:
+        created.append(main.json_loads(request.content))
+        return httpx.Response(200, json={"name": "cachedContents/abc"})
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(respond))
+    monkeypatch.setitem(main.provider_pools.clients, "google", client)
+    request = chat([{"role": "system", "content": "rules " * 100}, {"role": "user", "content": "hi"}])
+
+    _, first = build("google", "gemini-2.0-flash", request)
+    _, second = build("google", "gemini-2.0-flash", request)  # Second sighting: created in the background
+    assert "systemInstruction" in first and "systemInstruction" in second
+    for task in list(main.gemini_cache.tasks):
+        await task
+    assert created[0]["model"] == "models/gemini-2.0-flash"
+    assert created[0]["systemInstruction"] == first["systemInstruction"]
+
+    _, third = build("google", "gemini-2.0-flash", request)
+    assert third["cachedContent"] == "cachedContents/abc"
+    assert "systemInstruction" not in third
+
+    main.adapter_for("google").failed(third, 404)  # Expired upstream: send the prefix again
+    _, fourth = build("google", "gemini-2.0-flash", request)
+    assert "cachedContent" not in fourth
+    assert main.gemini_cache.get_stats()["invalidated"] == 1
+
+@pytest.mark.asyncio
+async def test_gemini_stream():
+    stats = main.StreamStats()
+    response = sse(
+        {"candidates": [{"content": {"role": "model", "parts": [{"text": "Hel"}]}}]},
+        {"candidates": [{"content": {"role": "model", "parts": [{"text": "lo"}]}}]},
+        {"candidates": [{"content": {"role": "model", "parts": [
+            {"functionCall": {"name": "get_weather", "args": {"city": "Paris"}}}]}, "finishReason": "STOP"}],
+         "usageMetadata": {"promptTokenCount": 12, "candidatesTokenCount": 4, "cachedContentTokenCount": 8}},
+    )
+    chunks = await translate(main.iter_gemini_stream(response, "gemini-2.0-flash", stats))
+    assert chunks[-1] == "[DONE]"
+    found = deltas(chunks)
+    assert found[0]["role"] == "assistant"
+    assert "".join(d.get("content", "") for d in found) == "Hello"
+    calls = [c for d in found for c in d.get("tool_calls", [])]
+    assert len(calls) == 1
+    assert calls[0]["index"] == 0
+    assert calls[0]["function"] == {"name": "get_weather", "arguments": '{"city":"Paris"}'}
+    final = chunks[-2]
+    assert final["choices"][0]["finish_reason"] == "tool_calls"
+    assert final["usage"]["prompt_tokens"] == 12
+    assert final["usage"]["prompt_tokens_details"]["cached_tokens"] == 8
+    assert stats.usage == final["usage"]
+
+def test_ollama_payload():
+    url, payload = build("ollama", "llama3.2", chat(temperature=None, max_tokens=30, stop=["END"], tools=TOOLS))
+    assert url == main.PROVIDERS["ollama"]["base_url"] + "/api/chat"
+    assert payload["options"] == {"temperature": 1.0, "num_predict": 30, "stop": ["END"]}
+    assert payload["tools"] == TOOLS
+    assert payload["messages"][2]["tool_calls"] == [
+        {"function": {"name": "get_weather", "arguments": {"city": "Paris"}}},
+        {"function": {"name": "get_weather", "arguments": {"city": "Lyon"}}},
+    ]
+    assert payload["messages"][3] == CONVERSATION[3]
+
+@pytest.mark.asyncio
+async def test_ollama_stream():
+    stats = main.StreamStats()
+    lines = [
+        {"message": {"role": "assistant", "content": "Hel"}, "done": False},
+        {"message": {"role": "assistant", "content": "lo"}, "done": False},
+        {"message": {"role": "assistant", "content": "", "tool_calls": [
+            {"function": {"name": "get_weather", "arguments": {"city": "Paris"}}}]}, "done": False},
+        {"message": {"role": "assistant", "content": ""}, "done": True, "prompt_eval_count": 9, "eval_count": 3},
+    ]
+    response = httpx.Response(200, content="".join(json.dumps(line) + "\n" for line in lines).encode("utf-8"))
+    chunks = await translate(main.iter_ollama_stream(response, "llama3.2", stats))
+    assert chunks[-1] == "[DONE]"
+    found = deltas(chunks)
+    assert found[0]["role"] == "assistant"
+    assert "".join(d.get("content", "") for d in found) == "Hello"
+    calls = [c for d in found for c in d.get("tool_calls", [])]
+    assert calls[0]["function"] == {"name": "get_weather", "arguments": '{"city":"Paris"}'}
+    final = chunks[-2]
+    assert final["choices"][0]["finish_reason"] == "tool_calls"
+    assert final["usage"] == {"prompt_tokens": 9, "completion_tokens": 3, "total_tokens": 12}
+    assert stats.usage == final["usage"]
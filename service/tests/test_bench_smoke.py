@@ -0,0 +1,23 @@
+# Short run of the load benchmark: every scenario must complete without errors
+import json
+import os
+import subprocess
+import sys
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SERVICE_DIR, "bench"))
+
+from bench_router import SCENARIOS  # noqa: E402
+
+def test_bench_router_runs_every_scenario(tmp_path):
+    results_file = tmp_path / "results.json"
+    subprocess.run(
+        [sys.executable, os.path.join("bench", "bench_router.py"), "--concurrency", "2", "--requests", "10",
+         "--latency-ms", "1", "--router-latency-ms", "1", "--chunk-delay-ms", "0", "--json", str(results_file)],
+        cwd=SERVICE_DIR, check=True, capture_output=True, timeout=120,
+    )
+    results = json.loads(results_file.read_text())
+    assert [r["scenario"] for r in results] == SCENARIOS
+    for result in results:
+        assert result["errors"] == 0, result
+        assert result["throughput_rps"] > 0
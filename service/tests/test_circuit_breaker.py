@@ -0,0 +1,116 @@
+import main
+from conftest import expire
+
+MODEL = "openai/gpt-4o-mini"
+
+def trip(cb, model=MODEL):
+    for _ in range(cb.config()["failure_threshold"]):
+        cb.record_failure(model)
+
+def test_trips_after_consecutive_failures(breaker):
+    breaker.record_failure(MODEL)
+    breaker.record_failure(MODEL)
+    assert breaker.state(MODEL) == "closed"
+    breaker.record_failure(MODEL)
+    assert breaker.state(MODEL) == "open"
+    assert not breaker.is_available(MODEL)
+
+def test_success_resets_consecutive_failures(breaker):
+    breaker.record_failure(MODEL)
+    breaker.record_failure(MODEL)
+    breaker.record_success(MODEL)
+    breaker.record_failure(MODEL)
+    assert breaker.state(MODEL) == "closed"
+
+def test_half_open_admits_one_trial_at_a_time(breaker):
+    trip(breaker)
+    expire(breaker, MODEL)
+    assert breaker.is_available(MODEL)
+    assert breaker.state(MODEL) == "half_open"
+    assert breaker.probes[MODEL]["inflight"] == 1
+    assert not breaker.is_available(MODEL)
+
+def test_release_gives_the_trial_slot_back(breaker):
+    trip(breaker)
+    expire(breaker, MODEL)
+    assert breaker.is_available(MODEL)
+    breaker.release(MODEL)
+    assert breaker.probes[MODEL]["inflight"] == 0
+    assert breaker.is_available(MODEL)
+
+def test_trial_without_outcome_frees_its_slot_after_probe_timeout(breaker):
+    trip(breaker)
+    expire(breaker, MODEL)
+    assert breaker.is_available(MODEL)
+    assert not breaker.is_available(MODEL)
+    breaker.probes[MODEL]["started"] -= breaker.config()["probe_timeout_sec"] + 1
+    assert breaker.is_available(MODEL)
+    assert breaker.probes[MODEL]["inflight"] == 1
+
+def test_successful_trial_closes_the_circuit(breaker):
+    trip(breaker)
+    expire(breaker, MODEL)
+    assert breaker.is_available(MODEL)
+    breaker.record_success(MODEL)
+    assert breaker.state(MODEL) == "closed"
+    assert MODEL not in breaker.probes
+
+def test_close_needs_half_open_successes(breaker, monkeypatch):
+    monkeypatch.setattr(main, "circuit_breaker_config", {"half_open_successes": 2})
+    trip(breaker)
+    expire(breaker, MODEL)
+    assert breaker.is_available(MODEL)
+    breaker.record_success(MODEL)
+    assert breaker.state(MODEL) == "half_open"
+    assert breaker.probes[MODEL]["inflight"] == 0
+    assert breaker.is_available(MODEL)
+    breaker.record_success(MODEL)
+    assert breaker.state(MODEL) == "closed"
+
+def test_failed_trial_reopens_with_backoff(breaker):
+    cfg = breaker.config()
+    trip(breaker)
+    assert breaker.open_timeout(MODEL, cfg) == cfg["recovery_timeout_sec"]
+    expire(breaker, MODEL)
+    assert breaker.is_available(MODEL)
+    breaker.record_failure(MODEL)
+    assert breaker.state(MODEL) == "open"
+    assert breaker.trip_reasons["probe_failed"] == 1
+    assert breaker.open_timeout(MODEL, cfg) == cfg["recovery_timeout_sec"] * cfg["backoff_multiplier"]
+    assert not breaker.is_available(MODEL)
+
+def test_late_success_does_not_close_an_open_circuit(breaker):
+    trip(breaker)
+    breaker.record_success(MODEL)
+    assert breaker.state(MODEL) == "open"
+
+def test_error_rate_trips_over_the_window(breaker, monkeypatch):
+    monkeypatch.setattr(main, "circuit_breaker_config",
+                        {"failure_threshold": 100, "error_rate_threshold": 0.5, "min_calls": 4})
+    for success in (True, False, True, False):
+        if success:
+            breaker.record_success(MODEL)
+        else:
+            breaker.record_failure(MODEL)
+    assert breaker.state(MODEL) == "open"
+    assert breaker.trip_reasons["error_rate"] == 1
+
+def test_trials_of_probed_models_go_to_probes_only(breaker):
+    breaker.probed = frozenset({MODEL})
+    trip(breaker)
+    expire(breaker, MODEL)
+    assert not breaker.is_available(MODEL)
+    assert breaker.state(MODEL) == "open"  # A refused user request changes nothing
+    assert breaker.is_available(MODEL, probe=True)
+    assert breaker.state(MODEL) == "half_open"
+    assert not breaker.is_available(MODEL)
+    breaker.record_success(MODEL)
+    assert breaker.state(MODEL) == "closed"
+    assert breaker.is_available(MODEL)
+
+def test_state_survives_a_restart(breaker, new_breaker):
+    trip(breaker)
+    breaker.persister.stop()  # Flushes
+    restored = new_breaker()
+    assert restored.state(MODEL) == "open"
+    assert restored.trips[MODEL] == 1
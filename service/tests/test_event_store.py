@@ -0,0 +1,110 @@
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    """An event store on a temp database, flushed by the test rather than the writer thread"""
+    events = main.RequestEventStore(str(tmp_path / "events.db"), buffer_size=1000)
+    monkeypatch.setattr(events, "_start", lambda: None)
+    monkeypatch.setattr(main, "request_events", events)
+    yield events
+    events.stop()
+
+def record(store, latency_ms=100.0, category="code", model="openai/a", user="alice", success=True, cached=False,
+           attempts=1, cost_usd=0.001):
+    store.record(category, model, model.split("/")[0], user, "keywords", latency_ms, cost_usd, success, cached,
+                 attempts, None if success else "HTTP 500")
+
+def test_ring_buffer_keeps_the_newest_events(store, tmp_path, monkeypatch):
+    ring = main.RequestEventStore(str(tmp_path / "ring.db"), buffer_size=3)
+    monkeypatch.setattr(ring, "_start", lambda: None)
+    for latency in (1, 2, 3, 4, 5):
+        record(ring, latency_ms=latency)
+    assert ring.stats["recorded"] == 5
+    assert ring.stats["dropped"] == 2
+    assert [event[6] for event in ring.pending] == [3, 4, 5]
+    assert ring.flush() == 3
+    assert ring.flush() == 0
+    assert [e["latency_ms"] for e in ring.events(0, time.time() + 1, {}, 10)] == [5, 4, 3]
+
+def test_recent_requests_format(store):
+    record(store, success=False)
+    record(store, cached=True)
+    first, second = store.recent_requests(10)
+    assert first["error"] == "HTTP 500"
+    assert not first["success"]
+    assert second["cached"] is True
+    assert second["timestamp"].endswith("Z")
+
+def test_rollups_count_failures_cache_hits_and_fallbacks(store):
+    record(store)
+    record(store, success=False)
+    record(store, cached=True, latency_ms=1)
+    record(store, attempts=2)
+    record(store, model="openai/b")
+    [a, b] = store.aggregate(time.time() - 60, time.time() + 60, ["model"], {})
+    assert a["model"] == "openai/a"
+    assert (a["requests"], a["failures"], a["cached"]) == (4, 1, 1)
+    assert a["error_rate"] == 0.25
+    assert a["fallback_rate"] == 0.25
+    assert a["cost_usd"] == pytest.approx(0.004)
+    assert a["latency_ms"]["avg"] == 100.0  # The cache hit is left out
+    assert b["requests"] == 1
+
+def test_latency_percentiles_from_rollup_buckets(store):
+    for _ in range(98):
+        record(store, latency_ms=10)
+    record(store, latency_ms=1000)
+    record(store, latency_ms=1000)
+    [group] = store.aggregate(time.time() - 60, time.time() + 60, [], {})
+    latency = group["latency_ms"]
+    # Buckets are 25% wide: percentiles are exact to within one bucket
+    assert 10 / 1.25 <= latency["p50"] <= 10 * 1.25
+    assert 10 / 1.25 <= latency["p95"] <= 10 * 1.25
+    assert 1000 / 1.25 <= latency["p99"] <= 1000 * 1.25
+    assert latency["avg"] == pytest.approx(29.8)
+
+def test_filters_and_time_window(store):
+    record(store, user="alice")
+    record(store, user="bob", category="reasoning")
+    now = time.time()
+    [group] = store.aggregate(now - 60, now + 60, ["category"], {"user": "bob"})
+    assert (group["category"], group["requests"]) == ("reasoning", 1)
+    assert store.aggregate(now + 120, now + 180, [], {}) == []
+    assert [e["user"] for e in store.events(now - 60, now + 60, {"category": "code"}, 10)] == ["alice"]
+
+def test_events_survive_a_restart(store, tmp_path):
+    record(store)
+    store.stop()
+    reopened = main.RequestEventStore(str(tmp_path / "events.db"))
+    assert len(reopened.events(0, time.time() + 1, {}, 10)) == 1
+
+@pytest.mark.parametrize("value, expected", [
+    ("15m", 1000.0 - 900),
+    ("2h", 1000.0 - 7200),
+    ("1700000000", 1700000000.0),
+    ("2024-01-01T00:00:00Z", 1704067200.0),
+    ("2024-01-01T00:00:00", 1704067200.0),
+    (None, None),
+])
+def test_parse_time(value, expected):
+    assert main.parse_time(value, 1000.0) == expected
+
+def test_events_endpoints_validate_their_filters(store):
+    client = TestClient(main.app)
+    record(store, user="alice")
+    record(store, user="bob")
+    assert client.get("/events/stats", params={"group_by": "model,colour"}).status_code == 400
+    assert client.get("/events", params={"since": "yesterday"}).status_code == 400
+    
+    response = client.get("/events/stats", params={"group_by": "user", "window": "1h", "user": "bob", "colour": "red"})
+    assert response.status_code == 200
+    assert response.json()["filters"] == {"user": "bob"}  # Unknown parameters are not filters
+    assert [g["user"] for g in response.json()["groups"]] == ["bob"]
+    
+    response = client.get("/events", params={"limit": 1})
+    assert response.json()["count"] == 1
@@ -0,0 +1,138 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+from conftest import completion, expire
+
+MODEL = "openai/gpt-4o-mini"
+
+def models_list(request: httpx.Request) -> httpx.Response:
+    return httpx.Response(200, json={"data": []})
+
+def answer(upstream, get=models_list, post=completion):
+    """Answer health endpoint GETs with `get` and model probe POSTs with `post`"""
+    upstream.respond = lambda request: get(request) if request.method == "GET" else post(request)
+
+@pytest.fixture
+def checker(routing_config, breaker, upstream):
+    def configure(health_checks=None, circuit_breaker=None):
+        routing_config({
+            "model_mappings": {category: [MODEL] for category in main.DEFAULT_MODEL_MAPPINGS},
+            "health_checks": health_checks or {},
+            "circuit_breaker": circuit_breaker or {},
+        })
+        answer(upstream)
+        return main.HealthChecker()
+    return configure
+
+def trip(cb):
+    for _ in range(cb.config()["failure_threshold"]):
+        cb.record_failure(MODEL)
+
+async def provider_rounds(hc, n: int):
+    for _ in range(n):
+        await hc.run_round()
+        await asyncio.sleep(0.01)  # Past provider_interval_sec
+
+@pytest.mark.asyncio
+async def test_only_provider_probes_by_default(checker, upstream, breaker):
+    hc = checker()
+    await hc.run_round()
+    assert [(r.method, r.url.path) for r in upstream] == [("GET", "/v1/models")]
+    assert breaker.probed == frozenset()
+
+@pytest.mark.asyncio
+async def test_one_failed_provider_probe_is_not_an_outage(checker, upstream, breaker):
+    hc = checker({"provider_interval_sec": 0.001})
+    answer(upstream, get=lambda r: httpx.Response(503))
+    await provider_rounds(hc, 1)
+    answer(upstream)
+    await provider_rounds(hc, 1)
+    answer(upstream, get=lambda r: httpx.Response(503))
+    await provider_rounds(hc, 1)
+    assert breaker.failures.get(MODEL, 0) == 0
+    assert hc.providers["openai"]["failures"] == 2
+    assert hc.provider_failures["openai"] == 1
+
+@pytest.mark.asyncio
+async def test_repeated_provider_failures_open_circuits(checker, upstream, breaker):
+    hc = checker({"provider_interval_sec": 0.001, "provider_failure_streak": 2}, {"failure_threshold": 2})
+    answer(upstream, get=lambda r: httpx.Response(503))
+    await provider_rounds(hc, 2)
+    assert breaker.state(MODEL) == "closed"
+    await provider_rounds(hc, 1)
+    assert breaker.state(MODEL) == "open"
+    assert hc.providers["openai"]["failures"] == 3
+
+@pytest.mark.asyncio
+async def test_unreachable_provider_counts_at_once(checker, upstream, breaker):
+    def refused(request: httpx.Request) -> httpx.Response:
+        raise httpx.ConnectError("connection refused", request=request)
+
+    hc = checker()
+    answer(upstream, get=refused)
+    await hc.run_round()
+    assert hc.providers["openai"]["status"] == "ConnectError"
+    assert breaker.failures[MODEL] == 1
+
+@pytest.mark.asyncio
+async def test_recovery_probe_closes_the_circuit_without_user_trials(checker, upstream, breaker):
+    hc = checker({"recover_by_probe": True})
+    trip(breaker)
+    await hc.run_round()  # Still within the recovery timeout: no model probe
+    assert not any(r.method == "POST" for r in upstream)
+    expire(breaker, MODEL)
+    assert not breaker.is_available(MODEL)
+    await hc.run_round()
+    assert breaker.state(MODEL) == "closed"
+    assert hc.stats["recovered"] == 1
+    post = next(r for r in upstream if r.method == "POST")
+    assert main.json_loads(post.content)["max_tokens"] == 1
+
+@pytest.mark.asyncio
+async def test_failed_recovery_probe_reopens(checker, upstream, breaker):
+    hc = checker({"recover_by_probe": True})
+    answer(upstream, post=lambda r: httpx.Response(500))
+    trip(breaker)
+    expire(breaker, MODEL)
+    await hc.run_round()
+    assert breaker.state(MODEL) == "open"
+    assert breaker.trips[MODEL] == 2
+
+@pytest.mark.asyncio
+async def test_inconclusive_probes_hand_trials_back_to_users(checker, upstream, breaker):
+    hc = checker({"recover_by_probe": True, "max_inconclusive": 2})
+    answer(upstream, post=lambda r: httpx.Response(400, json={"error": {"message": "max_tokens"}}))
+    trip(breaker)
+    expire(breaker, MODEL)
+    for _ in range(2):
+        await hc.run_round()
+        assert breaker.state(MODEL) == "half_open"
+        assert breaker.probes[MODEL]["inflight"] == 0  # Released, not held
+    assert hc.inconclusive[MODEL] == 2
+    await hc.run_round()
+    assert MODEL not in breaker.probed
+    assert breaker.is_available(MODEL)  # A user request gets the trial again
+
+@pytest.mark.asyncio
+async def test_model_probes_respect_the_budget(checker, upstream, breaker):
+    hc = checker({"model_interval_sec": 0.001, "provider_interval_sec": 0, "max_probes_per_min": 2})
+    hc.model_due[MODEL] = 0.0
+    for _ in range(4):
+        await hc.run_round()
+        hc.model_due[MODEL] = 0.0
+    assert sum(r.method == "POST" for r in upstream) == 2
+    assert hc.stats["over_budget"] == 2
+
+@pytest.mark.asyncio
+async def test_model_probes_go_through_the_rate_limiter(checker, upstream, breaker, monkeypatch):
+    hc = checker({"model_interval_sec": 0.001, "provider_interval_sec": 0})
+    monkeypatch.setattr(main, "rate_limit_config", {"models": {MODEL: {"rpm": 1}}})
+    monkeypatch.setattr(main, "rate_limiter", main.RateLimiter())
+    for _ in range(2):
+        hc.model_due[MODEL] = 0.0
+        await hc.run_round()
+    assert sum(r.method == "POST" for r in upstream) == 1
+    assert hc.models[MODEL]["result"] == "inconclusive"
@@ -0,0 +1,43 @@
+import httpx
+import pytest
+
+import main
+
+TOOL_CALL = {"id": "c1", "type": "function", "function": {"name": "f", "arguments": "{}"}}
+
+def chat(messages) -> main.ChatCompletionRequest:
+    return main.ChatCompletionRequest(model="router", messages=messages)
+
+def test_upstream_messages_are_the_clients_own():
+    sent = [
+        {"role": "user", "content": "hi"},
+        {"role": "assistant", "content": None, "tool_calls": [TOOL_CALL]},
+        {"role": "tool", "tool_call_id": "c1", "content": "42"},
+    ]
+    request = chat(sent)
+    assert main.upstream_messages(request) == sent
+    assert main.upstream_messages(request) is main.upstream_messages(request)  # Dumped once
+
+def test_usage_is_read_from_the_end_of_the_body():
+    body = b'{"id":"x","choices":[{"message":{"content":"a \\"usage\\": trap"}}],"usage":{"total_tokens":7}}'
+    assert main.UpstreamResponse(body).usage == {"total_tokens": 7}
+    assert main.UpstreamResponse(b'{"id":"x"}').usage == {}
+    assert main.UpstreamResponse(b'{"usage": null}').usage == {}
+
+@pytest.mark.asyncio
+async def test_call_model_keeps_the_upstream_body_untouched(upstream, monkeypatch):
+    monkeypatch.setattr(main, "rate_limiter", main.RateLimiter())
+    body = b'{"id":"chatcmpl-1",  "choices":[],\n "usage":{"prompt_tokens":1,"completion_tokens":1,"total_tokens":2}}'
+    upstream.respond = lambda r: httpx.Response(200, content=body)
+    result, provider = await main.call_model("openai/gpt-4o-mini", chat([{"role": "user", "content": "hi"}]))
+    assert provider == "openai"
+    assert result.body == body
+    assert result.usage["total_tokens"] == 2
+    assert main.json_loads(upstream[0].content)["messages"] == [{"role": "user", "content": "hi"}]
+
+@pytest.mark.asyncio
+async def test_call_model_refuses_a_non_json_body(upstream, monkeypatch):
+    monkeypatch.setattr(main, "rate_limiter", main.RateLimiter())
+    upstream.respond = lambda r: httpx.Response(200, content=b"<html>bad gateway</html>")
+    with pytest.raises(ValueError):
+        await main.call_model("openai/gpt-4o-mini", chat([{"role": "user", "content": "hi"}]))
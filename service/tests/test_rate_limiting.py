@@ -0,0 +1,157 @@
+import asyncio
+import email.utils
+import time
+
+import httpx
+import pytest
+
+import main
+
+@pytest.fixture
+def limiter(monkeypatch):
+    """A fresh RateLimiter installed as main.rate_limiter; returns a setter for its config"""
+    rl = main.RateLimiter()
+    monkeypatch.setattr(main, "rate_limiter", rl)
+    
+    def configure(**config):
+        monkeypatch.setattr(main, "rate_limit_config", config)
+        return rl
+    
+    configure()
+    return configure
+
+def drain(rl: main.RateLimiter, model_id: str, unit: str = "rpm"):
+    rl.buckets[("models", model_id, unit)].tokens = 0.0
+
+def chat() -> main.ChatCompletionRequest:
+    return main.ChatCompletionRequest(model="router", messages=[{"role": "user", "content": "hi"}], max_tokens=10)
+
+@pytest.mark.asyncio
+async def test_unlimited_models_are_admitted_at_once(limiter):
+    rl = limiter()
+    await rl.acquire("openai", "openai/a", 100, spill=False)
+    assert rl.buckets == {}
+
+@pytest.mark.asyncio
+async def test_queue_admits_in_order_until_the_deadline(limiter):
+    rl = limiter(models={"openai/a": {"rpm": 600}}, max_wait_ms=250)  # One request per 100 ms
+    await rl.acquire("openai", "openai/a", 1, spill=False)
+    drain(rl, "openai/a")
+    results = await asyncio.gather(*(rl.acquire("openai", "openai/a", 1, spill=False) for _ in range(3)),
+                                   return_exceptions=True)
+    assert results[:2] == [None, None]
+    assert isinstance(results[2], main.RateLimited)
+    assert rl.stats["waited"] == 2
+    assert rl.stats["rejected"] == 1
+    assert rl.depth["openai/a"] == 0
+
+@pytest.mark.asyncio
+async def test_wait_beyond_max_wait_is_refused_without_queueing(limiter):
+    rl = limiter(models={"openai/a": {"rpm": 1}}, max_wait_ms=100)
+    await rl.acquire("openai", "openai/a", 1, spill=False)
+    start = time.monotonic()
+    with pytest.raises(main.RateLimited) as refused:
+        await rl.acquire("openai", "openai/a", 1, spill=False)
+    assert time.monotonic() - start < 0.05
+    assert refused.value.retry_after > 50
+    assert not refused.value.upstream
+
+@pytest.mark.asyncio
+async def test_full_queue_refuses(limiter):
+    rl = limiter(models={"openai/a": {"rpm": 600}}, max_queue=1)
+    await rl.acquire("openai", "openai/a", 1, spill=False)
+    drain(rl, "openai/a")
+    waiting = asyncio.ensure_future(rl.acquire("openai", "openai/a", 1, spill=False))
+    await asyncio.sleep(0)
+    with pytest.raises(main.RateLimited):
+        await rl.acquire("openai", "openai/a", 1, spill=False)
+    await waiting
+
+@pytest.mark.asyncio
+async def test_spill_refuses_at_once_instead_of_waiting(limiter):
+    rl = limiter(models={"openai/a": {"rpm": 600}})
+    await rl.acquire("openai", "openai/a", 1, spill=False)
+    drain(rl, "openai/a")
+    with pytest.raises(main.RateLimited):
+        await rl.acquire("openai", "openai/a", 1, spill=True)
+    assert rl.stats["spilled"] == 1
+    
+    limiter(models={"openai/a": {"rpm": 600}}, spill_over=False)
+    await rl.acquire("openai", "openai/a", 1, spill=True)  # Waits ~100 ms instead
+    assert rl.stats["waited"] == 1
+
+@pytest.mark.asyncio
+async def test_token_limits_reserve_and_settle(limiter):
+    rl = limiter(providers={"openai": {"tpm": 1000}})
+    await rl.acquire("openai", "openai/a", 300, spill=False)
+    bucket = rl.buckets[("providers", "openai", "tpm")]
+    assert bucket.tokens == pytest.approx(700, abs=1)
+    rl.settle("openai", "openai/a", 300, 100)
+    assert bucket.tokens == pytest.approx(900, abs=1)
+
+@pytest.mark.asyncio
+async def test_chain_spills_to_the_next_model_without_waiting(limiter, breaker, upstream):
+    rl = limiter(models={"openai/a": {"rpm": 1}})
+    await rl.acquire("openai", "openai/a", 1, spill=False)
+    start = time.monotonic()
+    result, provider, model_id, attempts = await main.execute_chain(["openai/a", "openai/b"], chat())
+    assert time.monotonic() - start < 0.5
+    assert model_id == "openai/b"
+    assert [main.json.loads(r.content)["model"] for r in upstream] == ["b"]
+    assert breaker.state("openai/a") == "closed"
+
+@pytest.mark.parametrize("value, expected", [
+    ("7", 7.0),
+    ("0.5", 0.5),
+    ("-3", 0.0),
+    ("soon", None),
+    (None, None),
+])
+def test_parse_retry_after(value, expected):
+    assert main.parse_retry_after(value) == expected
+
+def test_parse_retry_after_http_date():
+    value = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert main.parse_retry_after(value) == pytest.approx(30, abs=2)
+
+@pytest.mark.asyncio
+async def test_upstream_429_pauses_the_model_for_retry_after(limiter, breaker, upstream):
+    rl = limiter(max_wait_ms=1000)
+    upstream.respond = lambda r: httpx.Response(429, headers={"Retry-After": "7"})
+    with pytest.raises(main.ChainFailure) as failure:
+        await main.execute_chain(["openai/a"], chat())
+    assert failure.value.retry_after == pytest.approx(7)
+    assert rl.blocked_until["openai/a"] - time.monotonic() == pytest.approx(7, abs=1)
+    assert rl.stats["upstream_429"] == 1
+    
+    # Paused for longer than max_wait: the next request is refused without calling the provider
+    with pytest.raises(main.RateLimited):
+        await rl.acquire("openai", "openai/a", 1, spill=True)
+    with pytest.raises(main.ChainFailure):
+        await main.execute_chain(["openai/a"], chat())
+    assert len(upstream) == 1
+
+@pytest.mark.asyncio
+async def test_upstream_429_without_retry_after_uses_the_default(limiter, breaker, upstream):
+    rl = limiter(default_retry_after_sec=3)
+    upstream.respond = lambda r: httpx.Response(429)
+    with pytest.raises(main.ChainFailure) as failure:
+        await main.execute_chain(["openai/a"], chat())
+    assert failure.value.retry_after == pytest.approx(3)
+
+@pytest.mark.asyncio
+async def test_429_is_not_a_breaker_failure(limiter, breaker, upstream):
+    limiter(default_retry_after_sec=0)
+    upstream.respond = lambda r: httpx.Response(429, headers={"Retry-After": "0"})
+    for _ in range(breaker.config()["failure_threshold"] + 1):
+        with pytest.raises(main.ChainFailure):
+            await main.execute_chain(["openai/a"], chat())
+    assert breaker.state("openai/a") == "closed"
+    assert breaker.failures["openai/a"] == 0
+    
+    upstream.respond = lambda r: httpx.Response(500)
+    for _ in range(breaker.config()["failure_threshold"]):
+        with pytest.raises(main.ChainFailure) as failure:
+            await main.execute_chain(["openai/a"], chat())
+    assert failure.value.retry_after is None
+    assert breaker.state("openai/a") == "open"
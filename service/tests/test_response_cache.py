@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+from starlette.requests import Request
+
+import main
+
+def cache(**options) -> main.ResponseCache:
+    return main.ResponseCache(**{"enabled": True, "max_entries": 10, "max_bytes": 1024, "ttl_sec": 60, "db_path": "",
+                                 **options})
+
+def request_with(headers: dict) -> Request:
+    return Request({"type": "http", "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()]})
+
+def chat(**fields) -> main.ChatCompletionRequest:
+    return main.ChatCompletionRequest(model="router", messages=[{"role": "user", "content": "hi"}], **fields)
+
+@pytest.mark.asyncio
+async def test_hit_returns_body_model_and_provider():
+    rc = cache()
+    rc.put("k", b'{"id":1}', "openai/gpt-4o-mini", "openai")
+    assert await rc.get("k") == (b'{"id":1}', "openai/gpt-4o-mini", "openai")
+    assert await rc.get("other") is None
+    assert rc.stats["hits_memory"] == 1
+    assert rc.stats["misses"] == 1
+
+@pytest.mark.asyncio
+async def test_expired_entries_are_dropped():
+    rc = cache(ttl_sec=-1)
+    rc.put("k", b"{}", "m", "p")
+    assert await rc.get("k") is None
+    assert rc.entries == {}
+    assert rc.bytes == 0
+
+@pytest.mark.asyncio
+async def test_lru_evicts_least_recently_used_by_count():
+    rc = cache(max_entries=2)
+    rc.put("a", b"{}", "m", "p")
+    rc.put("b", b"{}", "m", "p")
+    assert await rc.get("a") is not None
+    rc.put("c", b"{}", "m", "p")
+    assert list(rc.entries) == ["a", "c"]
+    assert rc.stats["evictions"] == 1
+
+def test_lru_evicts_by_total_bytes():
+    rc = cache(max_bytes=10)
+    rc.put("a", b"x" * 6, "m", "p")
+    rc.put("b", b"y" * 6, "m", "p")
+    assert list(rc.entries) == ["b"]
+    assert rc.bytes == 6
+    rc.put("c", b"z" * 11, "m", "p")  # Larger than the whole tier: not stored
+    assert list(rc.entries) == ["b"]
+
+@pytest.mark.asyncio
+async def test_sqlite_tier_serves_entries_after_a_restart(tmp_path):
+    db = str(tmp_path / "responses.db")
+    rc = cache(db_path=db)
+    rc.put("k", b'{"id":1}', "m", "p")
+    await asyncio.gather(*rc._background)
+    rc.close()
+    
+    restarted = cache(db_path=db)
+    try:
+        assert await restarted.get("k") == (b'{"id":1}', "m", "p")
+        assert restarted.stats["hits_disk"] == 1
+        assert "k" in restarted.entries  # Promoted to the memory tier
+        assert await restarted.get("k") is not None
+        assert restarted.stats["hits_memory"] == 1
+    finally:
+        restarted.close()
+
+@pytest.mark.asyncio
+async def test_sqlite_tier_skips_expired_rows(tmp_path):
+    rc = cache(db_path=str(tmp_path / "responses.db"), ttl_sec=-1)
+    try:
+        rc.put("k", b"{}", "m", "p")
+        await asyncio.gather(*rc._background)
+        rc.entries.clear()
+        assert await rc.get("k") is None
+    finally:
+        rc.close()
+
+def test_only_deterministic_non_streaming_requests_are_eligible():
+    rc = cache()
+    assert rc.is_eligible(chat(temperature=0))
+    assert not rc.is_eligible(chat(temperature=0.7))
+    assert not rc.is_eligible(chat(temperature=0, stream=True))
+    assert not cache(enabled=False).is_eligible(chat(temperature=0))
+
+@pytest.mark.parametrize("headers, expected", [
+    ({}, (True, True)),
+    ({"Cache-Control": "no-store"}, (False, False)),
+    ({"X-Router-Cache": "bypass"}, (False, False)),
+    ({"X-Router-Cache": "off"}, (False, False)),
+    ({"Cache-Control": "no-cache"}, (False, True)),
+    ({"X-Router-Cache": "refresh"}, (False, True)),
+])
+def test_bypass_headers(headers, expected):
+    assert main.cache_directives(request_with(headers)) == expected
+
+def test_key_depends_on_the_chain_and_sampling():
+    key = main.ResponseCache.make_key
+    chain = ["openai/gpt-4o-mini"]
+    assert key(chat(temperature=0), "code", chain) == key(chat(temperature=0), "code", chain)
+    assert key(chat(temperature=0), "code", chain) != key(chat(temperature=0), "conversation", chain)
+    assert key(chat(temperature=0), "code", chain) != key(chat(temperature=0), "code", chain + ["openai/gpt-4o"])
+    assert key(chat(temperature=0), "code", chain) != key(chat(temperature=0, max_tokens=5), "code", chain)
+    assert key(chat(temperature=0), "code", chain) != key(chat(temperature=0, stop=["END"]), "code", chain)
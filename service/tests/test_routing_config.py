@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+import main
+
+LEGAL = {"custom_categories": {"legal": {"keywords": ["contract"]}}, "model_mappings": {"legal": ["openai/a"]}}
+
+def test_snapshot_is_read_only():
+    table = main.RoutingSnapshot({"model_mappings": {"code": ["openai/a"]}}, 1)
+    with pytest.raises(TypeError):
+        table.model_mappings["code"] = ["openai/b"]
+    chain = table.chain("code")
+    chain.append("openai/b")
+    assert table.chain("code") == ["openai/a"]
+    assert table.chain("unknown") == table.chain("conversation")
+
+def test_a_request_keeps_its_snapshot(routing_config):
+    held = routing_config({"model_mappings": {"code": ["openai/a"]}})
+    current = routing_config({"model_mappings": {"code": ["openai/b"]}})
+    assert current.version == held.version + 1
+    assert held.chain("code") == ["openai/a"]
+    assert main.routing_table.chain("code") == ["openai/b"]
+    assert main.model_mappings["code"] == ("openai/b",)
+
+@pytest.mark.asyncio
+async def test_classification_reads_the_requests_snapshot(routing_config, monkeypatch):
+    monkeypatch.setattr(main, "ROUTING_MODE", "keywords")
+    messages = [{"role": "user", "content": "please review this contract before Friday"}]
+    held = routing_config(LEGAL)
+    routing_config({})  # Reloaded without the category while the request runs
+    assert await main.classify_message(messages, held) == ("legal", "keywords")
+    assert (await main.classify_message(messages, main.routing_table))[0] != "legal"
+
+@pytest.mark.asyncio
+async def test_update_persists_and_invalid_files_keep_the_table(routing_config, monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "CONFIG_FILE", str(tmp_path / "router_config.json"))
+    routing_config({})
+    table = await main.config_store.update(lambda config: config.update(LEGAL))
+    assert main.routing_table is table
+    assert table.chain("legal") == ["openai/a"]
+    with open(main.CONFIG_FILE) as f:
+        assert json.load(f) == LEGAL
+
+    with open(main.CONFIG_FILE, "w") as f:
+        f.write('{"model_mappings": ')  # Caught mid-write
+    with pytest.raises(ValueError):
+        await main.config_store.reload()
+    assert main.routing_table is table
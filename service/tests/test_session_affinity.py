@@ -0,0 +1,87 @@
+import main
+from conftest import expire
+
+CHAIN = ["openai/a", "openai/b", "openai/c"]
+TABLE = main.RoutingSnapshot({"model_mappings": {"code": CHAIN}}, 1)
+
+def pinned_session(model: str) -> main.SessionAffinity:
+    affinity = main.SessionAffinity()
+    affinity.assign("s1", "code", "keywords", 5.0, "explain this python function", [])
+    affinity.succeeded("s1", "code", model)
+    return affinity
+
+def test_session_key():
+    affinity = main.SessionAffinity()
+    opening = [{"role": "system", "content": "Be brief."}, {"role": "user", "content": "Hello"}]
+    later = opening + [{"role": "assistant", "content": "Hi"}, {"role": "user", "content": "More"}]
+    assert affinity.session_key("abc", None, opening) == "id\x00abc"
+    assert affinity.session_key(None, "u1", opening) == affinity.session_key(None, "u1", later)
+    assert affinity.session_key(None, "u1", opening) != affinity.session_key(None, "u2", opening)
+    assert affinity.session_key(None, None, [{"role": "system", "content": "x"}]) is None
+
+def test_lookup_returns_the_pinned_category():
+    affinity = pinned_session("openai/b")
+    assert affinity.lookup("s1", "now refactor the python function", [], TABLE) == "code"
+    assert affinity.lookup("other", "now refactor the python function", [], TABLE) is None
+    assert affinity.stats["hits"] == 1
+    assert affinity.stats["misses"] == 1
+
+def test_lookup_reclassifies_on_new_tools_and_max_turns(monkeypatch):
+    affinity = pinned_session("openai/b")
+    assert affinity.lookup("s1", "go on", ["search"], TABLE) is None
+    monkeypatch.setattr(main, "session_affinity_config", {"max_turns": 1})
+    assert affinity.lookup("s1", "go on", [], TABLE) == "code"
+    assert affinity.lookup("s1", "go on", [], TABLE) is None
+    assert dict(affinity.reclassified) == {"new_tools": 1, "max_turns": 1}
+
+def test_lookup_reclassifies_on_a_topic_shift():
+    affinity = main.SessionAffinity()
+    affinity.assign("s1", "code", "keywords", 5.0, "explain why this python function raises a KeyError", [])
+    assert affinity.lookup("s1", "short reply", [], TABLE) == "code"  # Under topic_min_words
+    assert affinity.lookup("s1", "should the python function catch that KeyError itself", [], TABLE) == "code"
+    assert affinity.lookup("s1", "recommend travel destinations across southern italy during autumn", [], TABLE) is None
+    assert affinity.reclassified["topic_shift"] == 1
+
+def test_lookup_reclassifies_when_the_category_left_the_table(routing_config):
+    affinity = main.SessionAffinity()
+    table = routing_config({"custom_categories": {"legal": {"keywords": ["contract"]}},
+                            "model_mappings": {"legal": ["openai/a"]}})
+    affinity.assign("s1", "legal", "keywords", 5.0, "review this contract clause", [])
+    assert affinity.lookup("s1", "and the next clause of the contract", [], table) == "legal"
+    other = main.RoutingSnapshot({}, table.version + 1)
+    assert affinity.lookup("s1", "and the next clause of the contract", [], other) is None
+    assert affinity.reclassified["config"] == 1
+
+def test_expired_sessions_are_classified_again():
+    affinity = pinned_session("openai/b")
+    affinity.sessions["s1"]["last_seen"] -= 10 ** 6
+    assert affinity.lookup("s1", "go on", [], TABLE) is None
+
+def test_model_pin_only_carries_over_within_a_category():
+    affinity = pinned_session("openai/b")
+    affinity.assign("s1", "code", "llm", 5.0, "go on", [])
+    assert affinity.sessions["s1"]["model"] == "openai/b"
+    affinity.assign("s1", "reasoning", "llm", 5.0, "prove it", [])
+    assert affinity.sessions["s1"]["model"] is None
+
+def test_order_puts_the_last_model_first(breaker):
+    affinity = pinned_session("openai/b")
+    assert affinity.order("s1", list(CHAIN)) == ["openai/b", "openai/a", "openai/c"]
+    assert affinity.order("s1", ["openai/a", "openai/c"]) == ["openai/a", "openai/c"]
+
+def test_order_skips_a_model_whose_circuit_is_not_closed(breaker):
+    affinity = pinned_session("openai/b")
+    for _ in range(breaker.config()["failure_threshold"]):
+        breaker.record_failure("openai/b")
+    assert affinity.order("s1", list(CHAIN)) == CHAIN
+
+def test_order_does_not_take_the_half_open_trial_slot(breaker):
+    affinity = pinned_session("openai/b")
+    for _ in range(breaker.config()["failure_threshold"]):
+        breaker.record_failure("openai/b")
+    expire(breaker, "openai/b")
+    assert affinity.order("s1", list(CHAIN)) == CHAIN
+    assert breaker.state("openai/b") == "open"
+    # The chain's own check still gets the trial
+    assert breaker.is_available("openai/b")
+    assert breaker.probes["openai/b"]["inflight"] == 1
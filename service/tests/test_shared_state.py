@@ -0,0 +1,116 @@
+import asyncio
+import os
+import sys
+import threading
+
+import pytest
+
+import main
+
+sys.path.insert(0, os.path.join(os.path.dirname(main.__file__), "bench"))
+import mock_redis  # noqa: E402
+
+MODEL = "openai/gpt-4o-mini"
+
+@pytest.fixture
+def redis_url():
+    """bench/mock_redis.py served from a background thread"""
+    mock_redis.store.clear()
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(mock_redis.handle, "127.0.0.1", 0))
+    port = server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield f"redis://127.0.0.1:{port}/0"
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
+
+@pytest.fixture(params=["mmap", "sqlite", "redis"])
+def backends(request, tmp_path):
+    """Two backend instances over the same store, as two workers would open them"""
+    if request.param == "mmap":
+        if main.fcntl is None:
+            pytest.skip("mmap backend needs fcntl")
+        open_backend = lambda: main.MmapBackend(str(tmp_path / "shared_state.mmap"), size=64 * 1024)
+    elif request.param == "sqlite":
+        open_backend = lambda: main.SQLiteBackend(str(tmp_path / "shared_state.db"))
+    else:
+        url = request.getfixturevalue("redis_url")
+        open_backend = lambda: main.RedisBackend(url)
+    pair = (open_backend(), open_backend())
+    yield pair
+    for backend in pair:
+        backend.close()
+
+@pytest.fixture
+def workers(new_breaker):
+    """Breakers of two workers, queueing their changes for the shared state"""
+    pair = (new_breaker(), new_breaker())
+    for cb in pair:
+        cb.shared = True
+    return pair
+
+def test_counter_deltas_add_up_across_workers(backends):
+    a, b = backends
+    a.sync({"requests_total": 2.0, "model_usage\x1fm": 1.0}, {})
+    counters, _ = b.sync({"requests_total": 3.0}, {})
+    assert counters == {"requests_total": 5.0, "model_usage\x1fm": 1.0}
+    counters, _ = a.sync({}, {})
+    assert counters["requests_total"] == 5.0
+
+def test_breaker_failures_add_up_and_a_success_resets_them(backends, workers):
+    (a, b), (cb_a, cb_b) = backends, workers
+    cb_a.record_failure(MODEL)
+    cb_b.record_failure(MODEL)
+    a.sync({}, cb_a.take_pending())
+    _, breakers = b.sync({}, cb_b.take_pending())
+    assert breakers[MODEL]["failures"] == 2
+    assert breakers[MODEL]["last_failure"] > 0
+    cb_b.apply_shared(breakers)
+    assert cb_b.failures[MODEL] == 2
+    
+    cb_a.record_success(MODEL)
+    a.sync({}, cb_a.take_pending())
+    _, breakers = b.sync({}, {})
+    assert breakers[MODEL]["failures"] == 0
+
+def test_trips_and_closes_reach_the_other_worker(backends, workers):
+    (a, b), (cb_a, cb_b) = backends, workers
+    for _ in range(cb_a.config()["failure_threshold"]):
+        cb_a.record_failure(MODEL)
+    a.sync({}, cb_a.take_pending())
+    cb_b.apply_shared(b.sync({}, {})[1])
+    assert cb_b.state(MODEL) == "open"
+    assert cb_b.trips[MODEL] == 1
+    
+    cb_a.opened_at[MODEL] -= 10 ** 6
+    assert cb_a.is_available(MODEL)
+    cb_a.record_success(MODEL)
+    a.sync({}, cb_a.take_pending())
+    cb_b.apply_shared(b.sync({}, {})[1])
+    assert cb_b.state(MODEL) == "closed"
+
+def test_reset_all_closes_circuits_on_every_worker(backends, workers):
+    (a, b), (cb_a, cb_b) = backends, workers
+    for _ in range(cb_a.config()["failure_threshold"]):
+        cb_a.record_failure(MODEL)
+    a.sync({}, cb_a.take_pending())
+    cb_b.apply_shared(b.sync({}, {})[1])
+    assert cb_b.state(MODEL) == "open"
+    
+    cb_a.reset_all()
+    _, breakers = a.sync({}, cb_a.take_pending())
+    assert MODEL not in breakers
+    cb_b.apply_shared(b.sync({}, {})[1])
+    assert cb_b.state(MODEL) == "closed"
+
+def test_failed_sync_keeps_changes_for_the_next_one(workers):
+    cb, _ = workers
+    cb.record_failure(MODEL)
+    ops = cb.take_pending()
+    cb.record_failure(MODEL)
+    cb.restore_pending(ops)
+    assert cb.take_pending()[MODEL]["failures"] == 2
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+import main
+
+@pytest.mark.asyncio
+async def test_concurrent_callers_share_one_call():
+    flight = main.SingleFlight(enabled=True)
+    calls = []
+    
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+    
+    results = await asyncio.gather(*(flight.run("k", call, "chat") for _ in range(3)))
+    assert len(calls) == 1
+    assert [r for r, _ in results] == ["result"] * 3
+    assert sorted(shared for _, shared in results) == [False, True, True]
+    assert flight.calls == {}
+    assert flight.get_stats()["upstream_calls_saved"] == 2
+
+@pytest.mark.asyncio
+async def test_different_keys_and_later_callers_make_their_own_call():
+    flight = main.SingleFlight(enabled=True)
+    calls = []
+    
+    async def call():
+        calls.append(1)
+        return len(calls)
+    
+    await asyncio.gather(flight.run("a", call, "chat"), flight.run("b", call, "chat"))
+    assert await flight.run("a", call, "chat") == (3, False)
+
+@pytest.mark.asyncio
+async def test_errors_reach_every_caller():
+    flight = main.SingleFlight(enabled=True)
+    
+    async def call():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+    
+    results = await asyncio.gather(*(flight.run("k", call, "chat") for _ in range(2)), return_exceptions=True)
+    assert all(isinstance(r, ValueError) for r in results)
+    assert flight.calls == {}
+
+@pytest.mark.asyncio
+async def test_caller_giving_up_does_not_cancel_the_others():
+    flight = main.SingleFlight(enabled=True)
+    
+    async def call():
+        await asyncio.sleep(0.02)
+        return "result"
+    
+    first = asyncio.ensure_future(flight.run("k", call, "chat"))
+    second = asyncio.ensure_future(flight.run("k", call, "chat"))
+    await asyncio.sleep(0)
+    first.cancel()
+    assert (await second) == ("result", True)
+
+@pytest.mark.asyncio
+async def test_call_is_cancelled_once_nobody_waits():
+    flight = main.SingleFlight(enabled=True)
+    started = asyncio.Event()
+    
+    async def call():
+        started.set()
+        await asyncio.sleep(10)
+    
+    waiter = asyncio.ensure_future(flight.run("k", call, "chat"))
+    await started.wait()
+    task = flight.calls["k"][0]
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    await asyncio.sleep(0)  # Done callbacks run on the next loop iteration
+    assert task.cancelled()
+    assert flight.calls == {}
+
+@pytest.mark.asyncio
+async def test_disabled_calls_every_time():
+    flight = main.SingleFlight(enabled=False)
+    calls = []
+    
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+    
+    await asyncio.gather(*(flight.run("k", call, "chat") for _ in range(3)))
+    assert len(calls) == 3
@@ -0,0 +1,74 @@
+import asyncio
+import time
+
+import anyio
+import httpx
+import pytest
+
+import main
+from conftest import expire
+
+MODEL = "openai/gpt-4o-mini"
+CHUNK = b'data: {"choices":[{"index":0,"delta":{"content":"Hel"},"finish_reason":null}]}\n\n'
+
+def chat() -> main.ChatCompletionRequest:
+    return main.ChatCompletionRequest(model="router", messages=[{"role": "user", "content": "hi"}], stream=True)
+
+def sse_response(body) -> httpx.Response:
+    return httpx.Response(200, content=body, headers={"Content-Type": "text/event-stream"})
+
+def counts() -> dict:
+    return {k: main.metrics[k] for k in ("requests_success", "requests_failed", "requests_aborted")}
+
+class StalledStream(httpx.AsyncByteStream):
+    """One chunk, then nothing until the client leaves; closing takes a loop turn, like a real connection"""
+    
+    def __init__(self):
+        self.closed = False
+    
+    async def __aiter__(self):
+        yield CHUNK
+        await asyncio.Event().wait()
+    
+    async def aclose(self):
+        await asyncio.sleep(0)
+        self.closed = True
+
+@pytest.fixture
+def streaming(upstream, breaker, monkeypatch):
+    monkeypatch.setattr(main, "rate_limiter", main.RateLimiter())
+    return upstream
+
+@pytest.mark.asyncio
+async def test_stream_is_relayed_and_counted(streaming, breaker):
+    streaming.respond = lambda r: sse_response(CHUNK + b"data: [DONE]\n\n")
+    before = counts()
+    response = await main.stream_chat_completion(chat(), "conversation", "keywords", [MODEL], time.time())
+    body = [chunk async for chunk in response.body_iterator]
+    assert body == [CHUNK, b"data: [DONE]\n\n"]
+    assert counts()["requests_success"] == before["requests_success"] + 1
+    assert main.json_loads(streaming[0].content)["stream"] is True
+
+@pytest.mark.asyncio
+async def test_client_disconnect_is_its_own_outcome(streaming, breaker):
+    stream = StalledStream()
+    streaming.respond = lambda r: httpx.Response(200, stream=stream, headers={"Content-Type": "text/event-stream"})
+    for _ in range(breaker.config()["failure_threshold"]):
+        breaker.record_failure(MODEL)
+    expire(breaker, MODEL)
+    before = counts()
+    response = await main.stream_chat_completion(chat(), "conversation", "keywords", [MODEL], time.time())
+    assert breaker.probes[MODEL]["inflight"] == 1  # The stream holds the half-open trial
+    received = []
+    # Starlette cancels the response task's scope on disconnect: every await in it is cancelled
+    with anyio.move_on_after(0.1):
+        async for chunk in response.body_iterator:
+            received.append(chunk)
+    assert received == [CHUNK]
+    after = counts()
+    assert after["requests_aborted"] == before["requests_aborted"] + 1
+    assert after["requests_failed"] == before["requests_failed"]
+    # Neither a failure nor a success of the model: the trial goes to the next request
+    assert breaker.state(MODEL) == "half_open"
+    assert breaker.probes[MODEL]["inflight"] == 0
+    assert stream.closed